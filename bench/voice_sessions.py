@@ -0,0 +1,444 @@
+"""Concurrent voice-session benchmark for bot.py.
+
+Drives the real play_next / per-guild player task for N simulated guilds, with:
+- a fake voice client that paces source.read() every 20ms like discord.py's
+  AudioPlayer (and Opus-encodes PCM frames when libopus is available),
+- a local HTTP server (separate process) serving a canned WAV tone in place
+  of googlevideo,
+- a stubbed yt-dlp extractor plugged into the real extractor pool.
+
+Reports per scale step: track-transition gap, frame lateness (jitter), CPU
+(bot process + FFmpeg children) and RSS.
+
+Usage:
+    python bench/voice_sessions.py --guilds 1,10,50,100,200 --tracks 4 --track-seconds 5
+    python bench/voice_sessions.py --guilds 300 --extract-ms 800 --unique --json bench_output.txt
+    python bench/voice_sessions.py --guilds 50,200 --broadcast-window 5
+
+Without an `ffmpeg` binary, tracks are read from the HTTP server directly as
+raw PCM (FFmpeg spawn/decode cost is then not measured).
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import multiprocessing
+import os
+import resource
+import shutil
+import struct
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import discord  # noqa: E402
+
+import bot as botmod  # noqa: E402
+
+SAMPLE_RATE = 48000
+CHANNELS = 2
+FRAME_MS = 20
+FRAME_BYTES = SAMPLE_RATE * CHANNELS * 2 * FRAME_MS // 1000  # 3840
+FRAME_DELAY = FRAME_MS / 1000
+WAV_HEADER_BYTES = 44
+# Frame lateness histogram buckets, in ms (last bucket = overflow)
+JITTER_BUCKETS = 201
+
+
+def _make_wav(seconds: float) -> bytes:
+    n = int(SAMPLE_RATE * seconds)
+    pcm = io.BytesIO()
+    for i in range(n):
+        v = int(3000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE))
+        pcm.write(struct.pack("<hh", v, v))
+    data = pcm.getvalue()
+    header = b"RIFF" + struct.pack("<I", 36 + len(data)) + b"WAVE"
+    header += b"fmt " + struct.pack("<IHHIIHH", 16, 1, CHANNELS, SAMPLE_RATE, SAMPLE_RATE * CHANNELS * 2, CHANNELS * 2, 16)
+    header += b"data" + struct.pack("<I", len(data))
+    return header + data
+
+
+def _serve_audio(seconds: float, port_queue) -> None:
+    """Child process: serve the same WAV for any /audio/... path."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    body = _make_wav(seconds)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/wav")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class _HTTPPCMSource(discord.AudioSource):
+    """Stand-in for FFmpegPCMAudio when ffmpeg is not installed."""
+
+    def __init__(self, url: str, seek: float = 0.0):
+        self._resp = urllib.request.urlopen(url)
+        # Like ffmpeg -ss: decode (here, read) and drop everything before `seek`
+        self._resp.read(WAV_HEADER_BYTES + FRAME_BYTES * round(seek / FRAME_DELAY))
+
+    def read(self) -> bytes:
+        data = self._resp.read(FRAME_BYTES)
+        return data if len(data) == FRAME_BYTES else b""
+
+    def cleanup(self) -> None:
+        self._resp.close()
+
+
+class _FakeYDL:
+    """Stub for yt_dlp.YoutubeDL: answers every query with a local audio URL."""
+
+    base_url = ""
+    latency = 0.0
+    track_seconds = 5.0
+
+    def __init__(self, profile: str):
+        self.params = {}
+
+    def extract_info(self, query: str, download: bool = False) -> dict:
+        if self.latency:
+            time.sleep(self.latency)
+        vid = query.rsplit("=", 1)[-1]
+        return {
+            "url": f"{self.base_url}/audio/{vid}.wav?expire={int(time.time()) + 6 * 3600}",
+            "title": f"Bench {vid}",
+            "webpage_url": query,
+            "duration": self.track_seconds,
+            "acodec": "pcm_s16le",
+        }
+
+
+class _FakeVoiceClient:
+    """Paces reads like discord.py's AudioPlayer and records timing stats."""
+
+    def __init__(self, encoder):
+        self._encoder = encoder
+        self._thread = None
+        self._stop = threading.Event()
+        self._connected = True
+        self.channel = None
+        self.tracks_finished = 0
+        self.last_frame_at = None
+        self.gaps: list[float] = []
+        self.jitter = [0] * JITTER_BUCKETS
+        self.frames = 0
+
+    def is_connected(self) -> bool:
+        return self._connected
+
+    def is_playing(self) -> bool:
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def is_paused(self) -> bool:
+        return False
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def pause(self) -> None:
+        pass
+
+    def resume(self) -> None:
+        pass
+
+    async def disconnect(self, *, force: bool = False) -> None:
+        self._stop.set()
+        self._connected = False
+
+    def play(self, source: discord.AudioSource, *, after=None) -> None:
+        self._stop = threading.Event()
+        stop = self._stop
+        self._thread = threading.Thread(target=self._run, args=(source, after, stop), daemon=True)
+        self._thread.start()
+
+    def _run(self, source, after, stop) -> None:
+        error = None
+        loops = 0
+        start = time.perf_counter()
+        try:
+            while not stop.is_set():
+                data = source.read()
+                if not data:
+                    break
+                now = time.perf_counter()
+                if loops == 0:
+                    if self.last_frame_at is not None:
+                        self.gaps.append(now - self.last_frame_at)
+                else:
+                    # AudioPlayer sleeps DELAY + (next_time - now), so read k lands at start + (k+1)*DELAY
+                    late_ms = int((now - (start + FRAME_DELAY * (loops + 1))) * 1000)
+                    self.jitter[min(max(late_ms, 0), JITTER_BUCKETS - 1)] += 1
+                if self._encoder is not None and not source.is_opus():
+                    self._encoder.encode(data, self._encoder.SAMPLES_PER_FRAME)
+                self.last_frame_at = now
+                self.frames += 1
+                loops += 1
+                next_time = start + FRAME_DELAY * loops
+                time.sleep(max(0, FRAME_DELAY + (next_time - time.perf_counter())))
+        except Exception as e:
+            error = e
+        finally:
+            source.cleanup()
+            self.tracks_finished += 1
+            if after is not None:
+                after(error)
+
+
+class _FakeMessage:
+    id = 0
+
+    async def edit(self, **kwargs):
+        return self
+
+    async def delete(self):
+        pass
+
+
+class _FakeChannel:
+    """Text channel stub for the bot's outbound message scheduler."""
+
+    def __init__(self, channel_id: int):
+        self.id = channel_id
+        self.last_message_id = None
+
+    async def send(self, content=None, **kwargs):
+        return _FakeMessage()
+
+
+class _FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+
+
+class _FakeAuthor:
+    id = 1
+    voice = None
+
+
+class _FakeCtx:
+    def __init__(self, guild_id: int, voice_client: _FakeVoiceClient):
+        self.guild = _FakeGuild(guild_id)
+        self.voice_client = voice_client
+        self.author = _FakeAuthor()
+        self.channel = _FakeChannel(guild_id)
+        self.interaction = None
+
+    async def send(self, content=None, **kwargs):
+        return _FakeMessage()
+
+
+def _percentile(sorted_values: list, pct: float) -> float:
+    if not sorted_values:
+        return float("nan")
+    k = min(len(sorted_values) - 1, max(0, int(round(pct / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+def _hist_percentile(hist: list, pct: float) -> float:
+    total = sum(hist)
+    if total == 0:
+        return float("nan")
+    target = pct / 100 * total
+    seen = 0
+    for ms, count in enumerate(hist):
+        seen += count
+        if seen >= target:
+            return float(ms)
+    return float(len(hist) - 1)
+
+
+def _rss_mb() -> float:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is the peak, in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _cpu_seconds() -> float:
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _reset_bot_state() -> None:
+    for guild_id in list(botmod.players):
+        botmod._release_player(guild_id, forget=True)
+
+
+async def _run_step(n_guilds: int, args, encoder) -> dict:
+    _reset_bot_state()
+    if args.unique:
+        botmod._resolution_cache = botmod._ResolutionCache(botmod.RESOLVE_CACHE_SIZE)
+
+    ctxs = []
+    for g in range(n_guilds):
+        guild_id = 10_000 + g
+        vc = _FakeVoiceClient(encoder)
+        ctx = _FakeCtx(guild_id, vc)
+        tag = f"g{g}t" if args.unique else "t"
+        botmod._get_player(guild_id).queue.extend(
+            botmod._make_queue_item(f"https://www.youtube.com/watch?v={tag}{t}", requester_id=1)
+            for t in range(args.tracks)
+        )
+        ctxs.append(ctx)
+
+    # Event-loop lag sampler: how late a 10ms sleep wakes up
+    loop_lag: list[float] = []
+    sampling = True
+
+    async def _sample_loop_lag():
+        while sampling:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.01)
+            loop_lag.append(time.perf_counter() - t0 - 0.01)
+
+    sampler = asyncio.create_task(_sample_loop_lag())
+    cpu0, wall0 = _cpu_seconds(), time.perf_counter()
+    rss_peak = _rss_mb()
+
+    await asyncio.gather(*(botmod.play_next(ctx) for ctx in ctxs))
+
+    deadline = time.perf_counter() + args.tracks * (args.track_seconds + 30) + 30
+    while time.perf_counter() < deadline:
+        rss_peak = max(rss_peak, _rss_mb())
+        if all(ctx.voice_client.tracks_finished >= args.tracks for ctx in ctxs):
+            break
+        await asyncio.sleep(0.25)
+
+    cpu1, wall1 = _cpu_seconds(), time.perf_counter()
+    sampling = False
+    await sampler
+
+    gaps = sorted(g for ctx in ctxs for g in ctx.voice_client.gaps)
+    jitter = [sum(col) for col in zip(*(ctx.voice_client.jitter for ctx in ctxs))]
+    lag = sorted(loop_lag)
+    finished = sum(ctx.voice_client.tracks_finished for ctx in ctxs)
+    for ctx in ctxs:
+        await ctx.voice_client.disconnect()
+
+    return {
+        "guilds": n_guilds,
+        "tracks_finished": finished,
+        "tracks_expected": n_guilds * args.tracks,
+        "gap_p50_ms": _percentile(gaps, 50) * 1000,
+        "gap_p95_ms": _percentile(gaps, 95) * 1000,
+        "gap_max_ms": (gaps[-1] if gaps else float("nan")) * 1000,
+        "jitter_p50_ms": _hist_percentile(jitter, 50),
+        "jitter_p99_ms": _hist_percentile(jitter, 99),
+        "late_frames_pct": 100 * sum(jitter[5:]) / max(1, sum(jitter)),
+        "loop_lag_p99_ms": _percentile(lag, 99) * 1000,
+        "cpu_pct": 100 * (cpu1 - cpu0) / max(1e-9, wall1 - wall0),
+        "rss_peak_mb": rss_peak,
+        "wall_s": wall1 - wall0,
+    }
+
+
+def _print_row(r: dict) -> None:
+    print(
+        f"{r['guilds']:>6} {r['tracks_finished']:>5}/{r['tracks_expected']:<5} "
+        f"{r['gap_p50_ms']:>8.1f} {r['gap_p95_ms']:>8.1f} {r['gap_max_ms']:>8.1f} "
+        f"{r['jitter_p50_ms']:>6.0f} {r['jitter_p99_ms']:>6.0f} {r['late_frames_pct']:>6.2f} "
+        f"{r['loop_lag_p99_ms']:>7.1f} {r['cpu_pct']:>6.1f} {r['rss_peak_mb']:>7.1f}"
+    )
+
+
+async def _main(args) -> list:
+    port_queue = multiprocessing.get_context("spawn").Queue()
+    server = multiprocessing.get_context("spawn").Process(
+        target=_serve_audio, args=(args.track_seconds, port_queue), daemon=True
+    )
+    server.start()
+    base_url = f"http://127.0.0.1:{port_queue.get(timeout=60)}"
+
+    # Wire the bot module to the local stand-ins
+    botmod.bot.loop = asyncio.get_running_loop()
+    _FakeYDL.base_url = base_url
+    _FakeYDL.latency = args.extract_ms / 1000
+    _FakeYDL.track_seconds = args.track_seconds
+    botmod._new_ydl = _FakeYDL
+    botmod._ydl_pool = botmod._YDLPool(botmod.EXTRACT_CONCURRENCY, backend="thread")
+    if not args.ffmpeg:
+        botmod._make_audio_source = lambda url, acodec=None, seek=0.0: _HTTPPCMSource(url, seek)
+        botmod._make_pcm_source = _HTTPPCMSource
+        botmod._make_opus_source = lambda url, acodec=None, seek=0.0: _HTTPPCMSource(url, seek)
+    botmod.BROADCAST_WINDOW = args.broadcast_window
+
+    encoder = None
+    try:
+        encoder = discord.opus.Encoder()
+    except Exception:
+        print("libopus not available: PCM frames are not Opus-encoded (encode CPU not measured).")
+
+    print(
+        f"audio={'ffmpeg' if args.ffmpeg else 'http-pcm'} mode={botmod.AUDIO_MODE} tracks={args.tracks} "
+        f"track_seconds={args.track_seconds} extract_ms={args.extract_ms} unique={args.unique} "
+        f"broadcast_window={args.broadcast_window}"
+    )
+    print(
+        f"{'guilds':>6} {'tracks':^11} {'gap50':>8} {'gap95':>8} {'gapmax':>8} "
+        f"{'jit50':>6} {'jit99':>6} {'late%':>6} {'lag99':>7} {'cpu%':>6} {'rssMB':>7}"
+    )
+    results = []
+    try:
+        for n in args.guilds:
+            r = await _run_step(n, args, encoder)
+            _print_row(r)
+            results.append(r)
+    finally:
+        server.terminate()
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--guilds", default="1,10,50,100,200", help="comma-separated guild counts to run")
+    parser.add_argument("--tracks", type=int, default=3, help="tracks queued per guild")
+    parser.add_argument("--track-seconds", type=float, default=5.0, help="length of the canned track")
+    parser.add_argument("--extract-ms", type=float, default=300.0, help="simulated yt-dlp latency per extraction")
+    parser.add_argument("--unique", action="store_true", help="distinct tracks per guild (no shared cache hits)")
+    parser.add_argument(
+        "--broadcast-window", type=float, default=0.0, help="share one upstream per track across guilds (seconds)"
+    )
+    parser.add_argument("--no-ffmpeg", dest="ffmpeg", action="store_false", help="read PCM over HTTP instead of FFmpeg")
+    parser.add_argument("--json", help="also write results as JSON to this file")
+    args = parser.parse_args()
+    args.guilds = [int(x) for x in args.guilds.split(",") if x.strip()]
+    if args.ffmpeg and shutil.which("ffmpeg") is None:
+        print("ffmpeg not found, using --no-ffmpeg.")
+        args.ffmpeg = False
+
+    results = asyncio.run(_main(args))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,43 @@
+import time
+_boot_started = time.perf_counter()  # for the startup timing log
+
 import discord
 from discord.ext import commands
 from discord import app_commands
-import yt_dlp
 import asyncio
-from collections import deque
+from collections import deque, OrderedDict
 import os
 from dotenv import load_dotenv
 from urllib.parse import urlparse, parse_qs, urlunparse, urlencode
-from typing import Optional, Tuple
-import time
+from typing import Optional
 from itertools import islice
-
-from flask import Flask
-from threading import Thread
+from contextlib import aclosing, contextmanager
+
+from aiohttp import web
+import threading
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import sqlite3
+import heapq
+import bisect
+import re
+import unicodedata
+import mmap
+import struct
+import math
+import weakref
+import functools
+import sys
+import traceback
+import json
+import random
+import hashlib
+import importlib
+import marshal
 # Load Opus với đường dẫn đầy đủ (Apple Silicon Homebrew)
 # OPUS_PATH = 'opus' #'/opt/homebrew/lib/libopus.dylib'  # <-- Đây là fix chính!
-app = Flask(__name__)
 
 # Nếu Intel Mac: OPUS_PATH = '/usr/local/lib/libopus.dylib'
 
@@ -37,8 +59,48 @@ GUILD_ID = os.getenv('DISCORD_GUILD_ID')
 SYNC_SCOPE = (os.getenv("DISCORD_SYNC_SCOPE") or "").lower()  # "guild" | "global"
 CLEAR_GLOBAL_COMMANDS = (os.getenv("DISCORD_CLEAR_GLOBAL_COMMANDS") == "1")
 CLEAR_GUILD_COMMANDS = (os.getenv("DISCORD_CLEAR_GUILD_COMMANDS") == "1")
-MAX_PLAYLIST_ITEMS = int(os.getenv("DISCORD_MAX_PLAYLIST_ITEMS") or "25")
+MAX_PLAYLIST_ITEMS = int(os.getenv("DISCORD_MAX_PLAYLIST_ITEMS") or "2000")
+PREFETCH_CONCURRENCY = int(os.getenv("DISCORD_PREFETCH_CONCURRENCY") or "2")
+PREFETCH_PER_GUILD = int(os.getenv("DISCORD_PREFETCH_PER_GUILD") or "1")
 QUEUE_PAGE_SIZE = int(os.getenv("DISCORD_QUEUE_PAGE_SIZE") or "10")
+# Open /queue messages re-render at most this often after the queue changes (0 = Refresh button only)
+QUEUE_REFRESH_SECONDS = float(os.getenv("DISCORD_QUEUE_REFRESH_SECONDS") or "3")
+# Bot-initiated channel messages (now playing, failure notices) are coalesced over this window
+MESSAGE_DEBOUNCE_SECONDS = int(os.getenv("DISCORD_MESSAGE_DEBOUNCE_MS") or "750") / 1000
+EXTRACT_CONCURRENCY = int(os.getenv("DISCORD_EXTRACT_CONCURRENCY") or "4")
+EXTRACT_BACKEND = (os.getenv("DISCORD_EXTRACT_BACKEND") or "thread").lower()  # "thread" | "process"
+# A track that stops this many seconds before its known end (dead stream, FFmpeg exit) is resumed
+# from where it stopped, at most RESUME_MAX_ATTEMPTS times per track
+RESUME_MIN_REMAINING = float(os.getenv("DISCORD_RESUME_MIN_REMAINING") or "5")
+RESUME_MAX_ATTEMPTS = int(os.getenv("DISCORD_RESUME_MAX_ATTEMPTS") or "2")
+# Seconds before the current track ends to spawn FFmpeg for the next one (0 = resolve only)
+GAPLESS_PRESPAWN_SECONDS = float(os.getenv("DISCORD_GAPLESS_PRESPAWN_SECONDS") or "10")
+# "pcm": FFmpeg decodes to PCM, discord.py encodes Opus (original behaviour)
+# "opus": prefer Opus formats and send them as-is via FFmpegOpusAudio (codec copy)
+AUDIO_MODE = (os.getenv("DISCORD_AUDIO_MODE") or "pcm").lower()
+RESOLVE_CACHE_SIZE = int(os.getenv("DISCORD_RESOLVE_CACHE_SIZE") or "2000")
+RESOLVE_CACHE_DB = os.getenv("DISCORD_RESOLVE_CACHE_DB")  # optional SQLite path, e.g. "resolve_cache.db"
+# Optional SQLite path for player snapshots (queues, history, repeat mode), e.g. "player_state.db"
+STATE_DB = os.getenv("DISCORD_STATE_DB")
+STATE_SNAPSHOT_SECONDS = float(os.getenv("DISCORD_STATE_SNAPSHOT_SECONDS") or "30")
+SEARCH_INDEX_SIZE = int(os.getenv("DISCORD_SEARCH_INDEX_SIZE") or "5000")
+SEARCH_RECENT_PER_GUILD = int(os.getenv("DISCORD_SEARCH_RECENT_PER_GUILD") or "300")  # /play suggestions per guild
+# Optional local audio cache: upcoming tracks are downloaded as Ogg/Opus and played from disk
+AUDIO_CACHE_DIR = os.getenv("DISCORD_AUDIO_CACHE_DIR")  # e.g. "audio_cache"; unset = disabled
+AUDIO_CACHE_MAX_MB = int(os.getenv("DISCORD_AUDIO_CACHE_MAX_MB") or "2048")
+AUDIO_CACHE_PREDOWNLOAD = int(os.getenv("DISCORD_AUDIO_CACHE_PREDOWNLOAD") or "3")  # upcoming items per guild
+AUDIO_CACHE_MAX_TRACK_SECONDS = int(os.getenv("DISCORD_AUDIO_CACHE_MAX_TRACK_SECONDS") or "900")
+# Seconds after a stream starts during which other guilds playing the same track
+# share its FFmpeg process instead of spawning their own (0 = disabled)
+BROADCAST_WINDOW = float(os.getenv("DISCORD_BROADCAST_WINDOW") or "0")
+# Log the event loop's stack whenever it is blocked longer than this many ms (0 = disabled)
+LOOP_WATCHDOG_MS = float(os.getenv("DISCORD_LOOP_WATCHDOG_MS") or "0")
+# Per-track lifecycle traces: recent ones kept in memory for /debug trace, optionally appended as JSONL
+TRACE_BUFFER_SIZE = int(os.getenv("DISCORD_TRACE_BUFFER_SIZE") or "200")
+TRACE_SAMPLE_RATE = float(os.getenv("DISCORD_TRACE_SAMPLE_RATE") or "1")  # fraction of transitions traced
+TRACE_FILE = os.getenv("DISCORD_TRACE_FILE")  # e.g. "traces.jsonl"
+# Hash of the last synced slash-command tree per scope; sync is skipped while it matches
+COMMAND_HASH_FILE = os.getenv("DISCORD_COMMAND_HASH_FILE") or ".command_tree_hash.json"
 
 intents = discord.Intents.default()
 intents.message_content = True
@@ -47,23 +109,557 @@ intents.members = True
 
 bot = commands.Bot(command_prefix='!', intents=intents)
 
+
+class _Metrics:
+    """Minimal Prometheus text-format registry (counters, gauges, histograms).
+
+    Updated from the event loop and voice/worker threads, rendered by the HTTP
+    server on scrape. Values that already live elsewhere (cache stats, queue
+    sizes) are read at scrape time by collector callbacks instead of mirrored.
+    """
+
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._lock = Lock()
+        self._families: dict[str, tuple[str, str, tuple]] = {}  # name -> (type, help, buckets)
+        self._values: dict[str, dict[tuple, float]] = {}  # counters/gauges: name -> labels -> value
+        self._hists: dict[str, dict[tuple, list]] = {}  # name -> labels -> [bucket counts..., sum, count]
+        self._collectors: list = []
+
+    def describe(self, name: str, kind: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self._families[name] = (kind, help_text, buckets)
+
+    def inc(self, name: str, value: float = 1.0, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._values.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self._values.setdefault(name, {})[tuple(sorted(labels.items()))] = value
+
+    def clear(self, name: str) -> None:
+        """Drop all series of a gauge (e.g. per-guild gauges before re-collecting)."""
+        with self._lock:
+            self._values.pop(name, None)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        buckets = self._families[name][2]
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts = self._hists.setdefault(name, {}).get(key)
+            if counts is None:
+                counts = self._hists[name][key] = [0] * (len(buckets) + 2)
+            counts[bisect.bisect_left(buckets, value)] += 1  # bucket "le" is inclusive
+            counts[-2] += value
+            counts[-1] += 1
+
+    def collector(self, fn):
+        """Register fn() to refresh gauges right before each scrape."""
+        self._collectors.append(fn)
+        return fn
+
+    def render(self) -> str:
+        for fn in self._collectors:
+            try:
+                fn()
+            except Exception as e:
+                print(f"Metrics collector {fn.__name__} failed: {e}")
+        lines: list[str] = []
+        with self._lock:
+            for name, (kind, help_text, buckets) in self._families.items():
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == "histogram":
+                    for key, counts in self._hists.get(name, {}).items():
+                        cumulative = 0
+                        for bound, n in zip((*buckets, "+Inf"), counts):
+                            cumulative += n
+                            lines.append(f"{name}_bucket{_metric_labels(key, le=bound)} {cumulative}")
+                        lines.append(f"{name}_sum{_metric_labels(key)} {counts[-2]}")
+                        lines.append(f"{name}_count{_metric_labels(key)} {counts[-1]}")
+                else:
+                    for key, value in self._values.get(name, {}).items():
+                        lines.append(f"{name}{_metric_labels(key)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _metric_labels(key: tuple, **extra) -> str:
+    pairs = [*key, *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+_metrics = _Metrics()
+_metrics.describe("bot_extract_seconds", "histogram", "yt-dlp extraction latency by kind (single/search/playlist).")
+_metrics.describe("bot_track_gap_seconds", "histogram", "Silence between one track ending and the next starting.")
+_metrics.describe("bot_event_loop_lag_seconds", "histogram", "How late a periodic event-loop wakeup fires.")
+_metrics.describe("bot_cache_requests_total", "counter", "Cache lookups by cache and result.")
+_metrics.describe("bot_resolve_coalesced_total", "counter", "Resolutions that joined an identical in-flight extraction.")
+_metrics.describe("bot_queue_depth", "gauge", "Queued tracks per guild.")
+_metrics.describe("bot_guilds_playing", "gauge", "Guilds with a track playing.")
+_metrics.describe("bot_ffmpeg_processes", "gauge", "Running FFmpeg processes (playback, shared streams and downloads).")
+_metrics.describe("bot_extract_workers", "gauge", "Extraction pool calls by state (busy/queued) and pool size (max).")
+_metrics.describe("bot_gateway_latency_seconds", "gauge", "Discord gateway heartbeat latency.")
+_metrics.describe("bot_handler_seconds", "histogram", "Command and button handler duration by handler.")
+_metrics.describe("bot_event_loop_stalls_total", "counter", "Event-loop blocks longer than the watchdog threshold.")
+_metrics.describe(
+    "bot_outbound_messages_total",
+    "counter",
+    "Bot-initiated channel messages by result (sent/edited/deleted/merged/suppressed/failed).",
+)
+
+
+def _timed(handler: str):
+    """Decorator recording an async handler's duration in bot_handler_seconds."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                _metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=handler)
+        return wrapper
+    return decorator
+
+
+class _TrackTrace:
+    """Timeline of one track transition: named spans plus a few milestones, all in ms."""
+
+    __slots__ = ("record", "_t0")
+
+    def __init__(self, guild_id: int, reason: Optional[str]):
+        self._t0 = time.perf_counter()
+        self.record = {
+            "ts": time.time(),
+            "guild_id": guild_id,
+            "reason": reason or "next",
+            "source": None,
+            "title": None,
+            "path": None,  # prepared | audio_cache | fresh_url | resolved | empty
+            "resolve_cache": None,  # hit | stale | miss | coalesced, when resolution ran
+            "retries": 0,  # unplayable items skipped before this one
+            "spans": {},
+            "to_audio_ms": None,  # voice_client.play() called
+            "first_packet_ms": None,  # first frame read by the voice thread
+            "total_ms": None,  # now-playing message sent
+        }
+
+    def span(self, name: str, started: float) -> None:
+        """Add time since `started` (perf_counter) to span `name` (summed over retries)."""
+        spans = self.record["spans"]
+        spans[name] = round(spans.get(name, 0) + (time.perf_counter() - started) * 1000, 2)
+
+    def mark(self, key: str) -> None:
+        self.record[key] = round((time.perf_counter() - self._t0) * 1000, 2)
+
+
+@contextmanager
+def _trace_span(name: str, trace: Optional[_TrackTrace]):
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.span(name, started)
+
+
+class _Tracer:
+    """Sampled track traces: a ring buffer for /debug trace, plus an optional JSONL file."""
+
+    def __init__(self, size: int, sample_rate: float, path: Optional[str]):
+        self.recent: deque = deque(maxlen=max(1, size))
+        self.sample_rate = sample_rate
+        self.path = path
+        self._pending: list[str] = []
+        self._flushing = False
+
+    def start(self, guild_id: int, reason: Optional[str]) -> Optional[_TrackTrace]:
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return _TrackTrace(guild_id, reason)
+
+    def finish(self, trace: Optional[_TrackTrace]) -> None:
+        if trace is None:
+            return
+        trace.mark("total_ms")
+        self.recent.append(trace.record)
+        if self.path:
+            self._pending.append(json.dumps(trace.record, ensure_ascii=False))
+            bot.loop.create_task(self.persist())
+
+    def slowest(self, n: int, key: str = "to_audio_ms") -> list[dict]:
+        return sorted(
+            (r for r in self.recent if r.get(key) is not None),
+            key=lambda r: r[key],
+            reverse=True,
+        )[:n]
+
+    def _write(self, lines: list[str]) -> None:
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(lines) + "\n")
+        except OSError as e:
+            print(f"Trace file write error ({self.path}): {e}")
+
+    async def persist(self) -> None:
+        """Append pending records off the loop; concurrent calls collapse into one write."""
+        if self._flushing:
+            return
+        self._flushing = True
+        try:
+            while self._pending:
+                lines, self._pending = self._pending, []
+                await asyncio.to_thread(self._write, lines)
+        finally:
+            self._flushing = False
+
+
+_tracer = _Tracer(TRACE_BUFFER_SIZE, TRACE_SAMPLE_RATE, TRACE_FILE)
+
+
+class TrackQueue:
+    """Upcoming tracks of a guild: a list of chunks indexed by a Fenwick tree of chunk sizes.
+
+    Keeps the deque operations the player uses (append/appendleft/popleft/extend,
+    queue[0], iteration) and adds positional access for /queue pages and
+    /remove, /move, /skipto: locating index i is O(log chunks), and an insert or
+    delete only shifts items within one chunk (at most 2 * CHUNK), so queues of
+    tens of thousands of tracks stay cheap to edit anywhere.
+
+    Every edit bumps `version` and records the first position it shifted, so
+    cached /queue pages before that position can be reused (see changed_from).
+    """
+
+    CHUNK = 256  # target chunk size; chunks split above 2 * CHUNK
+    CHANGE_LOG = 64  # edits remembered by changed_from; older versions count as "everything changed"
+
+    __slots__ = ("_chunks", "_tree", "_len", "version", "_changes", "on_change")
+
+    def __init__(self, items=()):
+        self._chunks: list[list] = []
+        self._tree: list[int] = [0]  # 1-based Fenwick tree over len(chunk)
+        self._len = 0
+        self.version = 0
+        self._changes: deque = deque(maxlen=self.CHANGE_LOG)  # (version, first position touched)
+        self.on_change = None  # optional callback after every edit
+        self.extend(items)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __bool__(self) -> bool:
+        return self._len > 0
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            yield from chunk
+
+    def __getitem__(self, index: int):
+        ci, off = self._locate(self._normalize(index))
+        return self._chunks[ci][off]
+
+    def __delitem__(self, index: int) -> None:
+        self.pop(index)
+
+    def _normalize(self, index: int) -> int:
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("queue index out of range")
+        return index
+
+    def _rebuild(self) -> None:
+        n = len(self._chunks)
+        tree = [0] * (n + 1)
+        for i, chunk in enumerate(self._chunks, start=1):
+            tree[i] += len(chunk)
+            parent = i + (i & -i)
+            if parent <= n:
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _add(self, ci: int, delta: int) -> None:
+        i = ci + 1
+        tree = self._tree
+        while i < len(tree):
+            tree[i] += delta
+            i += i & -i
+
+    def _touch(self, index: int) -> None:
+        self.version += 1
+        self._changes.append((self.version, index))
+        if self.on_change is not None:
+            self.on_change()
+
+    def changed_from(self, version: int) -> Optional[int]:
+        """First position edited since `version`, or None if nothing changed.
+
+        Items before that position are exactly what they were at `version`.
+        """
+        if version == self.version:
+            return None
+        if not self._changes or self._changes[0][0] > version + 1:
+            return 0  # edits older than the log: assume the whole queue moved
+        return min(index for v, index in self._changes if v > version)
+
+    def _locate(self, index: int) -> tuple[int, int]:
+        """(chunk index, offset in chunk) of item `index` (0 <= index < len)."""
+        tree = self._tree
+        n = len(tree) - 1
+        pos = 0
+        step = 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and tree[nxt] <= index:
+                pos = nxt
+                index -= tree[nxt]
+            step >>= 1
+        return pos, index
+
+    def append(self, item) -> None:
+        if self._chunks and len(self._chunks[-1]) < 2 * self.CHUNK:
+            self._chunks[-1].append(item)
+            self._add(len(self._chunks) - 1, 1)
+        else:
+            self._chunks.append([item])
+            self._rebuild()
+        self._len += 1
+        self._touch(self._len - 1)
+
+    def extend(self, items) -> None:
+        items = list(items)
+        if not items:
+            return
+        if self._chunks:
+            room = 2 * self.CHUNK - len(self._chunks[-1])
+            self._chunks[-1].extend(items[:room])
+            items = items[room:]
+        for i in range(0, len(items), self.CHUNK):
+            self._chunks.append(items[i:i + self.CHUNK])
+        first = self._len
+        self._len = sum(map(len, self._chunks))
+        self._rebuild()
+        self._touch(first)
+
+    def appendleft(self, item) -> None:
+        self.insert(0, item)
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError("pop from an empty queue")
+        return self.pop(0)
+
+    def insert(self, index: int, item) -> None:
+        """Insert before position `index` (clamped to the ends, like list.insert)."""
+        if index < 0:
+            index = max(0, index + self._len)
+        if index >= self._len:
+            self.append(item)
+            return
+        ci, off = self._locate(index)
+        chunk = self._chunks[ci]
+        chunk.insert(off, item)
+        self._len += 1
+        if len(chunk) > 2 * self.CHUNK:
+            self._chunks[ci:ci + 1] = [chunk[:self.CHUNK], chunk[self.CHUNK:]]
+            self._rebuild()
+        else:
+            self._add(ci, 1)
+        self._touch(index)
+
+    def pop(self, index: int = -1):
+        index = self._normalize(index)
+        ci, off = self._locate(index)
+        chunk = self._chunks[ci]
+        item = chunk.pop(off)
+        self._len -= 1
+        if not chunk:
+            del self._chunks[ci]
+            self._rebuild()
+        elif len(chunk) < self.CHUNK // 4 and ci + 1 < len(self._chunks) and len(self._chunks[ci + 1]) <= self.CHUNK:
+            # Merge small neighbours so repeated deletes can't leave thousands of tiny chunks.
+            chunk.extend(self._chunks.pop(ci + 1))
+            self._rebuild()
+        else:
+            self._add(ci, -1)
+        self._touch(index)
+        return item
+
+    def move(self, src: int, dst: int) -> None:
+        """Move the item at `src` so that it ends up at position `dst`."""
+        item = self.pop(src)
+        self.insert(dst, item)
+
+    def slice(self, start: int, stop: int) -> list:
+        """Items [start, stop) without walking the items before `start`."""
+        start, stop = max(0, start), min(stop, self._len)
+        if start >= stop:
+            return []
+        ci, off = self._locate(start)
+        out: list = []
+        while len(out) < stop - start:
+            out.extend(self._chunks[ci][off:off + (stop - start - len(out))])
+            ci, off = ci + 1, 0
+        return out
+
+    def delete_front(self, count: int) -> list:
+        """Remove and return the first `count` items."""
+        count = min(max(0, count), self._len)
+        removed = self.slice(0, count)
+        ci, off = self._locate(count) if count < self._len else (len(self._chunks), 0)
+        rest = self._chunks[ci:]
+        if rest and off:
+            rest[0] = rest[0][off:]
+        self._chunks = rest
+        self._len -= count
+        self._rebuild()
+        self._touch(0)
+        return removed
+
+    def shuffle(self) -> None:
+        items = list(self)
+        random.shuffle(items)
+        self.clear()
+        self.extend(items)
+
+    def clear(self) -> None:
+        self._chunks = []
+        self._tree = [0]
+        self._len = 0
+        self._touch(0)
+
+
+class _QueuePages:
+    """Rendered /queue page lines of one guild plus the queue messages showing them.
+
+    A page is reused while no queue edit reached its range and no title it
+    shows was filled in since (meta_version), so paging through a long queue
+    or refreshing an unchanged page does not re-format every line.
+    """
+
+    __slots__ = ("pages", "meta_version", "views", "refresh_handle")
+
+    hits = 0
+    misses = 0
+
+    def __init__(self):
+        # (page, page_size) -> (queue version, meta_version, lines)
+        self.pages: dict[tuple[int, int], tuple[int, int, list[str]]] = {}
+        self.meta_version = 0  # bumped when the prefetcher fills in titles of queued items
+        self.views: dict[int, "QueueView"] = {}  # message id -> open /queue message to auto-refresh
+        self.refresh_handle: Optional[asyncio.TimerHandle] = None
+
+    def get(self, queue: TrackQueue, page: int, page_size: int) -> Optional[list[str]]:
+        entry = self.pages.get((page, page_size))
+        if entry is not None:
+            version, meta_version, lines = entry
+            changed = queue.changed_from(version)
+            if meta_version == self.meta_version and (changed is None or changed >= (page + 1) * page_size):
+                _QueuePages.hits += 1
+                return lines
+            del self.pages[(page, page_size)]
+        _QueuePages.misses += 1
+        return None
+
+    def put(self, queue: TrackQueue, page: int, page_size: int, lines: list[str]) -> None:
+        self.pages[(page, page_size)] = (queue.version, self.meta_version, lines)
+
+    def cancel_refresh(self) -> None:
+        if self.refresh_handle is not None:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+
+
+class GuildPlayer:
+    """All playback state of one guild (queue, now playing, repeat, player task)."""
+
+    __slots__ = (
+        "guild_id",
+        "queue",
+        "history",
+        "repeat_mode",
+        "current",
+        "last_played",
+        "next_override",
+        "requeue_front",
+        "end_reason",
+        "prepared",
+        "lookahead_task",
+        "task",
+        "events",
+        "ctx",
+        "enqueue_lock",
+        "ended_at",
+        "queue_pages",
+        "now_playing_channel",
+        "playback",
+        "seek_to",
+        "start_at",
+        "resume_attempts",
+    )
+
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.queue = TrackQueue()  # upcoming QueueItems
+        self.history: deque = deque(maxlen=100)  # played QueueItems, newest at end
+        self.repeat_mode = "off"  # "off" | "one" | "all"
+        self.current = None  # QueueItem playing now (None when idle)
+        self.last_played = None  # last started QueueItem, for repeat-one
+        self.next_override = None  # QueueItem to play next (e.g., back)
+        self.requeue_front = None  # QueueItem to push front before next play (e.g., back)
+        self.end_reason: Optional[str] = None  # "skip" | "back", set when the player stops a track
+        self.prepared = None  # (QueueItem, primed audio source) ready for the next track
+        self.lookahead_task: Optional[asyncio.Task] = None  # resolving/pre-spawning the next track
+        self.task: Optional[asyncio.Task] = None  # _player_loop
+        self.events: Optional[asyncio.Queue] = None  # (kind, payload) player events
+        self.ctx = None  # latest command context (channel for messages, voice client)
+        self.enqueue_lock: Optional[asyncio.Lock] = None  # serializes playlist imports
+        self.ended_at: Optional[float] = None  # monotonic time the last track ended, for the gap metric
+        self.queue_pages = _QueuePages()  # cached /queue pages and open queue messages
+        self.queue.on_change = functools.partial(_schedule_queue_refresh, guild_id)
+        self.now_playing_channel: Optional[int] = None  # channel id holding the now-playing message
+        self.playback = None  # _ElapsedAudio of the current track (playback position)
+        self.seek_to: Optional[float] = None  # target of a pending /seek, in seconds
+        self.start_at: Optional[tuple] = None  # (QueueItem, seconds): start that item mid-track (restored snapshot)
+        self.resume_attempts = 0  # early-end resumes of the current track
+
+    def is_dormant(self) -> bool:
+        """Nothing worth keeping: no queue, no playback, default settings."""
+        return not self.queue and self.current is None and self.repeat_mode == "off"
+
+
 # Queue cho mỗi guild (server)
-queues = {}
-current_song = {}
-current_song_url = {}
-playlist_enqueue_locks = {}
-repeat_mode = {}  # guild_id -> "off" | "one" | "all"
-last_track_source = {}  # guild_id -> last played queue item (dict) for repeat-one/all
-end_reasons = {}  # guild_id -> "skip" | "stop"
-current_track_item = {}  # guild_id -> current playing queue item (dict)
-history = {}  # guild_id -> deque of played items (dict), newest at end
-next_override_item = {}  # guild_id -> queue item (dict) to play next (e.g., back)
-requeue_front_item = {}  # guild_id -> queue item (dict) to push front before next play (e.g., back)
+players: dict[int, GuildPlayer] = {}
+
+
+def _get_player(guild_id: int) -> GuildPlayer:
+    player = players.get(guild_id)
+    if player is None:
+        player = GuildPlayer(guild_id)
+        players[guild_id] = player
+    return player
+
 
 def _repeat_text(mode: str) -> str:
     return {"off": "Tắt", "one": "1 bài", "all": "Tất cả"}.get(mode, mode)
 
 
+def _now_playing_info(guild_id: int, default_title: str = "Unknown title") -> tuple[str, Optional[str]]:
+    player = players.get(guild_id)
+    cur = player.current if player is not None else None
+    if cur is None:
+        return default_title, None
+    return cur.title or default_title, cur.web_url
+
+
 def _build_now_playing_text(guild_id: int, title: str, web_url: Optional[str]) -> str:
     mode = _get_repeat_mode(guild_id)
     mode_text = _repeat_text(mode)
@@ -72,14 +668,220 @@ def _build_now_playing_text(guild_id: int, title: str, web_url: Optional[str]) -
     return f"Đang phát: **{title}**\nRepeat: **{mode_text}**"
 
 
-class NowPlayingView(discord.ui.View):
-    def __init__(self, guild_id: int):
-        super().__init__(timeout=600)
+class _ChannelOutbox:
+    """Bot-initiated messages of one text channel, coalesced to spare its rate limit.
+
+    Updates go to named slots ("now_playing"): each slot is one message that is
+    edited in place, and updates arriving within MESSAGE_DEBOUNCE_SECONDS of
+    each other collapse into a single edit. Notices (failure reports) are
+    batched into one message per flush.
+    """
+
+    def __init__(self, channel, guild_id: int):
+        self.channel = channel
         self.guild_id = guild_id
+        self.pending: dict[str, tuple[str, Optional[discord.ui.View], bool]] = {}  # slot -> (content, view, repost)
+        self.on_shown: dict[str, list] = {}  # slot -> callbacks waiting for its pending update
+        self.notices: list[str] = []
+        self.messages: dict[str, discord.Message] = {}  # slot -> message showing it
+        self.shown: dict[str, str] = {}  # slot -> content of that message
+        self.task: Optional[asyncio.Task] = None
+
+    def update(self, slot: str, content: str, view: Optional[discord.ui.View] = None, repost: bool = False,
+               on_shown=None) -> None:
+        """Show `content` in the slot's message; view=None keeps its current buttons.
+
+        With repost=True the message is sent again at the bottom of the channel
+        (and the old one deleted) if other messages were posted after it.
+        `on_shown()` runs once the message has been sent or edited (or the
+        update was dropped), after any later update it was merged into.
+        """
+        if on_shown is not None:
+            self.on_shown.setdefault(slot, []).append(on_shown)
+        previous = self.pending.get(slot)
+        if previous is not None:
+            _metrics.inc("bot_outbound_messages_total", result="merged")
+            view = view or previous[1]
+            repost = repost or previous[2]
+        self.pending[slot] = (content, view, repost)
+        self._kick()
+
+    def notice(self, text: str) -> None:
+        if self.notices:
+            _metrics.inc("bot_outbound_messages_total", result="merged")
+        self.notices.append(text)
+        self._kick()
+
+    def adopt(self, slot: str, message: discord.Message, replace: bool = False) -> None:
+        """Use an existing message for the slot (e.g. the one whose button was pressed).
+
+        With replace=True the slot's previous message is deleted in favour of it.
+        """
+        previous = self.messages.get(slot)
+        if previous is not None and replace and previous.id != message.id:
+            del self.messages[slot]
+            bot.loop.create_task(self._delete(previous))
+        if slot not in self.messages:
+            self.messages[slot] = message
+            self.shown[slot] = message.content
+
+    def clear(self, slot: str) -> None:
+        """Drop pending updates and delete the slot's message."""
+        self.pending.pop(slot, None)
+        self._shown(slot)
+        self.shown.pop(slot, None)
+        message = self.messages.pop(slot, None)
+        if message is not None:
+            bot.loop.create_task(self._delete(message))
+
+    def _shown(self, slot: str) -> None:
+        for callback in self.on_shown.pop(slot, ()):
+            try:
+                callback()
+            except Exception as e:
+                print(f"Outbox callback error: {e}")
+
+    def _kick(self) -> None:
+        if self.task is None or self.task.done():
+            self.task = bot.loop.create_task(self._flush())
+
+    async def _flush(self) -> None:
+        while self.pending or self.notices:
+            await asyncio.sleep(MESSAGE_DEBOUNCE_SECONDS)
+            notices, self.notices = self.notices, []
+            if notices:
+                await self._send_notices(notices)
+            pending, self.pending = self.pending, {}
+            for slot, (content, view, repost) in pending.items():
+                try:
+                    await self._apply(slot, content, view, repost)
+                finally:
+                    if slot not in self.pending:  # not superseded while sending
+                        self._shown(slot)
+
+    async def _send_notices(self, notices: list[str]) -> None:
+        batch: list[str] = []
+        for text in notices:
+            # Discord caps a message at 2000 characters
+            if batch and len("\n".join(batch)) + len(text) + 1 > 2000:
+                await self._send("\n".join(batch))
+                batch = []
+            batch.append(text[:2000])
+        if batch:
+            await self._send("\n".join(batch))
+
+    async def _send(self, content: str, view: Optional[discord.ui.View] = None) -> Optional[discord.Message]:
+        try:
+            if view is not None:
+                message = await self.channel.send(content, view=view)
+            else:
+                message = await self.channel.send(content)
+        except discord.HTTPException as e:
+            print(f"Send to channel {self.channel.id} failed: {e}")
+            _metrics.inc("bot_outbound_messages_total", result="failed")
+            return None
+        _metrics.inc("bot_outbound_messages_total", result="sent")
+        return message
+
+    async def _delete(self, message: discord.Message) -> None:
+        try:
+            await message.delete()
+        except discord.HTTPException:
+            return
+        _metrics.inc("bot_outbound_messages_total", result="deleted")
+
+    async def _apply(self, slot: str, content: str, view: Optional[discord.ui.View], repost: bool) -> None:
+        message = self.messages.get(slot)
+        if message is not None and repost and self.channel.last_message_id != message.id:
+            self.messages.pop(slot)
+            await self._delete(message)
+            message = None
+        if message is not None:
+            if view is None and self.shown.get(slot) == content:
+                _metrics.inc("bot_outbound_messages_total", result="suppressed")
+                return
+            try:
+                if view is not None:
+                    await message.edit(content=content, view=view)
+                else:
+                    await message.edit(content=content)
+            except discord.HTTPException as e:
+                # 404: deleted by someone; 401: a command reply whose interaction token
+                # expired (15 min). Either way post a fresh message below.
+                if e.status not in (401, 404):
+                    print(f"Edit in channel {self.channel.id} failed: {e}")
+                    _metrics.inc("bot_outbound_messages_total", result="failed")
+                    return
+                self.messages.pop(slot, None)
+                message = None
+            else:
+                _metrics.inc("bot_outbound_messages_total", result="edited")
+                self.shown[slot] = content
+                return
+        message = await self._send(content, view)
+        if message is None:
+            self.messages.pop(slot, None)
+            return
+        self.messages[slot] = message
+        self.shown[slot] = content
+
+
+# Outboxes by channel id; dropped when the bot leaves the channel's guild
+_outboxes: dict[int, _ChannelOutbox] = {}
+
+
+def _outbox(channel, guild_id: int) -> _ChannelOutbox:
+    outbox = _outboxes.get(channel.id)
+    if outbox is None:
+        outbox = _ChannelOutbox(channel, guild_id)
+        _outboxes[channel.id] = outbox
+    else:
+        outbox.channel = channel
+    return outbox
+
+
+def _drop_outboxes(guild_id: int) -> None:
+    for channel_id in [c for c, outbox in _outboxes.items() if outbox.guild_id == guild_id]:
+        del _outboxes[channel_id]
+
+
+def _now_playing_outbox(player: GuildPlayer) -> _ChannelOutbox:
+    """Outbox of the channel the guild's player reports to; keeps one now-playing message per guild."""
+    channel = player.ctx.channel
+    previous = player.now_playing_channel
+    if previous is not None and previous != channel.id and previous in _outboxes:
+        _outboxes[previous].clear("now_playing")
+    player.now_playing_channel = channel.id
+    return _outbox(channel, player.guild_id)
+
+
+class NowPlayingButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"np[:_](?P<action>back|pause|skip|repeat)",
+):
+    """Player control button. A dynamic item, so buttons on any now-playing message
+    (including ones sent before a restart) are dispatched by custom_id alone and
+    nothing is stored per message.
+    """
+
+    LABELS = {"back": "⏮", "pause": "⏸", "skip": "⏭", "repeat": "🔁"}
+
+    def __init__(self, action: str, paused: bool = False):
+        label = "▶" if action == "pause" and paused else self.LABELS[action]
+        if action == "repeat":
+            button = discord.ui.Button(emoji=label, style=discord.ButtonStyle.secondary, custom_id=f"np:{action}")
+        else:
+            button = discord.ui.Button(label=label, style=discord.ButtonStyle.secondary, custom_id=f"np:{action}")
+        super().__init__(button)
+        self.action = action
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(match["action"])
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
         guild = interaction.guild
-        if guild is None or guild.id != self.guild_id:
+        if guild is None:
             return False
         vc = guild.voice_client
         if vc is None or not vc.is_connected():
@@ -95,101 +897,91 @@ class NowPlayingView(discord.ui.View):
                 return False
         return True
 
-    # Button order: back, pause/resume, skip, repeat (icon-only)
-    @discord.ui.button(label="⏮", style=discord.ButtonStyle.secondary, custom_id="np_back")
-    async def back_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
-        guild = interaction.guild
-        if guild is None:
-            return
-        vc = guild.voice_client
-        if vc is None or not vc.is_connected():
-            return await interaction.response.send_message("Bot không ở trong voice channel.", ephemeral=True)
+    async def callback(self, interaction: discord.Interaction) -> None:
+        handler = getattr(self, f"_{self.action}")
+        await _timed(f"np_{self.action}")(handler)(interaction)
+
+    @staticmethod
+    async def _update(interaction: discord.Interaction, content: str, view: Optional[discord.ui.View] = None) -> None:
+        """Acknowledge the click and route the message edit through the channel outbox."""
+        await interaction.response.defer()
+        outbox = _outbox(interaction.channel, interaction.guild_id)
+        outbox.adopt("now_playing", interaction.message)
+        outbox.update("now_playing", content, view)
 
-        h = history.get(guild.id)
-        if h is None or len(h) < 2:
+    async def _back(self, interaction: discord.Interaction) -> None:
+        guild = interaction.guild
+        player = _get_player(guild.id)
+        if len(player.history) < 2:
             return await interaction.response.send_message("Chưa có bài trước đó để back.", ephemeral=True)
 
-        prev_item = h[-2]
-        cur_item = current_track_item.get(guild.id)
-        if isinstance(cur_item, dict):
-            requeue_front_item[guild.id] = cur_item
-        next_override_item[guild.id] = prev_item
+        prev_item = player.history[-2]
+        cur_item = player.current
+        if cur_item is not None:
+            player.requeue_front = cur_item
+        player.next_override = prev_item
 
-        end_reasons[guild.id] = "back"
-        if vc.is_playing() or vc.is_paused():
-            vc.stop()
+        _post_player_event(guild.id, "back", cur_item)
 
-        # Update UI immediately (next song message will be sent/edited by play_next)
-        await interaction.response.edit_message(
-            content="⏮ Đang quay lại bài trước...",
-            view=self,
-        )
+        # Usually merged with the next track's now-playing edit
+        await self._update(interaction, "⏮ Đang quay lại bài trước...")
 
-    @discord.ui.button(label="⏸", style=discord.ButtonStyle.secondary, custom_id="np_pause")
-    async def pause_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def _pause(self, interaction: discord.Interaction) -> None:
         guild = interaction.guild
-        if guild is None:
-            return
         vc = guild.voice_client
-        if vc is None or not vc.is_connected():
-            return await interaction.response.send_message("Bot không ở trong voice channel.", ephemeral=True)
-
+        player = players.get(guild.id)
         if vc.is_paused():
             vc.resume()
-            button.label = "⏸"
             status = "▶ Resume"
+            if player is not None and player.current is not None:
+                _cancel_lookahead(player)
+                player.lookahead_task = bot.loop.create_task(_lookahead_next_track(player, player.current))
         else:
             if not vc.is_playing():
                 return await interaction.response.send_message("Không có bài nào đang phát.", ephemeral=True)
             vc.pause()
-            button.label = "▶"
             status = "⏸ Pause"
+            if player is not None:
+                _cancel_lookahead(player)  # a pre-spawned next track would sit idle for the whole pause
 
         # keep content as now playing, only update view (and optionally a small status line)
-        title = current_song.get(guild.id) or "Unknown title"
-        url = current_song_url.get(guild.id)
-        await interaction.response.edit_message(
-            content=_build_now_playing_text(guild.id, title, url) + f"\nStatus: **{status}**",
-            view=self,
+        title, url = _now_playing_info(guild.id)
+        await self._update(
+            interaction,
+            _build_now_playing_text(guild.id, title, url) + f"\nStatus: **{status}**",
+            NowPlayingView(paused=vc.is_paused()),
         )
 
-    @discord.ui.button(label="⏭", style=discord.ButtonStyle.secondary, custom_id="np_skip")
-    async def skip_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def _skip(self, interaction: discord.Interaction) -> None:
         guild = interaction.guild
-        if guild is None:
-            return
         vc = guild.voice_client
-        if vc is None or not vc.is_connected():
-            return await interaction.response.send_message("Bot không ở trong voice channel.", ephemeral=True)
         if vc.is_playing() or vc.is_paused():
-            end_reasons[guild.id] = "skip"
-            vc.stop()
+            _post_player_event(guild.id, "skip", _get_player(guild.id).current)
             # update message content quickly
-            title = current_song.get(guild.id) or "Unknown"
-            url = current_song_url.get(guild.id)
-            await interaction.response.edit_message(
-                content=f"Đã skip: **{title}**\n{url}" if url else f"Đã skip: **{title}**",
-                view=self,
-            )
+            title, url = _now_playing_info(guild.id, "Unknown")
+            await self._update(interaction, f"Đã skip: **{title}**\n{url}" if url else f"Đã skip: **{title}**")
         else:
             await interaction.response.send_message("Không có bài nào đang phát.", ephemeral=True)
 
-    @discord.ui.button(emoji="🔁", style=discord.ButtonStyle.secondary, custom_id="np_repeat")
-    async def repeat_btn(self, interaction: discord.Interaction, button: discord.ui.Button):
+    async def _repeat(self, interaction: discord.Interaction) -> None:
         guild = interaction.guild
-        if guild is None:
-            return
-        cur = _get_repeat_mode(guild.id)
-        nxt = "one" if cur == "off" else ("all" if cur == "one" else "off")
-        repeat_mode[guild.id] = nxt
+        player = _get_player(guild.id)
+        cur = player.repeat_mode
+        player.repeat_mode = "one" if cur == "off" else ("all" if cur == "one" else "off")
 
         # Refresh message to reflect new repeat mode
-        title = current_song.get(guild.id) or "Unknown title"
-        url = current_song_url.get(guild.id)
-        await interaction.response.edit_message(
-            content=_build_now_playing_text(guild.id, title, url),
-            view=self,
-        )
+        title, url = _now_playing_info(guild.id)
+        await self._update(interaction, _build_now_playing_text(guild.id, title, url))
+
+
+class NowPlayingView(discord.ui.View):
+    """Buttons of a now-playing message (NowPlayingButton items only, nothing to time out)."""
+
+    def __init__(self, paused: bool = False):
+        super().__init__(timeout=None)
+        # Button order: back, pause/resume, skip, repeat (icon-only)
+        for action in ("back", "pause", "skip", "repeat"):
+            self.add_item(NowPlayingButton(action, paused))
 
 
 def _print_registered_slash_commands() -> None:
@@ -201,7 +993,8 @@ def _print_registered_slash_commands() -> None:
         print(f"Cannot list local app_commands: {e}")
 
 YDL_OPTS = {
-    "format": "bestaudio/best",
+    # Opus-in-webm first when passing Opus through, so FFmpeg can copy the codec
+    "format": "bestaudio[acodec=opus]/bestaudio/best" if AUDIO_MODE == "opus" else "bestaudio/best",
     "quiet": True,
     "no_warnings": True,
     "default_search": "ytsearch",
@@ -210,6 +1003,244 @@ YDL_OPTS = {
     "force_ipv4": True,
 }
 
+# Per-profile option overrides on top of YDL_OPTS.
+# - video: direct watch URL, never expand list=... into a playlist
+# - search: free-text / other URLs (may return a search/playlist result)
+# - flat: playlist/mix listing without resolving each entry
+YDL_PROFILES = {
+    "video": {"noplaylist": True},
+    "search": {},
+    "flat": {
+        "extract_flat": True,  # do not resolve each entry
+        "lazy_playlist": True,
+        "skip_download": True,
+        "noplaylist": False,
+        "ignoreerrors": True,
+        "playliststart": 1,
+    },
+}
+
+
+def _new_ydl(profile: str):
+    # Imported on first use (in an extractor thread/worker): yt_dlp is the
+    # heaviest import and isn't needed to connect to the gateway.
+    import yt_dlp
+
+    opts = dict(YDL_OPTS)
+    opts.update(YDL_PROFILES[profile])
+    return yt_dlp.YoutubeDL(opts)
+
+
+# Warm extractors owned by a process-pool worker (one per profile; each worker
+# process runs a single extraction at a time).
+_proc_extractors: dict = {}
+
+
+def _proc_run(profile: str, fn, *args):
+    """Entry point executed inside an extraction worker process."""
+    ydl = _proc_extractors.get(profile)
+    if ydl is None:
+        ydl = _new_ydl(profile)
+        _proc_extractors[profile] = ydl
+    return fn(ydl, *args)
+
+
+class _YDLPool:
+    """Bounded pool of warm yt_dlp.YoutubeDL instances, keyed by option profile.
+
+    Creating a YoutubeDL is expensive (extractor setup, cookies, player JS cache),
+    so instances are kept around and reused. Extraction runs on a dedicated
+    executor whose size is the concurrency cap, which also keeps yt-dlp work from
+    flooding the default thread pool used by asyncio.to_thread.
+
+    With backend="process", extraction runs in worker processes instead, so the
+    CPU-heavy parsing does not hold the bot process' GIL (gateway heartbeats,
+    voice packet sending). Workers only send back the small result the bot uses.
+    """
+
+    def __init__(self, max_workers: int, backend: str = "thread"):
+        self.max_workers = max(1, max_workers)
+        self.backend = backend
+        self._executor = None
+        self._idle: dict[str, list] = {}
+        self._lock = Lock()
+        self.in_use = 0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.backend == "process":
+                # spawn: never fork a process that already runs the gateway/voice threads
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ydl")
+        return self._executor
+
+    def _acquire(self, profile: str):
+        with self._lock:
+            idle = self._idle.get(profile)
+            if idle:
+                return idle.pop()
+        return _new_ydl(profile)
+
+    def _release(self, profile: str, ydl) -> None:
+        with self._lock:
+            self._idle.setdefault(profile, []).append(ydl)
+
+    async def run(self, profile: str, fn, *args):
+        """Run fn(ydl, *args) on the pool with a warm extractor for `profile`."""
+        loop = asyncio.get_running_loop()
+        executor = self._get_executor()
+        self.in_use += 1
+        started = time.perf_counter()
+        try:
+            if self.backend == "process":
+                try:
+                    return await loop.run_in_executor(executor, _proc_run, profile, fn, *args)
+                except BrokenProcessPool:
+                    # A worker crashed (OOM, killed); start a fresh pool for the next call.
+                    if self._executor is executor:
+                        self._executor = None
+                        executor.shutdown(wait=False, cancel_futures=True)
+                    raise RuntimeError("Extraction worker bị dừng đột ngột, thử lại sau.")
+
+            def _work():
+                ydl = self._acquire(profile)
+                try:
+                    return fn(ydl, *args)
+                finally:
+                    self._release(profile, ydl)
+
+            return await loop.run_in_executor(executor, _work)
+        finally:
+            self.in_use -= 1
+            _metrics.observe(
+                "bot_extract_seconds",
+                time.perf_counter() - started,
+                kind=_EXTRACT_KINDS.get(profile, profile),
+            )
+
+
+_EXTRACT_KINDS = {"video": "single", "search": "search", "flat": "playlist"}
+
+
+_ydl_pool = _YDLPool(EXTRACT_CONCURRENCY, backend=EXTRACT_BACKEND)
+
+
+def _ydl_extract_track(ydl, normalized: str) -> dict:
+    """Resolve one playable track with a pooled extractor (runs in a worker thread/process).
+
+    Returns only the few fields the bot uses, so results stay cheap to pickle.
+    """
+    info = ydl.extract_info(normalized, download=False)
+
+    # Playlist handling: pick first playable entry
+    if isinstance(info, dict) and "entries" in info:
+        entries = info.get("entries") or []
+        picked = None
+        for e in entries:
+            if not e:
+                continue
+            if isinstance(e, dict) and (e.get("url") or e.get("id")):
+                picked = e
+                break
+        if picked is None:
+            raise RuntimeError("Playlist không có entry playable.")
+        info = picked
+
+    # yt-dlp may return 'id' for some extractors; prefer direct 'url' when available
+    stream_url = info.get("url") or info.get("webpage_url")  # type: ignore[union-attr]
+    title = info.get("title") or "Unknown title"  # type: ignore[union-attr]
+    duration = info.get("duration")  # type: ignore[union-attr]
+    acodec = info.get("acodec")  # type: ignore[union-attr]
+    web_url = (
+        info.get("webpage_url")  # type: ignore[union-attr]
+        or info.get("original_url")  # type: ignore[union-attr]
+        or (normalized if normalized.startswith("http") else None)
+    )
+    if not stream_url:
+        raise RuntimeError("Không lấy được stream URL.")
+    return {
+        "stream_url": stream_url,
+        "title": title,
+        "web_url": web_url,
+        "duration": float(duration) if isinstance(duration, (int, float)) else None,
+        "acodec": acodec if isinstance(acodec, str) else None,
+    }
+
+
+def _flat_entry_to_watch(e) -> Optional[tuple[str, str]]:
+    """Turn a flat playlist entry into (watch_url, title), or None if unusable."""
+    if not e or not isinstance(e, dict):
+        return None
+    title = e.get("title") or "Unknown title"
+    vid = e.get("id")
+    url = e.get("url")
+
+    # For YouTube flat playlists, url/id are often the video id.
+    if url and isinstance(url, str) and url.startswith("http"):
+        return url, title
+    watch_id = None
+    if isinstance(url, str) and url:
+        watch_id = url
+    elif isinstance(vid, str) and vid:
+        watch_id = vid
+    if not watch_id:
+        return None
+    return f"https://www.youtube.com/watch?v={watch_id}", title
+
+
+def _ydl_extract_flat(ydl, q: str, max_items: int) -> list[tuple[str, str]]:
+    """List playlist entries with a pooled flat extractor (runs in a worker thread/process)."""
+    # The extractor is checked out exclusively, so per-call params are safe to set.
+    ydl.params["playlistend"] = max_items
+    info = ydl.extract_info(q, download=False)
+    if not isinstance(info, dict) or "entries" not in info:
+        return []
+
+    out: list[tuple[str, str]] = []
+    for e in (info.get("entries") or []):
+        entry = _flat_entry_to_watch(e)
+        if entry is None:
+            continue
+        out.append(entry)
+        if len(out) >= max_items:
+            break
+
+    return out
+
+
+def _ydl_iter_flat(ydl, q: str, max_items: int, emit, cancelled) -> int:
+    """Walk playlist entries lazily, calling emit((watch_url, title)) as pages arrive.
+
+    process=False keeps yt-dlp from materializing the whole playlist first, so
+    the first entries are available after the first page request. Runs in a
+    worker thread; stops early once `cancelled` (threading.Event) is set.
+    """
+    info = ydl.extract_info(q, download=False, process=False)
+    # Mix/watch URLs resolve to a redirect to the actual playlist
+    for _ in range(3):
+        if not isinstance(info, dict) or info.get("_type") not in ("url", "url_transparent"):
+            break
+        info = ydl.extract_info(info["url"], download=False, process=False, ie_key=info.get("ie_key"))
+    if not isinstance(info, dict) or "entries" not in info:
+        return 0
+
+    count = 0
+    for e in (info.get("entries") or []):
+        if cancelled.is_set():
+            break
+        entry = _flat_entry_to_watch(e)
+        if entry is None:
+            continue
+        emit(entry)
+        count += 1
+        if count >= max_items:
+            break
+    return count
+
 
 def _normalize_youtube_query(query: str) -> str:
     q = query.strip()
@@ -242,32 +1273,444 @@ def _normalize_youtube_query(query: str) -> str:
     return q
 
 
+# Signed YouTube stream URLs carry their own expiry; URLs without one (other
+# extractors) are trusted for a conservative fixed window.
+STREAM_URL_FALLBACK_TTL = 8 * 60
+STREAM_URL_EXPIRY_MARGIN = 60
+
+
+def _stream_url_expiry(url: Optional[str]) -> Optional[float]:
+    """Return the epoch seconds encoded in a signed stream URL's `expire`, if any."""
+    if not url:
+        return None
+    try:
+        parsed = urlparse(url)
+    except Exception:
+        return None
+    raw = (parse_qs(parsed.query).get("expire") or [None])[0]
+    if raw is None and "/expire/" in parsed.path:
+        # Manifest-style URLs put params in the path: .../expire/1700000000/...
+        parts = parsed.path.split("/")
+        i = parts.index("expire")
+        raw = parts[i + 1] if i + 1 < len(parts) else None
+    try:
+        return float(raw) if raw else None
+    except ValueError:
+        return None
+
+
+def _stream_url_is_fresh(
+    stream_url: Optional[str],
+    extracted_at: Optional[float],
+    expires_at: Optional[float],
+    min_remaining: float = 0,
+) -> bool:
+    """True if the URL stays valid for at least `min_remaining` more seconds (plus margin)."""
+    if not stream_url:
+        return False
+    now = time.time()
+    if isinstance(expires_at, (int, float)):
+        return expires_at - now > STREAM_URL_EXPIRY_MARGIN + min_remaining
+    return isinstance(extracted_at, (int, float)) and (now - extracted_at) <= STREAM_URL_FALLBACK_TTL
+
+
+def _queue_item_stream_is_fresh(item: "QueueItem") -> bool:
+    """Whether the item's cached stream URL can be played as-is.
+
+    The URL must outlive the whole track: FFmpeg re-requests it on reconnect, and
+    a signed URL that expires mid-song would cut playback off. Repeat loops reuse
+    the same item, so a URL valid for hours is played many times without
+    re-extraction.
+    """
+    duration = item.duration
+    return _stream_url_is_fresh(
+        item.stream_url,
+        item.extracted_at,
+        item.expires_at,
+        min_remaining=duration if isinstance(duration, (int, float)) else 0,
+    )
+
+
+def _apply_resolved_stream(item: "QueueItem", info: dict) -> None:
+    item.stream_url = info["stream_url"]
+    item.extracted_at = info["extracted_at"]
+    item.expires_at = info["expires_at"]
+    item.acodec = info.get("acodec")
+    if info.get("duration"):
+        item.duration = info["duration"]
+
+
+class _ResolutionCache:
+    """Process-wide LRU of query -> resolved track, shared by all guilds.
+
+    Keys are _normalize_youtube_query() outputs. Metadata (title/web_url) is kept
+    until evicted; the stream URL is only served while it is still valid. With a
+    db_path, entries are persisted to SQLite so restarts don't start cold; the
+    database is opened by open(), not on construction, so that extraction
+    worker processes importing this module don't touch it.
+    """
+
+    def __init__(self, max_entries: int, db_path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = Lock()
+        self._pending: dict[str, dict] = {}
+        self._flushing = False
+        self.hits = 0
+        self.stale = 0  # metadata known, stream URL had to be re-resolved
+        self.misses = 0
+        self._db_path = db_path
+        self._db: Optional[sqlite3.Connection] = None
+
+    def open(self) -> None:
+        """Load persisted entries (blocking, once; call from the main process)."""
+        if not self._db_path or self._db is not None:
+            return
+        try:
+            self._open_db(self._db_path)
+        except Exception as e:
+            print(f"Resolve cache DB disabled ({self._db_path}): {e}")
+            self._db = None
+        self._db_path = None
+
+    def _open_db(self, db_path: str) -> None:
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS resolutions ("
+            "key TEXT PRIMARY KEY, title TEXT, web_url TEXT, stream_url TEXT, "
+            "extracted_at REAL, expires_at REAL, used_at REAL, duration REAL, acodec TEXT)"
+        )
+        cols = {row[1] for row in db.execute("PRAGMA table_info(resolutions)")}
+        for name, sql_type in (("duration", "REAL"), ("acodec", "TEXT")):
+            if name not in cols:
+                db.execute(f"ALTER TABLE resolutions ADD COLUMN {name} {sql_type}")
+        rows = db.execute(
+            "SELECT key, title, web_url, stream_url, extracted_at, expires_at, duration, acodec FROM resolutions "
+            "ORDER BY used_at ASC, rowid ASC LIMIT -1 OFFSET MAX(0, (SELECT COUNT(*) FROM resolutions) - ?)",
+            (self.max_entries,),
+        ).fetchall()
+        for key, title, web_url, stream_url, extracted_at, expires_at, duration, acodec in rows:
+            self._entries[key] = {
+                "title": title,
+                "web_url": web_url,
+                "stream_url": stream_url,
+                "extracted_at": extracted_at,
+                "expires_at": expires_at,
+                "duration": duration,
+                "acodec": acodec,
+            }
+        self._db = db
+        print(f"Resolve cache: loaded {len(rows)} entries from {db_path}")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[dict]:
+        """Return a copy of the entry (stream URL may be stale) and mark it recently used."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return dict(entry)
+
+    def put(self, key: str, info: dict) -> None:
+        entry = {
+            "title": info.get("title"),
+            "web_url": info.get("web_url"),
+            "stream_url": info.get("stream_url"),
+            "extracted_at": info.get("extracted_at"),
+            "expires_at": info.get("expires_at"),
+            "duration": info.get("duration"),
+            "acodec": info.get("acodec"),
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            if self._db is not None:
+                self._pending[key] = entry
+
+    def drop_stream(self, key: str, stream_url: str) -> None:
+        """Forget a stream URL that turned out dead (if still cached), keeping the metadata."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["stream_url"] != stream_url:
+                return
+            entry["stream_url"] = None
+            entry["expires_at"] = None
+            if self._db is not None:
+                self._pending[key] = entry
+
+    def flush(self) -> None:
+        """Write pending entries to SQLite (blocking; call off the event loop)."""
+        with self._lock:
+            if self._db is None or not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+        now = time.time()
+        rows = [
+            (k, e["title"], e["web_url"], e["stream_url"], e["extracted_at"], e["expires_at"], now, e["duration"], e["acodec"])
+            for k, e in pending.items()
+        ]
+        try:
+            with self._db:
+                self._db.executemany("INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self._db.execute(
+                    "DELETE FROM resolutions WHERE key NOT IN "
+                    "(SELECT key FROM resolutions ORDER BY used_at DESC, rowid DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+        except Exception as e:
+            print(f"Resolve cache flush error: {e}")
+
+    async def persist(self) -> None:
+        """Flush in the background; concurrent calls collapse into one write."""
+        if self._db is None or self._flushing:
+            return
+        self._flushing = True
+        try:
+            await asyncio.to_thread(self.flush)
+        finally:
+            self._flushing = False
+
+
+_resolution_cache = _ResolutionCache(RESOLVE_CACHE_SIZE, RESOLVE_CACHE_DB)
+
+
+_SEARCH_KEY_JUNK = re.compile(r"[^\w\s]+")
+
+
+def _search_key(text: str) -> str:
+    """Canonical form of free-text search: case/width/punctuation/spacing-insensitive."""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return " ".join(_SEARCH_KEY_JUNK.sub(" ", text).split())
+
+
+def _fold_diacritics(key: str) -> str:
+    """"nơi này có anh" -> "noi nay co anh", for matching what people type without accents."""
+    decomposed = unicodedata.normalize("NFKD", key.replace("đ", "d"))
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def _youtube_video_id(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
+    normalized = _normalize_youtube_query(url)
+    if normalized.startswith("https://youtu.be/"):
+        return normalized[len("https://youtu.be/"):] or None
+    if normalized.startswith("https://www.youtube.com/watch?"):
+        return (parse_qs(urlparse(normalized).query).get("v") or [None])[0]
+    return None
+
+
+class _SearchIndex:
+    """Local index of search text -> YouTube video, so repeated free-text /play skips ytsearch.
+
+    Entries keyed by a query someone actually searched map to the video yt-dlp
+    picked for it and are used to resolve that query. Entries keyed by a video
+    title (from resolutions and playlist imports) only feed /play autocomplete.
+    Bounded LRU, shared by all guilds for resolution. Autocomplete only shows a
+    guild the keys it searched or played itself (remember()), so one server's
+    searches never surface in another's suggestions; a sorted copy of each
+    guild's keys serves prefix completion.
+    """
+
+    def __init__(self, max_entries: int, recent_per_guild: int):
+        self.max_entries = max(1, max_entries)
+        self.recent_per_guild = max(1, recent_per_guild)
+        self._entries: "OrderedDict[str, dict]" = OrderedDict()
+        self._recent: dict[int, "OrderedDict[str, None]"] = {}  # guild id -> its keys, least recent first
+        self._recent_sorted: dict[int, list[str]] = {}  # guild id -> the same keys, sorted
+        self.lookups = 0
+        self.hits = 0
+        self.completions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def add(self, text: str, video_id: str, title: Optional[str], duration: Optional[float], searched: bool) -> None:
+        key = _search_key(text)
+        if not key or not video_id:
+            return
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = self._entries[key] = {
+                "video_id": video_id,
+                "title": text,
+                "duration": None,
+                "searched": searched,
+                "words": _fold_diacritics(key).split(),
+            }
+        elif entry["searched"] and not searched:
+            # A title match never overrides what a real search picked for this text.
+            self._entries.move_to_end(key)
+            return
+        if entry["video_id"] != video_id:
+            entry["duration"] = None
+        entry["video_id"] = video_id
+        entry["searched"] = searched
+        if title:
+            entry["title"] = title
+        if duration is not None:
+            entry["duration"] = duration
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def add_title(self, title: Optional[str], web_url: Optional[str], duration: Optional[float] = None) -> None:
+        video_id = _youtube_video_id(web_url)
+        if video_id and title and title != "Unknown title":
+            self.add(title, video_id, title, duration, searched=False)
+
+    def add_resolution(self, query: str, info: dict) -> None:
+        """Index a finished resolution: the query (if free text) and the video's title."""
+        video_id = _youtube_video_id(info.get("web_url"))
+        if not video_id:
+            return
+        if not query.startswith("http"):
+            self.add(query, video_id, info.get("title"), info.get("duration"), searched=True)
+        self.add_title(info.get("title"), info.get("web_url"), info.get("duration"))
+
+    def remember(self, guild_id: int, text: Optional[str]) -> None:
+        """Offer `text` (a search or a played title) in this guild's suggestions."""
+        key = _search_key(text) if text else ""
+        if not key:
+            return
+        recent = self._recent.setdefault(guild_id, OrderedDict())
+        keys = self._recent_sorted.setdefault(guild_id, [])
+        if key in recent:
+            recent.move_to_end(key)
+            return
+        recent[key] = None
+        bisect.insort(keys, key)
+        while len(recent) > self.recent_per_guild:
+            old, _ = recent.popitem(last=False)
+            del keys[bisect.bisect_left(keys, old)]
+
+    def forget_guild(self, guild_id: int) -> None:
+        self._recent.pop(guild_id, None)
+        self._recent_sorted.pop(guild_id, None)
+
+    def warm(self, cache: _ResolutionCache) -> None:
+        for query, info in list(cache._entries.items()):
+            self.add_resolution(query, info)
+
+    def peek(self, query: str) -> Optional[dict]:
+        """Exact match on a previously searched query; never guesses. Doesn't count in stats."""
+        entry = self._entries.get(_search_key(query))
+        return entry if entry is not None and entry["searched"] else None
+
+    def lookup(self, query: str) -> Optional[dict]:
+        self.lookups += 1
+        entry = self.peek(query)
+        if entry is not None:
+            self._entries.move_to_end(_search_key(query))
+            self.hits += 1
+        return entry
+
+    def complete(self, text: str, guild_id: int, limit: int = 25) -> list[tuple[str, dict]]:
+        """The guild's (key, entry) suggestions: prefix matches first, then any-order word-prefix matches."""
+        self.completions += 1
+        key = _search_key(text)
+        recent = self._recent.get(guild_id)
+        if not recent:
+            return []
+        keys = self._recent_sorted[guild_id]
+        out: list[tuple[str, dict]] = []
+        seen: set[str] = set()
+
+        def _take(k: str) -> bool:
+            entry = self._entries.get(k)  # None: evicted from the shared index since
+            if entry is not None and entry["video_id"] not in seen:
+                seen.add(entry["video_id"])
+                out.append((k, entry))
+            return len(out) >= limit
+
+        if not key:
+            for k in reversed(recent):
+                if _take(k):
+                    break
+            return out
+
+        i = bisect.bisect_left(keys, key)
+        while i < len(keys) and keys[i].startswith(key):
+            if _take(keys[i]):
+                return out
+            i += 1
+
+        # "hip lofi" / "noi nay" should still find "lofi hip hop" / "nơi này có anh"
+        tokens = _fold_diacritics(key).split()
+        for k in reversed(recent):
+            entry = self._entries.get(k)
+            if entry is None:
+                continue
+            words = entry["words"]
+            if all(any(w.startswith(t) for w in words) for t in tokens) and _take(k):
+                break
+        return out
+
+
+_search_index = _SearchIndex(SEARCH_INDEX_SIZE, SEARCH_RECENT_PER_GUILD)
+
+
+class QueueItem:
+    """One queued track; metadata and stream fields are filled lazily by resolution."""
+
+    __slots__ = (
+        "source",
+        "title",
+        "web_url",
+        "stream_url",
+        "extracted_at",
+        "expires_at",
+        "duration",
+        "acodec",
+        "copy_failed",
+        "requester_id",
+    )
+
+    def __init__(
+        self,
+        source: str,
+        requester_id: int,
+        title: Optional[str] = None,
+        web_url: Optional[str] = None,
+    ):
+        self.source = source  # original query / URL used to resolve
+        self.title = title
+        self.web_url = web_url
+        self.stream_url: Optional[str] = None  # resolved direct audio URL (may expire)
+        self.extracted_at: Optional[float] = None  # epoch seconds when stream_url was resolved
+        self.expires_at: Optional[float] = None  # signed `expire=` of stream_url, if it has one
+        self.duration: Optional[float] = None  # seconds, when known
+        self.acodec: Optional[str] = None  # audio codec of stream_url (e.g. "opus"), when known
+        self.copy_failed = False  # Opus codec copy broke off mid-track: decode to PCM from now on
+        self.requester_id = requester_id
+
+
 def _make_queue_item(
     source: str,
     requester_id: int,
     title: Optional[str] = None,
     web_url: Optional[str] = None,
-) -> dict:
+) -> QueueItem:
     # title/web_url may be filled later by background resolution
-    return {
-        "source": source,  # original query / URL used to resolve
-        "title": title,
-        "web_url": web_url,
-        "stream_url": None,  # resolved direct audio URL (may expire)
-        "extracted_at": None,  # epoch seconds when stream_url was resolved
-        "requester_id": requester_id,
-    }
+    return QueueItem(source, requester_id, title=title, web_url=web_url)
 
 
-def _queue_item_display(item: dict) -> tuple[str, str, str]:
-    title = item.get("title") or "Đang xử lý..."
-    link = item.get("web_url") or (
-        item.get("source")
-        if isinstance(item.get("source"), str) and item.get("source", "").startswith("http")
-        else "-"
-    )
-    requester_id = item.get("requester_id")
-    requester = f"<@{requester_id}>" if isinstance(requester_id, int) and requester_id else "@unknown"
+def _queue_item_display(item: QueueItem) -> tuple[str, str, str]:
+    title = item.title or "Đang xử lý..."
+    link = item.web_url or (item.source if item.source.startswith("http") else "-")
+    requester_id = item.requester_id
+    requester = f"<@{requester_id}>" if requester_id else "@unknown"
     return title, link, requester
 
 
@@ -294,80 +1737,203 @@ def _is_youtube_playlist_or_mix(url: str) -> bool:
 
 async def _extract_playlist_entries(query: str, max_items: int) -> list[tuple[str, str]]:
     """Extract playlist/mix entries quickly (flat), returning watch URLs + titles."""
+    q = query.strip()
+    if q.startswith("<") and q.endswith(">"):
+        q = q[1:-1].strip()
+    return await _ydl_pool.run("flat", _ydl_extract_flat, q, max_items)
 
-    def _work() -> list[tuple[str, str]]:
-        q = query.strip()
-        if q.startswith("<") and q.endswith(">"):
-            q = q[1:-1].strip()
-
-        opts = dict(YDL_OPTS)
-        # Flat + lazy playlist extraction: fastest way to just get IDs.
-        opts.update(
-            {
-                "extract_flat": True,  # do not resolve each entry
-                "lazy_playlist": True,
-                "skip_download": True,
-                "noplaylist": False,
-                "ignoreerrors": True,
-                "playliststart": 1,
-                "playlistend": max_items,
-            }
-        )
-
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(q, download=False)
-            if not isinstance(info, dict) or "entries" not in info:
-                return []
-
-            out: list[tuple[str, str]] = []
-            for e in (info.get("entries") or []):
-                if not e or not isinstance(e, dict):
-                    continue
-                title = e.get("title") or "Unknown title"
-                vid = e.get("id")
-                url = e.get("url")
 
-                # For YouTube flat playlists, url/id are often the video id.
-                if url and isinstance(url, str) and url.startswith("http"):
-                    watch_url = url
-                else:
-                    watch_id = None
-                    if isinstance(url, str) and url:
-                        watch_id = url
-                    elif isinstance(vid, str) and vid:
-                        watch_id = vid
-                    if not watch_id:
-                        continue
-                    watch_url = f"https://www.youtube.com/watch?v={watch_id}"
-
-                out.append((watch_url, title))
-                if len(out) >= max_items:
-                    break
+async def _iter_playlist_entries(query: str, max_items: int):
+    """Async generator of (watch_url, title) playlist entries, yielded as they are extracted."""
+    q = query.strip()
+    if q.startswith("<") and q.endswith(">"):
+        q = q[1:-1].strip()
 
-            return out
+    if _ydl_pool.backend == "process":
+        # Entries can't be streamed back from a worker process; fall back to one batch.
+        for entry in await _extract_playlist_entries(q, max_items):
+            yield entry
+        return
 
-    return await asyncio.to_thread(_work)
+    loop = asyncio.get_running_loop()
+    entries: asyncio.Queue = asyncio.Queue()
+    cancelled = threading.Event()
+    done = object()
 
+    def _emit(entry: tuple[str, str]) -> None:
+        loop.call_soon_threadsafe(entries.put_nowait, entry)
 
-async def _resolve_queue_item_metadata(item: dict) -> None:
-    """Fill title/web_url for a queue item in the background (best-effort)."""
+    work = asyncio.ensure_future(_ydl_pool.run("flat", _ydl_iter_flat, q, max_items, _emit, cancelled))
+    # Entries emitted before completion are queued ahead of the sentinel.
+    work.add_done_callback(lambda _: entries.put_nowait(done))
     try:
-        stream_url, title, web_url = await _extract_yt_info_with_web(item.get("source", ""))
-    except Exception:
-        return
-    if not item.get("title"):
-        item["title"] = title
-    if not item.get("web_url"):
-        item["web_url"] = web_url
+        while True:
+            entry = await entries.get()
+            if entry is done:
+                break
+            yield entry
+        work.result()  # re-raise extraction errors
+    finally:
+        cancelled.set()
+        if not work.done():
+            # Consumer stopped early: wait for the extraction to notice, so its
+            # pool slot is free again and its outcome isn't left unretrieved
+            try:
+                await work
+            except Exception:
+                pass
+        elif not work.cancelled():
+            work.exception()
+
+
+def _apply_item_metadata(item: QueueItem, info: dict) -> None:
+    if not item.title:
+        item.title = info["title"]
+    if not item.web_url:
+        item.web_url = info["web_url"]
     # Cache stream url for faster immediate playback (best-effort; may expire)
-    if not item.get("stream_url"):
-        item["stream_url"] = stream_url
-        item["extracted_at"] = time.time()
+    if not _queue_item_stream_is_fresh(item):
+        _apply_resolved_stream(item, info)
+
+
+# Prefetch priorities (lower runs first)
+PREFETCH_NEXT = 0  # next track to play
+PREFETCH_VISIBLE = 1  # on a /queue page someone is looking at
+PREFETCH_BACKGROUND = 2  # everything else
+
+
+class _PrefetchJob:
+    __slots__ = ("key", "guild_id", "items", "priority", "cancelled")
+
+    def __init__(self, key: str, guild_id: int, priority: int):
+        self.key = key
+        self.guild_id = guild_id
+        self.items: list[tuple[int, QueueItem]] = []  # (guild_id, item) waiting for this key
+        self.priority = priority
+        self.cancelled = False
+
+
+class _MetadataPrefetcher:
+    """Bounded, prioritized background resolution of queue item metadata.
+
+    Jobs are deduplicated by normalized source (items from any guild asking for
+    the same track share one extraction), run by a fixed number of workers, and
+    at most `per_guild` jobs per guild run at once so one large enqueue can't
+    starve other guilds. Priorities can be raised later (lazy heap re-push).
+    """
+
+    def __init__(self, concurrency: int, per_guild: int):
+        self.concurrency = max(1, concurrency)
+        self.per_guild = max(1, per_guild)
+        self._heap: list = []
+        self._seq = 0
+        self._jobs: dict[str, _PrefetchJob] = {}  # pending or running, by key
+        self._running: dict[int, int] = {}  # guild_id -> running job count
+        self._wakeup: Optional[asyncio.Event] = None
+        self._workers: list[asyncio.Task] = []
+
+    def _push(self, job: _PrefetchJob) -> None:
+        self._seq += 1
+        heapq.heappush(self._heap, (job.priority, self._seq, job))
+        self._wakeup.set()
+
+    def schedule(self, guild_id: int, item: QueueItem, priority: int = PREFETCH_BACKGROUND) -> None:
+        # Known metadata shows up in /queue right away, even if the stream URL is stale.
+        key = _normalize_youtube_query(item.source)
+        cached = _resolution_cache.get(key)
+        if cached is not None:
+            if not item.title:
+                item.title = cached["title"]
+            if not item.web_url:
+                item.web_url = cached["web_url"]
+
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._workers = [bot.loop.create_task(self._worker()) for _ in range(self.concurrency)]
+
+        job = self._jobs.get(key)
+        if job is None:
+            job = _PrefetchJob(key, guild_id, priority)
+            self._jobs[key] = job
+            job.items.append((guild_id, item))
+            self._push(job)
+            return
+        if all(it is not item for _, it in job.items):
+            job.items.append((guild_id, item))
+        job.cancelled = False
+        if priority < job.priority:
+            job.priority = priority
+            self._push(job)  # the old heap entry is skipped when popped
+
+    def discard(self, item: QueueItem) -> None:
+        """Forget an item removed from its queue (its job is dropped if nobody else waits)."""
+        job = self._jobs.get(_normalize_youtube_query(item.source))
+        if job is None:
+            return
+        job.items = [(g, it) for g, it in job.items if it is not item]
+        if not job.items:
+            job.cancelled = True
+
+    def cancel_guild(self, guild_id: int) -> None:
+        for job in self._jobs.values():
+            job.items = [(g, it) for g, it in job.items if g != guild_id]
+            if not job.items:
+                job.cancelled = True
+
+    def _pop_runnable(self) -> Optional[_PrefetchJob]:
+        deferred = []
+        picked = None
+        while self._heap:
+            priority, seq, job = heapq.heappop(self._heap)
+            if priority != job.priority:
+                continue  # stale entry: re-prioritized or already running
+            if job.cancelled:
+                if self._jobs.get(job.key) is job:
+                    del self._jobs[job.key]
+                continue
+            if self._running.get(job.guild_id, 0) >= self.per_guild:
+                deferred.append((priority, seq, job))
+                continue
+            picked = job
+            break
+        for entry in deferred:
+            heapq.heappush(self._heap, entry)
+        return picked
+
+    async def _worker(self) -> None:
+        while True:
+            job = self._pop_runnable()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            job.priority = -1  # running: remaining heap entries for it are stale
+            self._running[job.guild_id] = self._running.get(job.guild_id, 0) + 1
+            try:
+                info = await _resolve_track(job.key)
+            except Exception:
+                info = None
+            finally:
+                self._running[job.guild_id] -= 1
+                if not self._running[job.guild_id]:
+                    del self._running[job.guild_id]
+                self._jobs.pop(job.key, None)
+                self._wakeup.set()  # a per-guild slot may have freed up
+            if info is not None and not job.cancelled:
+                for guild_id, item in job.items:
+                    _apply_item_metadata(item, info)
+                    player = players.get(guild_id)
+                    if player is not None:
+                        player.queue_pages.meta_version += 1
+                        _schedule_queue_refresh(guild_id)
+
+
+_prefetcher = _MetadataPrefetcher(PREFETCH_CONCURRENCY, PREFETCH_PER_GUILD)
 
 
 def _build_queue_embed(guild_id: int, page: int, page_size: int) -> discord.Embed:
-    dq = queues.get(guild_id, deque())
-    total = len(dq)
+    player = players.get(guild_id)
+    total = len(player.queue) if player is not None else 0
     if total == 0:
         return discord.Embed(title="Queue", description="Queue đang trống.")
 
@@ -376,18 +1942,20 @@ def _build_queue_embed(guild_id: int, page: int, page_size: int) -> discord.Embe
     start = page * page_size
     end = min(start + page_size, total)
 
-    lines = []
-    for i, item in enumerate(islice(dq, start, end), start=start + 1):
-        if isinstance(item, dict):
+    lines = player.queue_pages.get(player.queue, page, page_size)
+    if lines is None:
+        lines = []
+        for i, item in enumerate(player.queue.slice(start, end), start=start + 1):
+            if not item.title:
+                # Someone is looking at this page: resolve its items ahead of the rest
+                _prefetcher.schedule(guild_id, item, PREFETCH_VISIBLE)
             title, link, requester = _queue_item_display(item)
             lines.append(f"**{i}** - {title} - {link} - {requester}")
-        else:
-            # Backward compatible if old queue items still exist
-            lines.append(f"**{i}** - {item} - - - @unknown")
+        player.queue_pages.put(player.queue, page, page_size, lines)
 
-    cur = current_song.get(guild_id)
-    cur_url = current_song_url.get(guild_id)
-    mode = _get_repeat_mode(guild_id)
+    cur = player.current.title if player.current is not None else None
+    cur_url = player.current.web_url if player.current is not None else None
+    mode = player.repeat_mode
     mode_text = {"off": "Tắt", "one": "1 bài", "all": "Tất cả"}.get(mode, mode)
 
     desc = "\n".join(lines)
@@ -405,17 +1973,78 @@ def _build_queue_embed(guild_id: int, page: int, page_size: int) -> discord.Embe
     return embed
 
 
-class QueueView(discord.ui.View):
-    def __init__(self, guild_id: int, author_id: int, page_size: int):
-        super().__init__(timeout=180)
-        self.guild_id = guild_id
+def _schedule_queue_refresh(guild_id: int) -> None:
+    """Re-render the guild's open /queue messages soon; repeated edits share one refresh."""
+    player = players.get(guild_id)
+    if player is None or QUEUE_REFRESH_SECONDS <= 0:
+        return
+    pages = player.queue_pages
+    if not pages.views or pages.refresh_handle is not None:
+        return
+    loop = asyncio.get_running_loop()
+    pages.refresh_handle = loop.call_later(
+        QUEUE_REFRESH_SECONDS, lambda: loop.create_task(_refresh_queue_views(guild_id))
+    )
+
+
+async def _refresh_queue_views(guild_id: int) -> None:
+    player = players.get(guild_id)
+    if player is None:
+        return
+    pages = player.queue_pages
+    pages.refresh_handle = None
+    now = time.monotonic()
+    for message_id, view in list(pages.views.items()):
+        if now > view.watch_until:
+            del pages.views[message_id]
+            continue
+        view._sync_buttons()
+        embed = _build_queue_embed(guild_id, view.page, view.page_size)
+        rendered = embed.to_dict()
+        if rendered == view.rendered:
+            continue  # edits elsewhere in the queue didn't change this page
+        try:
+            await view.message.edit(embed=embed, view=view)
+        except discord.HTTPException:
+            pages.views.pop(message_id, None)  # message deleted or no longer editable
+            continue
+        view.rendered = rendered
+
+
+class QueueButton(
+    discord.ui.DynamicItem[discord.ui.Button],
+    template=r"queue:(?P<action>prev|next|refresh):(?P<author_id>\d+):(?P<page>\d+)",
+):
+    """/queue pager button. Its custom_id carries the caller and page, so buttons
+    on queue messages keep working after a restart without any stored view.
+    """
+
+    STYLES = {
+        "prev": ("◀", discord.ButtonStyle.secondary),
+        "next": ("▶", discord.ButtonStyle.secondary),
+        "refresh": ("🔄 Refresh", discord.ButtonStyle.primary),
+    }
+
+    def __init__(self, action: str, author_id: int, page: int, disabled: bool = False):
+        label, style = self.STYLES[action]
+        super().__init__(
+            discord.ui.Button(
+                label=label,
+                style=style,
+                custom_id=f"queue:{action}:{author_id}:{page}",
+                disabled=disabled,
+            )
+        )
+        self.action = action
         self.author_id = author_id
-        self.page_size = page_size
-        self.page = 0
-        self._sync_buttons()
+        self.page = page
+
+    @classmethod
+    async def from_custom_id(cls, interaction: discord.Interaction, item: discord.ui.Button, match: re.Match[str]):
+        return cls(match["action"], int(match["author_id"]), int(match["page"]))
 
     async def interaction_check(self, interaction: discord.Interaction) -> bool:
-        if interaction.guild is None or interaction.guild.id != self.guild_id:
+        if interaction.guild is None:
             return False
         if interaction.user.id != self.author_id:
             await interaction.response.send_message(
@@ -425,124 +2054,189 @@ class QueueView(discord.ui.View):
             return False
         return True
 
-    def _sync_buttons(self) -> None:
-        total = len(queues.get(self.guild_id, deque()))
-        max_page = max(1, (total + self.page_size - 1) // self.page_size)
-        self.page = max(0, min(self.page, max_page - 1))
-        for child in self.children:
-            if not isinstance(child, discord.ui.Button):
-                continue
-            if child.custom_id == "queue_prev":
-                child.disabled = (self.page <= 0)
-            elif child.custom_id == "queue_next":
-                child.disabled = (self.page >= max_page - 1)
-
-    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary, custom_id="queue_prev")
-    async def prev(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.page = max(0, self.page - 1)
-        self._sync_buttons()
-        await interaction.response.edit_message(
-            embed=_build_queue_embed(self.guild_id, self.page, self.page_size),
-            view=self,
-        )
+    async def callback(self, interaction: discord.Interaction) -> None:
+        await _timed(f"queue_{self.action}")(self._show_page)(interaction)
 
-    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary, custom_id="queue_next")
-    async def next(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.page = self.page + 1
-        self._sync_buttons()
-        await interaction.response.edit_message(
-            embed=_build_queue_embed(self.guild_id, self.page, self.page_size),
-            view=self,
-        )
+    async def _show_page(self, interaction: discord.Interaction) -> None:
+        page = self.page + {"prev": -1, "next": 1}.get(self.action, 0)
+        view = QueueView(interaction.guild.id, self.author_id, QUEUE_PAGE_SIZE, page)
+        embed = _build_queue_embed(view.guild_id, view.page, view.page_size)
+        await interaction.response.edit_message(embed=embed, view=view)
+        view.watch(interaction.message, embed)
 
-    @discord.ui.button(label="🔄 Refresh", style=discord.ButtonStyle.primary, custom_id="queue_refresh")
-    async def refresh(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self._sync_buttons()
-        await interaction.response.edit_message(
-            embed=_build_queue_embed(self.guild_id, self.page, self.page_size),
-            view=self,
-        )
 
+class QueueView(discord.ui.View):
+    """Buttons of one /queue message at one page (QueueButton items only, nothing to time out)."""
 
-async def _extract_yt_info(query: str) -> tuple[str, str]:
-    """Run yt-dlp in a thread so slash commands don't time out."""
-
-    def _work() -> tuple[str, str]:
-        normalized = _normalize_youtube_query(query)
-        opts = dict(YDL_OPTS)
-        # If it's a direct watch URL (v=...), avoid accidental playlist extraction.
-        if "youtube.com/watch?v=" in normalized or "youtu.be/" in normalized:
-            opts["noplaylist"] = True
-
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(normalized, download=False)
-
-            # Playlist handling: pick first playable entry
-            if isinstance(info, dict) and "entries" in info:
-                entries = info.get("entries") or []
-                picked = None
-                for e in entries:
-                    if not e:
-                        continue
-                    if isinstance(e, dict) and (e.get("url") or e.get("id")):
-                        picked = e
-                        break
-                if picked is None:
-                    raise RuntimeError("Playlist không có entry playable.")
-                info = picked
-
-            # yt-dlp may return 'id' for some extractors; prefer direct 'url' when available
-            song_url = info.get("url") or info.get("webpage_url")  # type: ignore[union-attr]
-            title = info.get("title") or "Unknown title"  # type: ignore[union-attr]
-            if not song_url:
-                raise RuntimeError("Không lấy được stream URL.")
-            return song_url, title
-
-    return await asyncio.to_thread(_work)
-
-
-async def _extract_yt_info_with_web(query: str) -> Tuple[str, str, Optional[str]]:
-    """Like _extract_yt_info, but also returns a shareable webpage URL when possible."""
-
-    def _work() -> Tuple[str, str, Optional[str]]:
-        normalized = _normalize_youtube_query(query)
-        opts = dict(YDL_OPTS)
-        if "youtube.com/watch?v=" in normalized or "youtu.be/" in normalized:
-            opts["noplaylist"] = True
-
-        with yt_dlp.YoutubeDL(opts) as ydl:
-            info = ydl.extract_info(normalized, download=False)
-
-            if isinstance(info, dict) and "entries" in info:
-                entries = info.get("entries") or []
-                picked = None
-                for e in entries:
-                    if not e:
-                        continue
-                    if isinstance(e, dict) and (e.get("url") or e.get("id")):
-                        picked = e
-                        break
-                if picked is None:
-                    raise RuntimeError("Playlist không có entry playable.")
-                info = picked
-
-            stream_url = info.get("url") or info.get("webpage_url")  # type: ignore[union-attr]
-            title = info.get("title") or "Unknown title"  # type: ignore[union-attr]
-            web_url = (
-                info.get("webpage_url")  # type: ignore[union-attr]
-                or info.get("original_url")  # type: ignore[union-attr]
-                or (normalized if normalized.startswith("http") else None)
-            )
-            if not stream_url:
-                raise RuntimeError("Không lấy được stream URL.")
-            return stream_url, title, web_url
+    WATCH_SECONDS = 180  # auto-refresh a queue message this long after it was shown or paged
 
-    return await asyncio.to_thread(_work)
+    def __init__(self, guild_id: int, author_id: int, page_size: int, page: int = 0):
+        super().__init__(timeout=None)
+        self.guild_id = guild_id
+        self.author_id = author_id
+        self.page_size = page_size
+        self.page = page
+        self.message: Optional[discord.Message] = None  # set once sent; auto-refresh edits it
+        self.rendered: Optional[dict] = None  # last embed shown, to skip no-op edits
+        self.watch_until = 0.0
+        self._sync_buttons()
+
+    def watch(self, message: discord.Message, embed: discord.Embed) -> None:
+        """Keep `message` in sync with the queue for the next WATCH_SECONDS."""
+        self.message = message
+        self.rendered = embed.to_dict()
+        now = time.monotonic()
+        self.watch_until = now + self.WATCH_SECONDS
+        player = players.get(self.guild_id)
+        if player is None or QUEUE_REFRESH_SECONDS <= 0:
+            return  # nothing would ever refresh (or prune) the registration
+        views = player.queue_pages.views
+        # Normally pruned by _refresh_queue_views; also here for guilds whose queue stays untouched
+        for message_id in [m for m, v in views.items() if now > v.watch_until]:
+            del views[message_id]
+        views[message.id] = self
+
+    def _sync_buttons(self) -> None:
+        player = players.get(self.guild_id)
+        total = len(player.queue) if player is not None else 0
+        max_page = max(1, (total + self.page_size - 1) // self.page_size)
+        self.page = max(0, min(self.page, max_page - 1))
+        self.clear_items()
+        self.add_item(QueueButton("prev", self.author_id, self.page, disabled=self.page <= 0))
+        self.add_item(QueueButton("next", self.author_id, self.page, disabled=self.page >= max_page - 1))
+        self.add_item(QueueButton("refresh", self.author_id, self.page))
+
+
+def _resolution_key(query: str) -> str:
+    """Key of a query in the resolution cache (and of its in-flight extraction)."""
+    normalized = _normalize_youtube_query(query)
+    if not normalized.startswith("http"):
+        indexed = _search_index.lookup(normalized)
+        if indexed is not None:
+            # Searched before: go straight to the video, skipping ytsearch.
+            normalized = f"https://www.youtube.com/watch?v={indexed['video_id']}"
+    return normalized
+
+
+async def _resolve_track(query: str, trace: Optional[_TrackTrace] = None, fresh: bool = False) -> dict:
+    """Resolve a query to {stream_url, title, web_url, duration, extracted_at, expires_at}.
+
+    Served from the shared resolution cache while the stream URL is still valid;
+    otherwise extracted with yt-dlp and written back to the cache. Concurrent
+    misses for the same query wait on a single in-flight extraction. fresh=True
+    skips the cache, e.g. when the cached stream URL just died mid-track.
+    """
+    global _inflight_hits
+    with _trace_span("normalize", trace):
+        normalized = _resolution_key(query)
+    cached = _resolution_cache.get(normalized)
+    if cached is not None and not fresh:
+        if _stream_url_is_fresh(
+            cached["stream_url"],
+            cached["extracted_at"],
+            cached["expires_at"],
+            min_remaining=cached["duration"] or 0,
+        ):
+            _resolution_cache.hits += 1
+            if trace is not None:
+                trace.record["resolve_cache"] = "hit"
+            return cached
+        _resolution_cache.stale += 1
+    else:
+        _resolution_cache.misses += 1
+    if trace is not None:
+        trace.record["resolve_cache"] = "stale" if cached is not None else "miss"
+
+    # Single-flight: concurrent callers for the same query share one extraction.
+    task = _inflight_resolutions.get(normalized)
+    if task is None:
+        task = asyncio.ensure_future(_extract_and_cache(normalized, trace))
+        _inflight_resolutions[normalized] = task
+        task.add_done_callback(lambda t: _resolution_done(normalized, t))
+    else:
+        _inflight_hits += 1
+        if trace is not None:
+            trace.record["resolve_cache"] = "coalesced"
+    # shield: one caller being cancelled (e.g. a look-ahead) must not abort the others
+    return dict(await asyncio.shield(task))
+
+
+# normalized query -> Task extracting it, shared by concurrent _resolve_track callers
+_inflight_resolutions: dict[str, asyncio.Future] = {}
+_inflight_hits = 0
+
+
+def _resolution_done(normalized: str, task: asyncio.Future) -> None:
+    if _inflight_resolutions.get(normalized) is task:
+        del _inflight_resolutions[normalized]
+    if not task.cancelled():
+        task.exception()  # retrieved here so an unawaited failure isn't logged as lost
+
+
+async def _extract_and_cache(normalized: str, trace: Optional[_TrackTrace] = None) -> dict:
+    # If it's a direct watch URL (v=...), avoid accidental playlist extraction.
+    if "youtube.com/watch?v=" in normalized or "youtu.be/" in normalized:
+        profile = "video"
+    else:
+        profile = "search"
+    with _trace_span("extract", trace):
+        info = await _ydl_pool.run(profile, _ydl_extract_track, normalized)
+    info["extracted_at"] = time.time()
+    info["expires_at"] = _stream_url_expiry(info["stream_url"])
+
+    _resolution_cache.put(normalized, info)
+    _search_index.add_resolution(normalized, info)
+    web_url = info.get("web_url")
+    if web_url:
+        # Let a later request for the video URL itself hit the same entry.
+        web_key = _normalize_youtube_query(web_url)
+        if web_key != normalized:
+            _resolution_cache.put(web_key, info)
+    bot.loop.create_task(_resolution_cache.persist())
+    return info
+
+
+_ready_once = False
+
+
+def _command_tree_hash(guild: Optional[discord.Object]) -> str:
+    """Digest of exactly what tree.sync(guild=...) would upload."""
+    payload = sorted(
+        (cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands(guild=guild)),
+        key=lambda d: d["name"],
+    )
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+def _load_command_hashes() -> dict:
+    try:
+        with open(COMMAND_HASH_FILE, encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_command_hashes(hashes: dict) -> None:
+    try:
+        with open(COMMAND_HASH_FILE, "w", encoding="utf-8") as f:
+            json.dump(hashes, f)
+    except OSError as e:
+        print(f"Không lưu được hash lệnh slash ({COMMAND_HASH_FILE}): {e}")
 
 
 @bot.event
 async def on_ready():
+    global _ready_once
     print(f'Đã login với tên {bot.user}')
+    if _ready_once:
+        return  # gateway reconnect: commands were already synced by this process
+    _ready_once = True
+    print(f"Startup: import {_import_seconds:.2f}s, ready sau {time.perf_counter() - _boot_started:.2f}s")
+    # Load yt_dlp in the background now, so the first /play doesn't pay for the import.
+    bot.loop.create_task(asyncio.to_thread(importlib.import_module, "yt_dlp"))
+    if _snapshots.enabled:
+        bot.loop.create_task(_run_player_snapshots())
     try:
         guild_obj: Optional[discord.Object] = None
         if GUILD_ID:
@@ -577,136 +2271,1306 @@ async def on_ready():
 
         # ---- Sync mode (pick ONE to avoid duplicates) ----
         scope = SYNC_SCOPE or ("guild" if guild_obj is not None else "global")
-
-        if scope == "guild":
-            if guild_obj is None:
-                print("DISCORD_SYNC_SCOPE=guild nhưng chưa set DISCORD_GUILD_ID -> fallback global sync.")
-                synced = await bot.tree.sync()
-                print(f'Đã sync {len(synced)} lệnh slash (global)!')
-            else:
-                synced = await bot.tree.sync(guild=guild_obj)
-                print(f'Đã sync {len(synced)} lệnh slash cho guild {guild_obj.id}!')
+        if scope == "guild" and guild_obj is None:
+            print("DISCORD_SYNC_SCOPE=guild nhưng chưa set DISCORD_GUILD_ID -> fallback global sync.")
+        target = guild_obj if scope == "guild" else None
+
+        # Syncing is slow and rate-limited: skip it when the tree is unchanged since the last sync.
+        hash_key = f"{bot.application_id}:{target.id if target is not None else 'global'}"
+        tree_hash = _command_tree_hash(target)
+        hashes = _load_command_hashes()
+        if hashes.get(hash_key) == tree_hash and not (CLEAR_GLOBAL_COMMANDS or CLEAR_GUILD_COMMANDS):
+            print("Slash commands không đổi từ lần sync trước, bỏ qua sync.")
         else:
-            synced = await bot.tree.sync()
-            print(f'Đã sync {len(synced)} lệnh slash (global)!')
+            synced = await bot.tree.sync(guild=target)
+            if target is not None:
+                print(f'Đã sync {len(synced)} lệnh slash cho guild {target.id}!')
+            else:
+                print(f'Đã sync {len(synced)} lệnh slash (global)!')
+            hashes[hash_key] = tree_hash
+            _save_command_hashes(hashes)
 
         _print_registered_slash_commands()
     except Exception as e:
         print(f"Slash sync error: {e}")
 
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    _release_player(guild.id, forget=True)
+    _snapshots.forget(guild.id)
+    _search_index.forget_guild(guild.id)
+
+
+@bot.event
+async def on_guild_available(guild: discord.Guild):
+    # Unavailable (outage) when snapshots were restored at startup: restore it now
+    if guild.id in _snapshots.unrestored:
+        await _restore_player(guild)
+
+
+@bot.event
+async def on_voice_state_update(member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+    # Bot was disconnected from voice (kicked, /stop, channel deleted): free playback
+    # state but keep the queue/settings for the next /play.
+    if bot.user is not None and member.id == bot.user.id and before.channel is not None and after.channel is None:
+        _release_player(member.guild.id)
+
 # Hàm chơi nhạc
 def _get_repeat_mode(guild_id: int) -> str:
-    return repeat_mode.get(guild_id, "off")
+    player = players.get(guild_id)
+    return player.repeat_mode if player is not None else "off"
 
 
-async def play_next(ctx):
-    guild_id = ctx.guild.id
-    voice_client = ctx.voice_client
-    if voice_client is None or not voice_client.is_connected():
-        return
+FFMPEG_BEFORE_OPTIONS = '-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5'
 
-    mode = _get_repeat_mode(guild_id)
 
-    # Decide next track source (supports repeat-one even when queue is empty)
-    if guild_id in requeue_front_item:
-        if guild_id not in queues:
-            queues[guild_id] = deque()
-        queues[guild_id].appendleft(requeue_front_item.pop(guild_id))
-
-    if guild_id in next_override_item:
-        item = next_override_item.pop(guild_id)
-    elif mode == "one" and end_reasons.get(guild_id) is None and last_track_source.get(guild_id):
-        item = last_track_source[guild_id]
-    else:
-        if guild_id not in queues or not queues[guild_id]:
-            current_song[guild_id] = None
-            current_song_url[guild_id] = None
+class _PrimedAudio(discord.AudioSource):
+    """Wraps a source whose first frame is read ahead of time.
+
+    Priming forces FFmpeg to spawn, connect and start decoding before the
+    previous track ends, so voice_client.play() can start sending immediately.
+    """
+
+    def __init__(self, inner: discord.AudioSource):
+        self.inner = inner
+        self._first: Optional[bytes] = None
+
+    def prime(self) -> bool:
+        """Blocking: read the first frame. Returns False if the stream produced nothing."""
+        self._first = self.inner.read()
+        return bool(self._first)
+
+    def read(self) -> bytes:
+        if self._first is not None:
+            frame, self._first = self._first, None
+            return frame
+        return self.inner.read()
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self) -> None:
+        self.inner.cleanup()
+
+
+# Live FFmpeg-backed sources, for the process-count metric
+_ffmpeg_sources: "weakref.WeakSet[discord.FFmpegAudio]" = weakref.WeakSet()
+
+
+class _TracedAudio(discord.AudioSource):
+    """Pass-through source that marks when the voice thread reads the first frame."""
+
+    def __init__(self, inner: discord.AudioSource, trace: _TrackTrace):
+        self.inner = inner
+        self._trace: Optional[_TrackTrace] = trace
+
+    def read(self) -> bytes:
+        if self._trace is not None:
+            data = self.inner.read()
+            self._trace.mark("first_packet_ms")
+            self._trace = None
+            return data
+        return self.inner.read()
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self) -> None:
+        self.inner.cleanup()
+
+
+class _ElapsedAudio(discord.AudioSource):
+    """Pass-through source counting the 20ms frames sent, i.e. the playback position.
+
+    Frames are only read while playing, so pauses don't count.
+    """
+
+    FRAME_SECONDS = 0.02
+
+    def __init__(self, inner: discord.AudioSource, offset: float = 0.0):
+        self.inner = inner
+        self.offset = offset  # seconds into the track where inner starts
+        self.frames = 0
+
+    @property
+    def elapsed(self) -> float:
+        return self.offset + self.frames * self.FRAME_SECONDS
+
+    def read(self) -> bytes:
+        data = self.inner.read()
+        if data:
+            self.frames += 1
+        return data
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self) -> None:
+        self.inner.cleanup()
+
+
+def _ffmpeg_before_options(seek: float) -> str:
+    # -ss before -i seeks the input: FFmpeg jumps there via HTTP range requests
+    # instead of downloading and decoding everything before it.
+    if seek > 0:
+        return f"-ss {seek:.2f} {FFMPEG_BEFORE_OPTIONS}"
+    return FFMPEG_BEFORE_OPTIONS
+
+
+def _make_pcm_source(stream_url: str, seek: float = 0.0) -> discord.AudioSource:
+    source = discord.FFmpegPCMAudio(
+        stream_url,
+        before_options=_ffmpeg_before_options(seek),
+        options='-vn'
+    )
+    _ffmpeg_sources.add(source)
+    return source
+
+
+def _make_opus_source(stream_url: str, acodec: Optional[str] = None, seek: float = 0.0) -> discord.AudioSource:
+    source = discord.FFmpegOpusAudio(
+        stream_url,
+        codec="copy" if acodec == "opus" else None,
+        before_options=_ffmpeg_before_options(seek),
+        options='-vn',
+    )
+    _ffmpeg_sources.add(source)
+    return source
+
+
+def _make_audio_source(stream_url: str, acodec: Optional[str] = None, seek: float = 0.0) -> discord.AudioSource:
+    """Build the FFmpeg source for a stream, honouring AUDIO_MODE, starting `seek` seconds in.
+
+    In opus mode, Opus input is remuxed without re-encoding and sent to Discord
+    as-is (no PCM decode, no per-frame libopus encode in the voice thread); other
+    codecs are encoded to Opus by FFmpeg. Falls back to the PCM path on error.
+    """
+    if AUDIO_MODE == "opus":
+        try:
+            return _make_opus_source(stream_url, acodec, seek)
+        except Exception as e:
+            print(f"Opus passthrough unavailable, falling back to PCM: {e}")
+    return _make_pcm_source(stream_url, seek)
+
+
+def _make_item_source(item: QueueItem, seek: float = 0.0) -> discord.AudioSource:
+    """_make_audio_source for an item's stream, on the PCM path once its codec copy has failed."""
+    if item.copy_failed:
+        return _make_pcm_source(item.stream_url, seek)
+    return _make_audio_source(item.stream_url, item.acodec, seek)
+
+
+# Frames a lagging (e.g. paused) subscriber may trail the fastest one before it skips ahead
+BROADCAST_MAX_LAG_FRAMES = 3000  # 60s of 20ms frames
+
+
+class _BroadcastHub:
+    """One upstream FFmpeg process for a track, fanned out to several guilds.
+
+    Frames are pulled from the upstream by whichever subscriber is furthest
+    ahead and kept in a shared buffer; every subscriber reads at its own offset,
+    starting from the first frame. Guilds can join only while that first frame is
+    still buffered, i.e. within BROADCAST_WINDOW of the first guild starting.
+    The blocking upstream read happens outside the lock (one reader at a time),
+    so a stalled FFmpeg pipe never delays subscribers that still have buffered
+    frames to play.
+    """
+
+    def __init__(self, key: str, upstream: discord.AudioSource):
+        self.key = key
+        self.upstream = upstream
+        self.started = time.monotonic()
+        self._frames: deque[bytes] = deque()
+        self._base = 0  # absolute frame index of _frames[0]
+        self._ended = False
+        self._closed = False
+        self._subscribers: set["_BroadcastSubscriber"] = set()
+        self._lock = Lock()
+        self._frame_ready = threading.Condition(self._lock)  # a read of the upstream finished
+        self._reading = False  # a subscriber is reading the upstream
+
+    def joinable(self) -> bool:
+        return not self._closed and self._base == 0 and time.monotonic() - self.started < BROADCAST_WINDOW
+
+    def subscribe(self) -> Optional["_BroadcastSubscriber"]:
+        with self._lock:
+            if self._closed:
+                return None
+            sub = _BroadcastSubscriber(self)
+            self._subscribers.add(sub)
+            return sub
+
+    def frame(self, index: int) -> tuple[bytes, int]:
+        """(frame at index or b"" at the end, index actually served). Called from voice threads."""
+        while True:
+            with self._lock:
+                while True:
+                    if index < self._base:
+                        index = self._base  # trailed too far behind: skip ahead
+                    if index < self._base + len(self._frames):
+                        data = self._frames[index - self._base]
+                        self._trim()
+                        return data, index
+                    if self._ended or self._closed:
+                        return b"", index
+                    if not self._reading:
+                        break
+                    self._frame_ready.wait()  # another subscriber is fetching the next frame
+                self._reading = True
+            data = b""
+            try:
+                data = self.upstream.read()
+            finally:
+                with self._lock:
+                    self._reading = False
+                    if not data:
+                        self._ended = True
+                    elif not self._closed:
+                        self._frames.append(data)
+                    self._frame_ready.notify_all()
+
+    def _trim(self) -> None:
+        # Keep everything during the join window: a new subscriber starts at frame 0.
+        if time.monotonic() - self.started < BROADCAST_WINDOW:
             return
-        item = queues[guild_id].popleft()
-
-    # Backward compatible if queue contains raw strings
-    if isinstance(item, str):
-        item = _make_queue_item(source=item, requester_id=0)
-
-    # If we already have a fresh stream URL cached, reuse it to start faster.
-    # YouTube signed URLs can expire; keep the cache window conservative.
-    CACHE_TTL_SECONDS = 8 * 60
-    extracted_at = item.get("extracted_at")
-    cached_stream = item.get("stream_url")
-    cached_title = item.get("title")
-    cached_web = item.get("web_url")
-
-    info_msg = None
-    if not cached_stream or not isinstance(extracted_at, (int, float)) or (time.time() - extracted_at) > CACHE_TTL_SECONDS:
-        # Give immediate feedback while extracting
+        head = self._base + len(self._frames)
+        keep_from = max(
+            min((s.position for s in self._subscribers), default=head),
+            head - BROADCAST_MAX_LAG_FRAMES,
+        )
+        while self._base < keep_from:
+            self._frames.popleft()
+            self._base += 1
+
+    def unsubscribe(self, sub: "_BroadcastSubscriber") -> None:
+        with self._lock:
+            self._subscribers.discard(sub)
+            if self._subscribers or self._closed:
+                return
+            self._closed = True
+            self._frames.clear()
+            self._frame_ready.notify_all()
+        with _broadcasts_lock:
+            if _broadcasts.get(self.key) is self:
+                del _broadcasts[self.key]
+        self.upstream.cleanup()
+
+
+class _BroadcastSubscriber(discord.AudioSource):
+    """One guild's view of a _BroadcastHub."""
+
+    def __init__(self, hub: _BroadcastHub):
+        self.hub = hub
+        self.position = 0
+        self._done = False
+
+    def read(self) -> bytes:
+        if self._done:
+            return b""
+        data, index = self.hub.frame(self.position)
+        self.position = index + 1
+        return data
+
+    def is_opus(self) -> bool:
+        return self.hub.upstream.is_opus()
+
+    def cleanup(self) -> None:
+        if not self._done:
+            self._done = True
+            self.hub.unsubscribe(self)
+
+
+# track key (video id or normalized query) -> newest hub streaming it
+_broadcasts: dict[str, _BroadcastHub] = {}
+_broadcasts_lock = Lock()
+
+
+def _open_stream_source(item: QueueItem) -> discord.AudioSource:
+    """Source for an item's resolved stream URL, shared with other guilds when BROADCAST_WINDOW is set.
+
+    Shared upstreams always produce Opus (FFmpeg encodes once), so fanning out
+    costs no per-guild decode or encode, whatever AUDIO_MODE is.
+    """
+    if BROADCAST_WINDOW <= 0 or item.copy_failed:
+        return _make_item_source(item)
+    key = _youtube_video_id(item.web_url or item.source) or _normalize_youtube_query(item.source)
+    with _broadcasts_lock:
+        hub = _broadcasts.get(key)
+        sub = hub.subscribe() if hub is not None and hub.joinable() else None
+    if sub is not None:
+        return sub
+    try:
+        upstream = _make_opus_source(item.stream_url, item.acodec)
+    except Exception as e:
+        print(f"Shared stream unavailable, using a dedicated one: {e}")
+        return _make_item_source(item)
+    hub = _BroadcastHub(key, upstream)
+    with _broadcasts_lock:
+        _broadcasts[key] = hub
+        return hub.subscribe()
+
+
+class _MappedOpusAudio(discord.AudioSource):
+    """Plays a cached Ogg/Opus file straight from a read-only memory map.
+
+    Packets are sent as-is (no FFmpeg, no decode/encode), and the pages come from
+    the OS page cache, so guilds playing the same cached track share one copy.
+    """
+
+    def __init__(self, path: str, offset: float = 0.0):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        start = self._page_at(offset) if offset > 0 else 0
+        self._map.seek(start)
+        # A page starting mid-packet would hand out the packet's tail first
+        self._skip_first = start > 0 and start + 5 < len(self._map) and bool(self._map[start + 5] & 0x01)
+        self._packets = discord.oggparse.OggStream(self._map).iter_packets()
+
+    def _page_at(self, seconds: float) -> int:
+        """Byte offset of the first Ogg page ending at or after `seconds`."""
+        target = seconds * 48000
+        data = self._map
+        pos = 0
+        while pos + 27 <= len(data) and data[pos:pos + 4] == b"OggS":
+            if struct.unpack_from("<q", data, pos + 6)[0] >= target:
+                return pos
+            segments = data[pos + 26]
+            pos += 27 + segments + sum(data[pos + 27:pos + 27 + segments])
+        return len(data)
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Seconds, from the granule position of the last Ogg page (48 kHz for Opus)."""
+        last = self._map.rfind(b"OggS")
+        if last < 0 or last + 14 > len(self._map):
+            return None
+        granule = struct.unpack_from("<q", self._map, last + 6)[0]
+        return granule / 48000 if granule > 0 else None
+
+    def read(self) -> bytes:
         try:
-            info_msg = await ctx.send(f"Đang lấy thông tin: **{item.get('source', '')}** ...")
-        except Exception:
-            info_msg = None
+            for packet in self._packets:
+                if self._skip_first:
+                    self._skip_first = False
+                    continue
+                if not packet.startswith((b"OpusHead", b"OpusTags")):
+                    return packet
+        except (ValueError, discord.oggparse.OggError):
+            pass  # closed by cleanup() or truncated file: end the track
+        return b""
+
+    def is_opus(self) -> bool:
+        return True
+
+    def cleanup(self) -> None:
+        self._map.close()
+
+
+class _AudioCache:
+    """Size-bounded on-disk LRU of Ogg/Opus audio, content-addressed by YouTube video id.
+
+    Upcoming queue items are downloaded in the background (FFmpeg remux of the
+    resolved stream, or an Opus encode for other codecs) to <dir>/<video id>.opus.
+    Files are shared by all guilds; recency is kept in mtime so it survives restarts.
+    The directory is only scanned by open(): the scan deletes interrupted
+    downloads, which must not happen when a worker process imports this module.
+    """
+
+    def __init__(self, directory: Optional[str], max_bytes: int, max_track_seconds: float, concurrency: int = 2):
+        self._requested_dir = directory
+        self.directory: Optional[str] = None  # set by open()
+        self.max_bytes = max_bytes
+        self.max_track_seconds = max_track_seconds
+        self.concurrency = max(1, concurrency)
+        self._files: "OrderedDict[str, int]" = OrderedDict()  # video id -> size, oldest first
+        self._total = 0
+        self._downloading: dict[str, asyncio.Task] = {}  # video id / query -> download task
+        self._slots: Optional[asyncio.Semaphore] = None
+        self.hits = 0
+        self.misses = 0
+        self.downloads = 0
+        self.download_failures = 0
+        self.fetching = 0  # FFmpeg download processes running
+
+    def open(self) -> None:
+        """Scan the cache directory (once; main process only)."""
+        directory, self._requested_dir = self._requested_dir, None
+        if not directory:
+            return
+        self.directory = directory
+        try:
+            self._scan()
+        except OSError as e:
+            print(f"Audio cache disabled ({directory}): {e}")
+            self.directory = None
+            self._files.clear()
+            self._total = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def _scan(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".part"):
+                os.remove(entry.path)  # interrupted download
+            elif entry.name.endswith(".opus"):
+                st = entry.stat()
+                found.append((st.st_mtime, entry.name[:-len(".opus")], st.st_size))
+        for _, vid, size in sorted(found):
+            self._files[vid] = size
+            self._total += size
+        self._evict()
+        print(f"Audio cache: {len(self._files)} tracks, {self._total // (1024 * 1024)} MB in {self.directory}")
+
+    def _path(self, vid: str) -> str:
+        return os.path.join(self.directory, f"{vid}.opus")
+
+    def video_id(self, item: QueueItem) -> Optional[str]:
+        vid = _youtube_video_id(item.web_url) or _youtube_video_id(item.source)
+        if vid is None:
+            indexed = _search_index.peek(item.source)
+            vid = indexed["video_id"] if indexed else None
+        return vid
+
+    def has(self, item: QueueItem) -> bool:
+        return self.enabled and self.video_id(item) in self._files
+
+    def open_source(self, item: QueueItem, offset: float = 0.0) -> Optional[discord.AudioSource]:
+        """Audio source for a cached item starting `offset` seconds in (filling known metadata), or None on a miss."""
+        if not self.enabled:
+            return None
+        vid = self.video_id(item)
+        if vid is None or vid not in self._files:
+            self.misses += 1
+            return None
+        path = self._path(vid)
         try:
-            song_url, title, web_url = await _extract_yt_info_with_web(item.get("source", ""))
+            source = _MappedOpusAudio(path, offset)
+        except (OSError, ValueError) as e:
+            print(f"Audio cache: dropping unreadable {path}: {e}")
+            self._forget(vid)
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._files.move_to_end(vid)
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        if item.duration is None:
+            item.duration = source.duration
+        if not item.title or not item.web_url:
+            known = _resolution_cache.get(_normalize_youtube_query(item.source)) or _search_index.peek(item.source)
+            if known and not item.title:
+                item.title = known["title"]
+            if not item.web_url:
+                item.web_url = f"https://www.youtube.com/watch?v={vid}"
+        return source
+
+    def schedule_upcoming(self, player: GuildPlayer) -> None:
+        """Start background downloads for the next few items the player will reach."""
+        if not self.enabled or AUDIO_CACHE_PREDOWNLOAD <= 0:
+            return
+        upcoming = [_peek_next_item(player), *islice(player.queue, AUDIO_CACHE_PREDOWNLOAD)]
+        for item in upcoming:
+            if item is not None:
+                self.schedule(item)
+
+    def schedule(self, item: QueueItem) -> None:
+        key = self.video_id(item) or _normalize_youtube_query(item.source)
+        if key in self._files or key in self._downloading:
+            return
+        task = bot.loop.create_task(self._download(item, key))
+        self._downloading[key] = task
+        task.add_done_callback(lambda _: self._downloading.pop(key, None))
+
+    async def _download(self, item: QueueItem, key: str) -> None:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.concurrency)
+        async with self._slots:
+            if not _queue_item_stream_is_fresh(item):
+                try:
+                    _apply_item_metadata(item, await _resolve_track(item.source))
+                except Exception:
+                    return  # the player will report it if it's ever played
+            vid = _youtube_video_id(item.web_url)
+            if vid is None or vid in self._files:
+                return
+            if vid != key:
+                if vid in self._downloading:
+                    return
+                self._downloading[vid] = self._downloading[key]
+            try:
+                duration = item.duration
+                # Unknown duration is usually a live stream; very long mixes would flush the cache.
+                if isinstance(duration, (int, float)) and duration <= self.max_track_seconds:
+                    await self._fetch(vid, item.stream_url, item.acodec)
+            finally:
+                if vid != key:
+                    self._downloading.pop(vid, None)
+
+    async def _fetch(self, vid: str, stream_url: str, acodec: Optional[str]) -> None:
+        path = self._path(vid)
+        part = path + ".part"
+        codec = ["-c:a", "copy"] if acodec == "opus" else ["-c:a", "libopus", "-b:a", "128k"]
+        args = [
+            "ffmpeg", "-nostdin", "-loglevel", "error", "-y",
+            *FFMPEG_BEFORE_OPTIONS.split(), "-i", stream_url,
+            "-vn", "-map_metadata", "-1", *codec, "-f", "ogg", part,
+        ]
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            self.fetching += 1
+            try:
+                _, err = await proc.communicate()
+            except asyncio.CancelledError:
+                proc.kill()
+                await proc.wait()
+                raise
+            finally:
+                self.fetching -= 1
+            if proc.returncode != 0:
+                raise RuntimeError(err.decode(errors="replace").strip()[-300:] or f"ffmpeg exited {proc.returncode}")
+            os.replace(part, path)
+            size = os.path.getsize(path)
+        except asyncio.CancelledError:
+            _remove_quietly(part)
+            raise
         except Exception as e:
-            await ctx.send(f"Không lấy được info bài: **{item.get('source', '')}**\n```{e}```")
-            await play_next(ctx)
+            _remove_quietly(part)
+            self.download_failures += 1
+            print(f"Audio cache download failed for {vid}: {e}")
             return
+        self.downloads += 1
+        self._files[vid] = size
+        self._total += size
+        self._evict()
 
-        item["stream_url"] = song_url
-        item["extracted_at"] = time.time()
-        item["title"] = title
-        item["web_url"] = web_url
-    else:
-        song_url = cached_stream
-        title = cached_title or "Unknown title"
-        web_url = cached_web
+    def _forget(self, vid: str) -> None:
+        size = self._files.pop(vid, None)
+        if size is not None:
+            self._total -= size
+        _remove_quietly(self._path(vid))
 
-    source = discord.FFmpegPCMAudio(
-        song_url,
-        before_options='-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5',
-        options='-vn'
-    )
+    def _evict(self) -> None:
+        # Always keep the newest file, even if it alone exceeds the budget.
+        # Deleting a file that is still being played is fine: its mapping stays valid.
+        while self._total > self.max_bytes and len(self._files) > 1:
+            self._forget(next(iter(self._files)))
 
-    current_song[guild_id] = title
-    current_song_url[guild_id] = web_url
-    last_track_source[guild_id] = item
-    current_track_item[guild_id] = item
-    if guild_id not in history:
-        history[guild_id] = deque(maxlen=100)
-    history[guild_id].append(item)
 
-    now_playing_text = _build_now_playing_text(guild_id, title, web_url)
-    view = NowPlayingView(guild_id=guild_id)
-    if info_msg is not None:
+def _remove_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+_audio_cache = _AudioCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_MB * 1024 * 1024, AUDIO_CACHE_MAX_TRACK_SECONDS)
+
+
+def _peek_next_item(player: GuildPlayer) -> Optional[QueueItem]:
+    """Predict what the player will pick when the current track ends naturally."""
+    if player.next_override is not None:
+        return player.next_override
+    if player.requeue_front is not None:
+        return player.requeue_front
+    if player.repeat_mode == "one" and player.last_played is not None:
+        return player.last_played
+    if player.queue:
+        return player.queue[0]
+    if player.repeat_mode == "all" and player.current is not None:
+        # Re-appended to the (empty) queue on natural end
+        return player.current
+    return None
+
+
+def _discard_prepared(player: GuildPlayer) -> None:
+    prepared, player.prepared = player.prepared, None
+    if prepared is not None:
         try:
-            await info_msg.edit(content=now_playing_text, view=view)
+            prepared[1].cleanup()
         except Exception:
-            await ctx.send(now_playing_text, view=view)
-    else:
-        await ctx.send(now_playing_text, view=view)
+            pass
+
 
-    async def _after_track(played_item: dict):
-        # Determine why the track ended (natural vs skip/stop)
-        reason = end_reasons.pop(guild_id, None)
-        mode_after = _get_repeat_mode(guild_id)
+def _cancel_lookahead(player: GuildPlayer) -> None:
+    task, player.lookahead_task = player.lookahead_task, None
+    if task is not None and not task.done():
+        task.cancel()
+    _discard_prepared(player)
 
+
+async def _prime_source(source: "_PrimedAudio") -> bool:
+    try:
+        return await asyncio.to_thread(source.prime)
+    except Exception:
+        return False
+
+
+async def _lookahead_next_track(player: GuildPlayer, current_item: QueueItem) -> None:
+    """Resolve the next track while the current one plays, then pre-spawn its source.
+
+    The URL is resolved right away (cheap to keep); FFmpeg is only started
+    GAPLESS_PRESPAWN_SECONDS before the current track is expected to end, so an
+    idle connection is not held open for the whole song. The wait follows the
+    playback position, so paused time doesn't count; pausing drops the
+    look-ahead and resuming starts it again.
+    """
+    nxt = _peek_next_item(player)
+    if nxt is None or _audio_cache.has(nxt):
+        return  # cached tracks open instantly from disk; nothing to prepare
+    if not _queue_item_stream_is_fresh(nxt):
+        try:
+            info = await _resolve_track(nxt.source)
+        except Exception:
+            return  # the player will retry and report the error
+        _apply_resolved_stream(nxt, info)
+        if not nxt.title:
+            nxt.title = info["title"]
+        if not nxt.web_url:
+            nxt.web_url = info["web_url"]
+
+    duration = current_item.duration
+    if GAPLESS_PRESPAWN_SECONDS <= 0 or not isinstance(duration, (int, float)):
+        return
+    while True:
+        if player.current is not current_item or player.playback is None:
+            return
+        # Position only advances while playing, so this never wakes early
+        delay = duration - player.playback.elapsed - GAPLESS_PRESPAWN_SECONDS
+        if delay <= 0:
+            break
+        await asyncio.sleep(delay)
+
+    # The queue/repeat mode may have changed while waiting
+    nxt = _peek_next_item(player)
+    if nxt is None or not _queue_item_stream_is_fresh(nxt):
+        return
+    source = _PrimedAudio(_open_stream_source(nxt))
+    try:
+        ok = await _prime_source(source)
+        if not ok and (AUDIO_MODE == "opus" or BROADCAST_WINDOW > 0):
+            # Codec copy can fail on odd containers; retry through the PCM path
+            source.cleanup()
+            source = _PrimedAudio(_make_pcm_source(nxt.stream_url))
+            ok = await _prime_source(source)
+    except BaseException:
+        source.cleanup()  # cancelled by skip/seek/stop mid-prime: don't leak the FFmpeg process
+        raise
+    if not ok:
+        source.cleanup()
+        # URL looks dead: make the player re-resolve it instead of getting it back from the cache
+        _resolution_cache.drop_stream(_resolution_key(nxt.source), nxt.stream_url)
+        nxt.expires_at = 0
+        return
+    _discard_prepared(player)
+    player.prepared = (nxt, source)
+
+
+# Player events, handled in order by one task per guild:
+# - "play": start the next track if nothing is playing
+# - "skip" / "back": stop the current track (payload: the item it targeted)
+# - "seek": restart the current track at an offset (payload: (item, seconds))
+# - "ended": the current track finished (payload: played item), pick the next one
+# Stopping/leaving tears the task down via _release_player().
+MAX_REPORTED_FAILURES = 5
+
+
+def _post_player_event(guild_id: int, kind: str, payload=None) -> None:
+    """Queue an event for the guild's player task. Safe to call from any thread."""
+    player = players.get(guild_id)
+    if player is None or player.events is None:
+        return
+    try:
+        bot.loop.call_soon_threadsafe(player.events.put_nowait, (kind, payload))
+    except RuntimeError:
+        pass  # loop closed during shutdown
+
+
+def _ensure_player(ctx) -> GuildPlayer:
+    player = _get_player(ctx.guild.id)
+    player.ctx = ctx
+    if player.task is None or player.task.done():
+        player.events = asyncio.Queue()
+        player.task = bot.loop.create_task(_player_loop(player))
+    return player
+
+
+def _release_player(guild_id: int, forget: bool = False) -> None:
+    """Stop a guild's player task and free transient playback state.
+
+    With forget=True (bot left the guild) the whole GuildPlayer is dropped;
+    otherwise it is only dropped once nothing worth keeping is left.
+    """
+    if forget:
+        _drop_outboxes(guild_id)
+    player = players.get(guild_id)
+    if player is None:
+        return
+    _prefetcher.cancel_guild(guild_id)
+    _cancel_lookahead(player)
+    if player.task is not None and not player.task.done():
+        player.task.cancel()
+    player.task = None
+    player.events = None
+    player.ctx = None
+    player.current = None
+    player.end_reason = None
+    player.ended_at = None
+    player.playback = None
+    player.seek_to = None
+    if forget or player.is_dormant():
+        player.queue_pages.cancel_refresh()
+        players.pop(guild_id, None)
+
+
+async def play_next(ctx):
+    """Ask the guild's player to start the next track (no-op if already playing)."""
+    _ensure_player(ctx)
+    _post_player_event(ctx.guild.id, "play")
+
+
+async def _player_loop(player: GuildPlayer) -> None:
+    """Per-guild playback driver: an event loop instead of recursive play_next calls.
+
+    An unexpected error while handling one event (voice client, FFmpeg, channel)
+    is reported and leaves the player idle, ready for the next /play or /skip,
+    instead of ending the guild's player task.
+    """
+    events = player.events
+    while True:
+        kind, payload = await events.get()
+        try:
+            await _handle_player_event(player, kind, payload)
+        except Exception as e:
+            print(f"Player error in guild {player.guild_id} ({kind}):")
+            traceback.print_exc()
+            _player_failed(player, e)
+
+
+def _player_failed(player: GuildPlayer, error: Exception) -> None:
+    _cancel_lookahead(player)
+    _discard_prepared(player)
+    vc = player.ctx.voice_client if player.ctx is not None else None
+    item = player.current
+    if vc is None or not (vc.is_playing() or vc.is_paused()):
+        player.current = None  # nothing is playing it: don't wait for an "ended" that won't come
+    if player.ctx is None:
+        return
+    try:
+        _report_failures(_now_playing_outbox(player), [(item.source if item is not None else "?", error)])
+    except Exception as e:
+        print(f"Cannot report player error in guild {player.guild_id}: {e}")
+
+
+async def _handle_player_event(player: GuildPlayer, kind: str, payload) -> None:
+    ctx = player.ctx
+    vc = ctx.voice_client
+
+    busy = vc is not None and (vc.is_playing() or vc.is_paused())
+    reason = None
+    if kind in ("skip", "back"):
+        # Only stop the track the user was looking at, not one that started since.
+        if busy and player.current is payload:
+            player.end_reason = kind
+            vc.stop()  # -> "ended"
+            return
+        if kind == "skip" or busy:
+            return
+        reason = kind  # "back" while idle: play the previous track right away
+    elif kind == "seek":
+        item, player.seek_to = payload
+        if busy and player.current is item:
+            player.end_reason = "seek"
+            vc.stop()  # -> "ended", restarted at seek_to
+        return
+    elif kind == "ended":
+        if payload is not player.current:
+            return  # stale callback from a source torn down by stop/leave
+        # Determine why the track ended (natural vs skip/back/seek)
+        reason, player.end_reason = player.end_reason, None
+        connected = vc is not None and vc.is_connected()
+        if connected and (reason == "seek" or (reason is None and _ended_early(player))):
+            if await _restart_current(player, seek=reason == "seek"):
+                return
+            reason = None  # couldn't restart: carry on as if it ended normally
         # Repeat-all: push played track to the end on NATURAL end only
-        if mode_after == "all" and reason is None:
-            if guild_id not in queues:
-                queues[guild_id] = deque()
-            queues[guild_id].append(played_item)
+        if player.repeat_mode == "all" and reason is None and connected:
+            player.queue.append(payload)
+    elif busy:
+        return  # "play" while something is already playing
+
+    # If bot got disconnected, stop the chain
+    if vc is None or not vc.is_connected():
+        _cancel_lookahead(player)
+        return
 
-        # If bot got disconnected, stop chain
-        vc = ctx.voice_client
-        if vc is None or not vc.is_connected():
+    await _start_next_track(player, reason)
+
+
+def _pick_next_item(player: GuildPlayer, reason: Optional[str]) -> Optional[QueueItem]:
+    # Decide next track source (supports repeat-one even when queue is empty)
+    if player.requeue_front is not None:
+        player.queue.appendleft(player.requeue_front)
+        player.requeue_front = None
+
+    if player.next_override is not None:
+        item, player.next_override = player.next_override, None
+        return item
+    if player.repeat_mode == "one" and reason is None and player.last_played is not None:
+        return player.last_played
+    if not player.queue:
+        return None
+    return player.queue.popleft()
+
+
+async def _start_next_track(player: GuildPlayer, reason: Optional[str]) -> None:
+    """Start the next playable item, skipping unresolvable ones without recursion.
+
+    Failures are collected and reported in a single message, so a playlist full
+    of dead videos costs one loop iteration per item and one channel message.
+    """
+    trace = _tracer.start(player.guild_id, reason)
+
+    lookahead, player.lookahead_task = player.lookahead_task, None
+    if lookahead is not None and not lookahead.done():
+        lookahead.cancel()
+
+    failures: list[tuple[str, Exception]] = []
+    outbox = _now_playing_outbox(player)
+    status_shown = False
+    while True:
+        # After a failure, never fall back to repeat-one of the previous track.
+        item = _pick_next_item(player, reason if not failures else "failed")
+        if item is None:
+            _discard_prepared(player)
+            player.current = None
+            player.ended_at = None
+            _report_failures(outbox, failures)
+            if status_shown:
+                outbox.clear("now_playing")
+            if trace is not None and failures:
+                trace.record["path"] = "empty"
+                trace.record["retries"] = len(failures)
+                _tracer.finish(trace)
             return
 
-        await play_next(ctx)
+        # A track restored from a snapshot picks up where it was interrupted
+        start_at, player.start_at = player.start_at, None
+        offset = start_at[1] if start_at is not None and start_at[0] is item else 0.0
+
+        prepared, player.prepared = player.prepared, None
+        if prepared is not None and (offset or prepared[0] is not item or not _queue_item_stream_is_fresh(item)):
+            prepared[1].cleanup()
+            prepared = None
+
+        if prepared is not None:
+            path = "prepared"
+            cached_source = None
+        else:
+            with _trace_span("audio_cache", trace):
+                cached_source = _audio_cache.open_source(item, offset)
+            path = "audio_cache"
+        if cached_source is not None:
+            break
+
+        # If we already have a stream URL that stays valid for the whole track, reuse it
+        # to start faster (validity comes from the signed URL's own expire= parameter).
+        if _queue_item_stream_is_fresh(item):
+            path = "prepared" if prepared is not None else "fresh_url"
+            break
+
+        # Feedback while extracting; merged away if the now-playing text follows quickly
+        outbox.update(
+            "now_playing", f"Đang lấy thông tin: **{item.source}** ...", repost=True,
+            on_shown=functools.partial(trace.span, "status_message", time.perf_counter()) if trace is not None else None,
+        )
+        status_shown = True
+        try:
+            with _trace_span("resolve", trace):
+                info = await _resolve_track(item.source, trace)
+        except Exception as e:
+            failures.append((item.source, e))
+            continue
+
+        _apply_resolved_stream(item, info)
+        item.title = info["title"]
+        item.web_url = info["web_url"]
+        path = "resolved"
+        break
+
+    title = item.title or "Unknown title"
+    web_url = item.web_url
+    if prepared is not None:
+        source = prepared[1]
+    elif cached_source is not None:
+        source = cached_source
+    else:
+        with _trace_span("ffmpeg_spawn", trace):
+            source = _open_stream_source(item) if not offset else _make_item_source(item, offset)
+    if trace is not None:
+        trace.record.update(source=item.source, title=item.title, path=path, retries=len(failures))
+        source = _TracedAudio(source, trace)
+
+    player.current = item
+    player.last_played = item
+    player.history.append(item)
+    _search_index.remember(player.guild_id, item.title)
+    player.resume_attempts = 0
+    guild_id = player.guild_id
+
+    # Start audio before any message round-trips so transitions stay gapless.
+    _play_item(player, item, source, offset)
+    if trace is not None:
+        trace.mark("to_audio_ms")
+    if player.ended_at is not None:
+        _metrics.observe("bot_track_gap_seconds", time.monotonic() - player.ended_at)
+        player.ended_at = None
+    player.lookahead_task = bot.loop.create_task(_lookahead_next_track(player, item))
+    _audio_cache.schedule_upcoming(player)
+
+    _report_failures(outbox, failures)
+    now_playing_text = _build_now_playing_text(guild_id, title, web_url)
+    on_shown = None
+    if trace is not None:
+        queued = time.perf_counter()
+
+        def on_shown():
+            # Debounce wait plus the send/edit itself; total_ms is taken here too
+            trace.span("now_playing_message", queued)
+            _tracer.finish(trace)
+
+    outbox.update("now_playing", now_playing_text, NowPlayingView(), repost=True, on_shown=on_shown)
+
+
+def _play_item(player: GuildPlayer, item: QueueItem, source: discord.AudioSource, offset: float = 0.0) -> None:
+    """Hand `source` (starting `offset` seconds into `item`) to the voice client."""
+    guild_id = player.guild_id
 
     def after_play(error):
         if error:
             print(error)
-        asyncio.run_coroutine_threadsafe(_after_track(item), bot.loop)
+        player.ended_at = time.monotonic()
+        _post_player_event(guild_id, "ended", item)
+
+    playback = _ElapsedAudio(source, offset)
+    try:
+        player.ctx.voice_client.play(playback, after=after_play)
+    except Exception:
+        playback.cleanup()  # not handed over: the voice client won't clean it up
+        raise
+    player.playback = playback
+
+
+def _ended_early(player: GuildPlayer) -> bool:
+    """Whether the current track stopped well before its known end (dead stream, FFmpeg exit)."""
+    duration = player.current.duration
+    if player.playback is None or not isinstance(duration, (int, float)):
+        return False
+    if player.resume_attempts >= RESUME_MAX_ATTEMPTS:
+        return False
+    return duration - player.playback.elapsed > RESUME_MIN_REMAINING
+
+
+async def _restart_current(player: GuildPlayer, seek: bool) -> bool:
+    """Play the current track again from player.seek_to (seek) or from where it stopped.
+
+    FFmpeg seeks on the input side, so the restart costs one request for the
+    remaining part instead of the whole song. After an early end the stream URL
+    is reused once if it still looks valid, then re-resolved. If the track was
+    being remuxed (Opus codec copy), that is recorded on the item and the
+    restart decodes through the PCM path instead. Returns False if the track
+    couldn't be restarted.
+    """
+    item = player.current
+    if seek:
+        offset, player.seek_to = player.seek_to or 0.0, None
+    else:
+        offset = player.playback.elapsed
+        player.resume_attempts += 1
+        print(f"Stream ended early at {offset:.1f}s, resuming: {item.source}")
+        if AUDIO_MODE == "opus" and item.acodec == "opus" and not item.copy_failed:
+            item.copy_failed = True
+            print(f"Opus codec copy failed mid-track, falling back to PCM: {item.source}")
+    ended_at, player.ended_at = player.ended_at, None
+
+    source = _audio_cache.open_source(item, offset) if seek else None
+    if source is None:
+        refresh = not seek and player.resume_attempts > 1
+        if refresh or not _queue_item_stream_is_fresh(item):
+            try:
+                info = await _resolve_track(item.source, fresh=refresh)
+            except Exception as e:
+                print(f"Cannot restart {item.source}: {e}")
+                return False
+            _apply_resolved_stream(item, info)
+        try:
+            source = _make_item_source(item, offset)
+        except Exception as e:
+            print(f"Cannot restart {item.source}: {e}")
+            return False
+    if player.current is not item or player.ctx is None:
+        source.cleanup()  # skipped or stopped while re-resolving
+        return True
+    _play_item(player, item, source, offset)
+    if ended_at is not None and not seek:
+        _metrics.observe("bot_track_gap_seconds", time.monotonic() - ended_at)
+    # The next track's pre-spawn time depends on where this one now ends
+    _cancel_lookahead(player)
+    player.lookahead_task = bot.loop.create_task(_lookahead_next_track(player, item))
+    return True
+
+
+def _report_failures(outbox: _ChannelOutbox, failures: list[tuple[str, Exception]]) -> None:
+    if not failures:
+        return
+    if len(failures) == 1:
+        source, err = failures[0]
+        text = f"Không lấy được info bài: **{source}**\n```{err}```"
+    else:
+        lines = [f"- **{source}**" for source, _ in failures[:MAX_REPORTED_FAILURES]]
+        if len(failures) > MAX_REPORTED_FAILURES:
+            lines.append(f"- ... và {len(failures) - MAX_REPORTED_FAILURES} bài khác")
+        text = f"Không lấy được info {len(failures)} bài (đã bỏ qua):\n" + "\n".join(lines)
+        text += f"\n```{failures[-1][1]}```"
+    outbox.notice(text[:2000])
+
+
+def _item_state(item: QueueItem) -> tuple:
+    return (item.source, item.requester_id, item.title, item.web_url, item.duration)
+
+
+def _item_from_state(state: tuple) -> QueueItem:
+    source, requester_id, title, web_url, duration = state
+    item = QueueItem(source, requester_id, title=title, web_url=web_url)
+    item.duration = duration
+    return item
+
+
+class _PlayerSnapshots:
+    """Periodic snapshots of every guild's player state in SQLite, restored on startup.
+
+    One row per guild holds a marshal-encoded tuple (repeat mode, channels, the
+    playing track and its position, queue, history). Rows are only rewritten
+    when their bytes changed. A row is deleted when this process dropped the
+    guild's player or the bot left the guild; rows of guilds that were
+    unavailable at startup are kept (in `unrestored`) until the guild comes
+    back. The queue is encoded separately and reused until it is edited, so a
+    playing guild with a long queue only re-encodes its position.
+    """
+
+    FORMAT = 1
+
+    def __init__(self, db_path: Optional[str]):
+        self._db: Optional[sqlite3.Connection] = None
+        self._saved: dict[int, bytes] = {}  # guild id -> blob last written by this process
+        self._removed: set[int] = set()  # guilds the bot left: rows to delete
+        self.unrestored: dict[int, tuple] = {}  # loaded states whose guild wasn't available yet
+        self._queues: dict[int, tuple[tuple[int, int], bytes]] = {}  # guild id -> (queue/meta version, encoded queue)
+        self._writing = False
+        self._db_path = db_path
+
+    def open(self) -> None:
+        """Open the database (once; main process only, like the other disk-backed caches)."""
+        db_path, self._db_path = self._db_path, None
+        if not db_path:
+            return
+        try:
+            self._open_db(db_path)
+        except Exception as e:
+            print(f"Player snapshots disabled ({db_path}): {e}")
+            self._db = None
+
+    @property
+    def enabled(self) -> bool:
+        return self._db is not None
+
+    def _open_db(self, db_path: str) -> None:
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS players (guild_id INTEGER PRIMARY KEY, state BLOB NOT NULL, saved_at REAL)")
+        self._db = db
+
+    def load(self) -> dict[int, tuple]:
+        """Stored snapshots by guild id (blocking; call off the event loop)."""
+        states: dict[int, tuple] = {}
+        for guild_id, blob in self._db.execute("SELECT guild_id, state FROM players").fetchall():
+            try:
+                state = marshal.loads(blob)
+                if not isinstance(state, tuple) or len(state) != 8 or state[0] != self.FORMAT:
+                    continue
+                states[guild_id] = (*state[:6], marshal.loads(state[6]), state[7])
+            except (EOFError, ValueError, TypeError, IndexError):
+                print(f"Skipping unreadable player snapshot of guild {guild_id}")
+        return states
+
+    def forget(self, guild_id: int) -> None:
+        """Delete the guild's row on the next save (the bot left the guild)."""
+        self.unrestored.pop(guild_id, None)
+        if self._db is not None:
+            self._removed.add(guild_id)
+
+    def encode(self, player: GuildPlayer) -> bytes:
+        current = player.current
+        position = int(player.playback.elapsed) if current is not None and player.playback is not None else 0
+        ctx = player.ctx
+        text_channel_id = ctx.channel.id if ctx is not None else player.now_playing_channel
+        vc = ctx.voice_client if ctx is not None else None
+        # Only a guild that is playing gets its voice channel back after a restart
+        voice_channel_id = vc.channel.id if current is not None and vc is not None and vc.is_connected() else None
+        version = (player.queue.version, player.queue_pages.meta_version)
+        cached = self._queues.get(player.guild_id)
+        if cached is None or cached[0] != version:
+            cached = (version, marshal.dumps([_item_state(item) for item in player.queue]))
+            self._queues[player.guild_id] = cached
+        return marshal.dumps((
+            self.FORMAT,
+            player.repeat_mode,
+            text_channel_id,
+            voice_channel_id,
+            _item_state(current) if current is not None else None,
+            position,
+            cached[1],
+            [_item_state(item) for item in player.history],
+        ))
+
+    def _write(self, changed: dict[int, Optional[bytes]]) -> None:
+        now = time.time()
+        try:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO players VALUES (?, ?, ?)",
+                    [(guild_id, blob, now) for guild_id, blob in changed.items() if blob is not None],
+                )
+                self._db.executemany(
+                    "DELETE FROM players WHERE guild_id = ?",
+                    [(guild_id,) for guild_id, blob in changed.items() if blob is None],
+                )
+        except Exception as e:
+            print(f"Player snapshot write error: {e}")
+
+    async def save(self) -> None:
+        """Write the guilds whose state changed; a call while a write is running is skipped."""
+        if self._db is None or self._writing:
+            return
+        changed: dict[int, Optional[bytes]] = {}
+        for guild_id, player in list(players.items()):
+            blob = self.encode(player)
+            if self._saved.get(guild_id) != blob:
+                changed[guild_id] = blob
+        for guild_id in (self._saved.keys() | self._removed) - players.keys():
+            changed[guild_id] = None
+        self._removed.clear()
+        for guild_id in self._queues.keys() - players.keys():
+            del self._queues[guild_id]
+        if not changed:
+            return
+        self._writing = True
+        try:
+            await asyncio.to_thread(self._write, changed)
+        finally:
+            self._writing = False
+        for guild_id, blob in changed.items():
+            if blob is None:
+                self._saved.pop(guild_id, None)
+            else:
+                self._saved[guild_id] = blob
+
+
+_snapshots = _PlayerSnapshots(STATE_DB)
+
+
+class _RestoredContext:
+    """Stand-in for a command context when playback resumes from a snapshot."""
+
+    def __init__(self, guild: discord.Guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+
+async def _restore_players() -> None:
+    """Rebuild players from the last snapshot; guilds that were playing rejoin voice and resume.
+
+    Guilds that are unavailable right now keep their snapshot until
+    on_guild_available restores them.
+    """
+    _snapshots.unrestored = await asyncio.to_thread(_snapshots.load)
+    restored = resumed = 0
+    for guild_id in list(_snapshots.unrestored):
+        guild = bot.get_guild(guild_id)
+        if guild is None:
+            continue
+        try:
+            resumed += await _restore_player(guild)
+        except Exception as e:
+            print(f"Cannot restore player of guild {guild_id}: {e}")
+            _release_player(guild_id, forget=True)  # don't keep a half-restored player
+            continue
+        restored += 1
+    if restored or _snapshots.unrestored:
+        print(
+            f"Player snapshots: restored {restored} guilds, resumed playback in {resumed}, "
+            f"{len(_snapshots.unrestored)} waiting for their guild"
+        )
 
-    voice_client.play(source, after=after_play)
+
+async def _restore_player(guild: discord.Guild) -> bool:
+    """Apply the guild's pending snapshot; True if playback resumed.
+
+    The interrupted track goes back to the front of the queue and resumes
+    where the snapshot left it.
+    """
+    state = _snapshots.unrestored.pop(guild.id, None)
+    if state is None or guild.id in players:
+        return False  # already in use again: its next snapshot replaces the old one
+    _, repeat_mode, text_channel_id, voice_channel_id, current, position, queue, history = state
+    player = _get_player(guild.id)
+    player.repeat_mode = repeat_mode
+    player.now_playing_channel = text_channel_id
+    if current is not None:
+        history = history[:-1]  # the current track is re-added to history when it plays again
+        queue = [current, *queue]
+    player.history.extend(map(_item_from_state, history))
+    player.queue.extend(map(_item_from_state, queue))
+    if current is not None and position > 0:
+        player.start_at = (player.queue[0], float(position))
+
+    channel = guild.get_channel(text_channel_id) if text_channel_id else None
+    voice_channel = guild.get_channel(voice_channel_id) if voice_channel_id else None
+    if channel is None or voice_channel is None or guild.voice_client is not None:
+        return False
+    try:
+        await voice_channel.connect()
+    except Exception as e:
+        print(f"Không vào lại được voice channel ở guild {guild.id}: {e}")
+        return False
+    await play_next(_RestoredContext(guild, channel))
+    return True
+
+
+async def _run_player_snapshots() -> None:
+    try:
+        await _restore_players()
+    except Exception as e:
+        print(f"Player snapshot restore failed: {e}")  # still snapshot from here on
+    while True:
+        await asyncio.sleep(STATE_SNAPSHOT_SECONDS)
+        try:
+            await _snapshots.save()
+        except Exception as e:
+            print(f"Player snapshot failed: {e}")
 
 
 @bot.hybrid_command(name='play', aliases=['p'])
@@ -729,46 +3593,49 @@ async def play(ctx, *, query: str):
     elif ctx.voice_client.channel != channel:
         await ctx.voice_client.move_to(channel)
 
-    guild_id = ctx.guild.id
-    if guild_id not in queues:
-        queues[guild_id] = deque()
-
-    async def _ensure_lock(gid: int):
-        lock = playlist_enqueue_locks.get(gid)
-        if lock is None:
-            lock = asyncio.Lock()
-            playlist_enqueue_locks[gid] = lock
-        return lock
+    player = _get_player(ctx.guild.id)
+    if player.enqueue_lock is None:
+        player.enqueue_lock = asyncio.Lock()
 
     async def _enqueue_playlist_in_background():
-        lock = await _ensure_lock(guild_id)
-        async with lock:
+        async with player.enqueue_lock:
+            added = 0
             try:
-                entries = await _extract_playlist_entries(query, MAX_PLAYLIST_ITEMS)
+                async with aclosing(_iter_playlist_entries(query, MAX_PLAYLIST_ITEMS)) as stream:
+                    async for watch_url, title in stream:
+                        if ctx.voice_client is None:
+                            break  # stopped/disconnected while importing
+                        _search_index.add_title(title, watch_url)
+                        _search_index.remember(ctx.guild.id, title)
+                        player.queue.append(
+                            _make_queue_item(
+                                source=watch_url,
+                                requester_id=ctx.author.id,
+                                title=title,
+                                web_url=watch_url,
+                            )
+                        )
+                        added += 1
+                        # Start playing as soon as the first entry arrives.
+                        if added == 1 and not ctx.voice_client.is_playing():
+                            await play_next(ctx)
             except Exception as e:
-                await ctx.send(f"Không lấy được playlist/mix.\n```{e}```")
-                return
-
-            if not entries:
+                if added == 0:
+                    await ctx.send(f"Không lấy được playlist/mix.\n```{e}```")
+                    return
+                await ctx.send(f"Lỗi khi đang lấy playlist/mix, dừng ở **{added}** bài.\n```{e}```")
+
+            if added == 0:
+                if ctx.voice_client is None:
+                    return
                 it = _make_queue_item(source=query, requester_id=ctx.author.id)
-                queues[guild_id].append(it)
-                bot.loop.create_task(_resolve_queue_item_metadata(it))
+                player.queue.append(it)
+                _prefetcher.schedule(ctx.guild.id, it, PREFETCH_NEXT if len(player.queue) == 1 else PREFETCH_BACKGROUND)
                 await ctx.send("Playlist/mix không có entry playable, đã thêm link gốc vào queue.")
+                if not ctx.voice_client.is_playing():
+                    await play_next(ctx)
             else:
-                for watch_url, title in entries:
-                    queues[guild_id].append(
-                        _make_queue_item(
-                            source=watch_url,
-                            requester_id=ctx.author.id,
-                            title=title,
-                            web_url=watch_url,
-                        )
-                    )
-                await ctx.send(f"Đã thêm **{len(entries)}** bài từ playlist/mix vào queue.")
-
-            # If bot is idle, start playing after the playlist is enqueued.
-            if ctx.voice_client and not ctx.voice_client.is_playing():
-                await play_next(ctx)
+                await ctx.send(f"Đã thêm **{added}** bài từ playlist/mix vào queue.")
 
     # Playlist/mix extraction can be slow; do it in the background for faster response.
     if _is_youtube_playlist_or_mix(query):
@@ -776,20 +3643,46 @@ async def play(ctx, *, query: str):
         bot.loop.create_task(_enqueue_playlist_in_background())
         return
 
+    indexed = None if query.startswith("http") else _search_index.peek(query)
+    if not query.startswith("http"):
+        _search_index.remember(ctx.guild.id, query)
     it = _make_queue_item(
         source=query,
         requester_id=ctx.author.id,
-        title=None,
+        title=indexed["title"] if indexed else None,
         web_url=query if query.startswith("http") else None,
     )
-    queues[guild_id].append(it)
+    player.queue.append(it)
     # Prefetch metadata in background (helps /queue and may speed up immediate playback)
-    bot.loop.create_task(_resolve_queue_item_metadata(it))
+    _prefetcher.schedule(ctx.guild.id, it, PREFETCH_NEXT if len(player.queue) == 1 else PREFETCH_BACKGROUND)
 
-    if not ctx.voice_client.is_playing():
-        await play_next(ctx)
-    else:
+    vc = ctx.voice_client
+    if vc.is_playing() or vc.is_paused():
         await ctx.send(f'Đã thêm vào queue: **{query}**')
+        return
+    # This reply answers the (deferred) command; the now-playing text then edits it in place.
+    message = await ctx.send(f"▶️ Đang chuẩn bị phát: **{query}**")
+    _outbox(ctx.channel, ctx.guild.id).adopt("now_playing", message, replace=True)
+    await play_next(ctx)
+
+
+@play.autocomplete("query")
+async def play_query_autocomplete(interaction: discord.Interaction, current: str) -> list[app_commands.Choice[str]]:
+    if current.strip().startswith("http"):
+        return []
+    choices = []
+    if interaction.guild_id is None:
+        return []
+    for key, entry in _search_index.complete(current, interaction.guild_id):
+        label = entry["title"]
+        duration = entry["duration"]
+        if isinstance(duration, (int, float)):
+            minutes, seconds = divmod(int(duration), 60)
+            label = f"{label} ({minutes}:{seconds:02d})"
+        # Searched text resolves through the index; title-only entries go to the video itself.
+        value = key if entry["searched"] and len(key) <= 100 else f"https://www.youtube.com/watch?v={entry['video_id']}"
+        choices.append(app_commands.Choice(name=label[:100], value=value))
+    return choices
 
 
 @bot.hybrid_command(name='skip')
@@ -797,11 +3690,11 @@ async def skip(ctx):
     if not ctx.voice_client:
         return await ctx.send("Bot không ở trong voice channel.")
     if ctx.voice_client.is_playing():
-        guild_id = ctx.guild.id
-        skipped_title = current_song.get(guild_id)
-        skipped_url = current_song_url.get(guild_id)
-        end_reasons[guild_id] = "skip"
-        ctx.voice_client.stop()
+        player = _get_player(ctx.guild.id)
+        skipped = player.current
+        skipped_title = skipped.title if skipped is not None else None
+        skipped_url = skipped.web_url if skipped is not None else None
+        _post_player_event(ctx.guild.id, "skip", skipped)
         if skipped_title and skipped_url:
             await ctx.send(f"Đã skip: **{skipped_title}**\n{skipped_url}")
         elif skipped_title:
@@ -815,11 +3708,10 @@ async def skip(ctx):
 @bot.hybrid_command(name='stop')
 async def stop(ctx):
     if ctx.voice_client:
-        end_reasons[ctx.guild.id] = "stop"
+        player = _get_player(ctx.guild.id)
+        player.queue.clear()
+        _release_player(ctx.guild.id)
         await ctx.voice_client.disconnect()
-        queues[ctx.guild.id].clear()
-        current_song[ctx.guild.id] = None
-        current_song_url[ctx.guild.id] = None
         await ctx.send("Đã dừng và disconnect.")
     else:
         await ctx.send("Bot không ở trong voice channel.")
@@ -828,20 +3720,148 @@ async def stop(ctx):
 @bot.hybrid_command(name='queue', aliases=['q'])
 async def show_queue(ctx):
     guild_id = ctx.guild.id
-    if guild_id not in queues or not queues[guild_id]:
+    player = players.get(guild_id)
+    if player is None or not player.queue:
         return await ctx.send("Queue đang trống.")
     
     view = QueueView(guild_id=guild_id, author_id=ctx.author.id, page_size=QUEUE_PAGE_SIZE)
     embed = _build_queue_embed(guild_id, page=0, page_size=QUEUE_PAGE_SIZE)
-    await ctx.send(embed=embed, view=view)
+    message = await ctx.send(embed=embed, view=view)
+    view.watch(message, embed)
+
+
+def _refresh_lookahead(player: GuildPlayer, next_before: Optional[QueueItem]) -> None:
+    """Restart the look-ahead if a queue edit changed which track plays next."""
+    if player.current is None or _peek_next_item(player) is next_before:
+        return
+    _cancel_lookahead(player)
+    player.lookahead_task = bot.loop.create_task(_lookahead_next_track(player, player.current))
+
+
+def _item_title(item: QueueItem) -> str:
+    return item.title or item.source
+
+
+@bot.hybrid_command(name="remove", aliases=["rm"])
+@app_commands.describe(position="Vị trí bài trong /queue (bắt đầu từ 1)")
+async def remove_cmd(ctx, position: int):
+    """Xóa một bài khỏi queue."""
+    player = players.get(ctx.guild.id)
+    if player is None or not player.queue:
+        return await ctx.send("Queue đang trống.")
+    if not 1 <= position <= len(player.queue):
+        return await ctx.send(f"Vị trí không hợp lệ (1-{len(player.queue)}).")
+    next_before = _peek_next_item(player)
+    item = player.queue.pop(position - 1)
+    _prefetcher.discard(item)
+    _refresh_lookahead(player, next_before)
+    await ctx.send(f"Đã xóa khỏi queue: **{_item_title(item)}**")
+
+
+@bot.hybrid_command(name="move", aliases=["mv"])
+@app_commands.describe(source="Vị trí hiện tại của bài", target="Vị trí mới")
+async def move_cmd(ctx, source: int, target: int):
+    """Đổi vị trí một bài trong queue."""
+    player = players.get(ctx.guild.id)
+    if player is None or not player.queue:
+        return await ctx.send("Queue đang trống.")
+    total = len(player.queue)
+    if not (1 <= source <= total and 1 <= target <= total):
+        return await ctx.send(f"Vị trí không hợp lệ (1-{total}).")
+    next_before = _peek_next_item(player)
+    player.queue.move(source - 1, target - 1)
+    _refresh_lookahead(player, next_before)
+    await ctx.send(f"Đã chuyển **{_item_title(player.queue[target - 1])}** tới vị trí #{target}.")
+
+
+@bot.hybrid_command(name="skipto")
+@app_commands.describe(position="Vị trí bài trong /queue muốn phát ngay")
+async def skipto_cmd(ctx, position: int):
+    """Bỏ qua tới một bài trong queue."""
+    vc = ctx.voice_client
+    if not vc:
+        return await ctx.send("Bot không ở trong voice channel.")
+    player = players.get(ctx.guild.id)
+    if player is None or not player.queue:
+        return await ctx.send("Queue đang trống.")
+    if not 1 <= position <= len(player.queue):
+        return await ctx.send(f"Vị trí không hợp lệ (1-{len(player.queue)}).")
+    next_before = _peek_next_item(player)
+    skipped = player.queue.delete_front(position - 1)
+    if player.repeat_mode == "all":
+        player.queue.extend(skipped)  # still part of the loop, just later
+    else:
+        for item in skipped:
+            _prefetcher.discard(item)
+    _refresh_lookahead(player, next_before)
+    target = player.queue[0]
+    if vc.is_playing() or vc.is_paused():
+        _post_player_event(ctx.guild.id, "skip", player.current)
+    else:
+        await play_next(ctx)
+    await ctx.send(f"Đã chuyển tới bài #{position}: **{_item_title(target)}**")
+
+
+def _parse_timestamp(text: str) -> Optional[float]:
+    """Seconds from "90", "1:30" or "1:02:03"; None if malformed."""
+    parts = text.strip().split(":")
+    if len(parts) > 3:
+        return None
+    seconds = 0.0
+    for part in parts:
+        try:
+            value = float(part)
+        except ValueError:
+            return None
+        if value < 0 or not math.isfinite(value):
+            return None
+        seconds = seconds * 60 + value
+    return seconds
+
+
+def _format_timestamp(seconds: float) -> str:
+    minutes, secs = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+
+@bot.hybrid_command(name="seek")
+@app_commands.describe(position="Vị trí muốn tua tới, ví dụ 90, 1:30 hoặc 1:02:03")
+async def seek_cmd(ctx, position: str):
+    """Tua bài đang phát tới một vị trí."""
+    vc = ctx.voice_client
+    player = players.get(ctx.guild.id)
+    if vc is None or player is None or player.current is None or not (vc.is_playing() or vc.is_paused()):
+        return await ctx.send("Không có bài nào đang phát.")
+    seconds = _parse_timestamp(position)
+    if seconds is None:
+        return await ctx.send("Vị trí không hợp lệ. Dùng số giây hoặc `phút:giây`, ví dụ `1:30`.")
+    item = player.current
+    if isinstance(item.duration, (int, float)) and seconds >= item.duration:
+        return await ctx.send(f"Bài này chỉ dài **{_format_timestamp(item.duration)}**.")
+    _post_player_event(ctx.guild.id, "seek", (item, seconds))
+    await ctx.send(f"Đã tua **{_item_title(item)}** tới **{_format_timestamp(seconds)}**.")
+
+
+@bot.hybrid_command(name="shuffle")
+async def shuffle_cmd(ctx):
+    """Xáo trộn thứ tự queue."""
+    player = players.get(ctx.guild.id)
+    if player is None or len(player.queue) < 2:
+        return await ctx.send("Queue không đủ bài để xáo trộn.")
+    next_before = _peek_next_item(player)
+    player.queue.shuffle()
+    _refresh_lookahead(player, next_before)
+    await ctx.send(f"Đã xáo trộn **{len(player.queue)}** bài trong queue.")
 
 
 @bot.hybrid_command(name='nowplaying', aliases=['np'])
 async def now_playing(ctx):
     guild_id = ctx.guild.id
-    if guild_id in current_song and current_song[guild_id]:
-        title = current_song[guild_id]
-        web_url = current_song_url.get(guild_id)
+    player = players.get(guild_id)
+    if player is not None and player.current is not None:
+        title = player.current.title or "Unknown title"
+        web_url = player.current.web_url
         mode = _get_repeat_mode(guild_id)
         mode_text = {"off": "Tắt", "one": "1 bài", "all": "Tất cả"}.get(mode, mode)
         if web_url:
@@ -866,7 +3886,7 @@ async def repeat_cmd(ctx, mode: Optional[str] = None):
     if mode_value not in ("off", "one", "all"):
         return await ctx.send("Mode không hợp lệ. Dùng: `off` / `one` / `all`.")
 
-    repeat_mode[guild_id] = mode_value
+    _get_player(guild_id).repeat_mode = mode_value
     mode_text = {"off": "Tắt", "one": "1 bài", "all": "Tất cả"}.get(mode_value, mode_value)
     await ctx.send(f"Đã set repeat: **{mode_text}**")
 
@@ -874,23 +3894,256 @@ async def repeat_cmd(ctx, mode: Optional[str] = None):
 @bot.hybrid_command(name="loop")
 async def loop_cmd(ctx):
     """Toggle loop queue (repeat all)."""
-    guild_id = ctx.guild.id
-    cur = _get_repeat_mode(guild_id)
-    repeat_mode[guild_id] = "off" if cur == "all" else "all"
-    mode_text = "Tắt" if repeat_mode[guild_id] == "off" else "Tất cả"
+    player = _get_player(ctx.guild.id)
+    player.repeat_mode = "off" if player.repeat_mode == "all" else "all"
+    mode_text = "Tắt" if player.repeat_mode == "off" else "Tất cả"
     await ctx.send(f"Loop queue: **{mode_text}**")
 
-@app.route('/')
-def home():
-    return "Bot is alive! 🎶"
 
-def run_flask():
+@bot.hybrid_group(name="debug")
+async def debug_group(ctx):
+    """Công cụ chẩn đoán (chỉ owner)."""
+    if ctx.invoked_subcommand is None:
+        await ctx.send("Dùng `debug trace`.", ephemeral=True)
+
+
+def _format_trace(r: dict) -> str:
+    def ms(v):
+        return "-" if v is None else f"{v:.0f}"
+
+    spans = " ".join(f"{k}={v:.0f}" for k, v in sorted(r["spans"].items(), key=lambda kv: -kv[1]))
+    head = (
+        f"{ms(r['to_audio_ms']):>6}ms audio, pkt {ms(r['first_packet_ms'])}, msg {ms(r['total_ms'])} | "
+        f"{r['path']}/{r['resolve_cache'] or '-'} retries={r['retries']} {r['reason']} guild={r['guild_id']}"
+    )
+    return f"{head}\n        {spans or '(no spans)'}\n        {(r['title'] or r['source'] or '')[:80]}"
+
+
+@debug_group.command(name="trace")
+@app_commands.describe(count="Số transition chậm nhất (theo thời gian tới lúc phát audio)")
+async def debug_trace(ctx, count: int = 5):
+    """Các lần chuyển bài chậm nhất gần đây."""
+    if not await bot.is_owner(ctx.author):
+        return await ctx.send("Lệnh này chỉ dành cho owner của bot.", ephemeral=True)
+    slowest = _tracer.slowest(max(1, min(count, 15)))
+    if not slowest:
+        return await ctx.send("Chưa có trace nào.", ephemeral=True)
+    header = f"{len(_tracer.recent)} trace gần đây (sample {_tracer.sample_rate:g}), chậm nhất:\n"
+    body = ""
+    for r in slowest:
+        entry = _format_trace(r) + "\n"
+        if len(header) + len(body) + len(entry) > 1900:
+            break
+        body += entry
+    await ctx.send(f"{header}```\n{body}```", ephemeral=True)
+
+LOOP_LAG_SAMPLE_INTERVAL = 0.5
+
+
+async def _sample_loop_lag() -> None:
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_SAMPLE_INTERVAL)
+        lag = time.perf_counter() - started - LOOP_LAG_SAMPLE_INTERVAL
+        _metrics.observe("bot_event_loop_lag_seconds", max(0.0, lag))
+
+
+class _LoopWatchdog:
+    """Opt-in detector for code that blocks the event loop.
+
+    A loop task bumps a heartbeat; a daemon thread checks it and, when it goes
+    stale for longer than the threshold, prints the loop thread's current stack
+    (via sys._current_frames) so the blocking call shows up in the logs.
+    One report per stall, plus its total length once the loop recovers.
+    """
+
+    def __init__(self, threshold: float):
+        self.threshold = threshold
+        self.interval = max(0.01, threshold / 4)
+        self.stalls = 0
+        self._beat = time.monotonic()
+        self._loop_thread_id: Optional[int] = None
+
+    async def run(self) -> None:
+        self._loop_thread_id = threading.get_ident()
+        Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        while True:
+            self._beat = time.monotonic()
+            await asyncio.sleep(self.interval)
+
+    def _watch(self) -> None:
+        reported: Optional[float] = None  # heartbeat of the stall already reported
+        while True:
+            time.sleep(self.interval)
+            beat = self._beat
+            blocked = time.monotonic() - beat - self.interval
+            if beat != reported and reported is not None:
+                print(f"Event loop unblocked after ~{(beat - reported - self.interval) * 1000:.0f}ms")
+                reported = None
+            if blocked < self.threshold or beat == reported:
+                continue
+            reported = beat
+            self.stalls += 1
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame is not None else "  (loop thread not found)\n"
+            print(f"Event loop blocked for {blocked * 1000:.0f}ms; loop thread is at:\n{stack}", end="")
+
+
+_loop_lag_task: Optional[asyncio.Task] = None
+_watchdog = _LoopWatchdog(LOOP_WATCHDOG_MS / 1000) if LOOP_WATCHDOG_MS > 0 else None
+_watchdog_task: Optional[asyncio.Task] = None
+
+
+@bot.event
+async def setup_hook():
+    global _loop_lag_task, _watchdog_task
+    # Disk-backed state is opened here rather than at import: extraction worker
+    # processes (DISCORD_EXTRACT_BACKEND=process) import this module as well.
+    _resolution_cache.open()
+    _search_index.warm(_resolution_cache)  # whatever the cache loaded from disk
+    _audio_cache.open()
+    _snapshots.open()
+    _loop_lag_task = bot.loop.create_task(_sample_loop_lag())
+    if _watchdog is not None:
+        _watchdog_task = bot.loop.create_task(_watchdog.run())
+        print(f"Loop watchdog: reporting blocks over {LOOP_WATCHDOG_MS:.0f}ms")
+    await _start_http_server()
+    # Buttons are dispatched by custom_id, also on messages sent before a restart
+    bot.add_dynamic_items(NowPlayingButton, QueueButton)
+
+
+@bot.before_invoke
+async def _start_handler_timer(ctx):
+    ctx.handler_started = time.perf_counter()
+
+
+@bot.after_invoke
+async def _record_handler_time(ctx):
+    started = getattr(ctx, "handler_started", None)
+    if started is not None and ctx.command is not None:
+        _metrics.observe("bot_handler_seconds", time.perf_counter() - started, handler=ctx.command.qualified_name)
+
+
+@_metrics.collector
+def _collect_runtime_metrics() -> None:
+    rc = _resolution_cache
+    for result, n in (("hit", rc.hits), ("stale", rc.stale), ("miss", rc.misses)):
+        _metrics.set("bot_cache_requests_total", n, cache="resolve", result=result)
+    si = _search_index
+    _metrics.set("bot_cache_requests_total", si.hits, cache="search", result="hit")
+    _metrics.set("bot_cache_requests_total", si.lookups - si.hits, cache="search", result="miss")
+    _metrics.set("bot_cache_requests_total", _QueuePages.hits, cache="queue_page", result="hit")
+    _metrics.set("bot_cache_requests_total", _QueuePages.misses, cache="queue_page", result="miss")
+    if _audio_cache.enabled:
+        _metrics.set("bot_cache_requests_total", _audio_cache.hits, cache="audio", result="hit")
+        _metrics.set("bot_cache_requests_total", _audio_cache.misses, cache="audio", result="miss")
+    _metrics.set("bot_resolve_coalesced_total", _inflight_hits)
+    if _watchdog is not None:
+        _metrics.set("bot_event_loop_stalls_total", _watchdog.stalls)
+
+    _metrics.clear("bot_queue_depth")
+    playing = 0
+    for guild_id, player in list(players.items()):
+        _metrics.set("bot_queue_depth", len(player.queue), guild=guild_id)
+        if player.current is not None:
+            playing += 1
+    _metrics.set("bot_guilds_playing", playing)
+
+    ffmpeg = 0
+    for source in list(_ffmpeg_sources):
+        process = getattr(source, "_process", None)
+        if process is not None and process.poll() is None:
+            ffmpeg += 1
+    _metrics.set("bot_ffmpeg_processes", ffmpeg + _audio_cache.fetching)
+
+    pool = _ydl_pool
+    _metrics.set("bot_extract_workers", min(pool.in_use, pool.max_workers), state="busy")
+    _metrics.set("bot_extract_workers", max(0, pool.in_use - pool.max_workers), state="queued")
+    _metrics.set("bot_extract_workers", pool.max_workers, state="max")
+    if math.isfinite(bot.latency):
+        _metrics.set("bot_gateway_latency_seconds", bot.latency)
+
+
+# Keep-alive / monitoring HTTP server, served from the bot's own event loop so
+# handlers read player state without locks or a second runtime.
+routes = web.RouteTableDef()
+_process_started = time.time()
+
+
+@routes.get('/')
+async def home(request: web.Request) -> web.Response:
+    return web.Response(text="Bot is alive! 🎶")
+
+
+@routes.get('/metrics')
+async def metrics(request: web.Request) -> web.Response:
+    return web.Response(
+        body=_metrics.render().encode(),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@routes.get('/status')
+async def status(request: web.Request) -> web.Response:
+    guilds = []
+    for guild_id, player in list(players.items()):
+        guild = bot.get_guild(guild_id)
+        vc = guild.voice_client if guild is not None else None
+        item = player.current
+        now_playing = None
+        if item is not None:
+            now_playing = {
+                "title": item.title or item.source,
+                "url": item.web_url,
+                "duration": item.duration,
+                "elapsed": round(player.playback.elapsed, 1) if player.playback is not None else None,
+                "requester_id": item.requester_id,
+            }
+        guilds.append({
+            "id": guild_id,
+            "name": guild.name if guild is not None else None,
+            "connected": vc is not None and vc.is_connected(),
+            "paused": vc is not None and vc.is_paused(),
+            "queue_length": len(player.queue),
+            "repeat": player.repeat_mode,
+            "now_playing": now_playing,
+        })
+    latency = bot.latency
+    return web.json_response({
+        "user": str(bot.user) if bot.user else None,
+        "ready": bot.is_ready(),
+        "uptime_seconds": round(time.time() - _process_started),
+        "gateway_latency_ms": round(latency * 1000, 1) if math.isfinite(latency) else None,
+        "guilds": guilds,
+    })
+
+
+app = web.Application()
+app.add_routes(routes)
+_http_runner: Optional[web.AppRunner] = None
+
+
+async def _start_http_server() -> None:
+    global _http_runner
+    if _http_runner is not None:
+        return
     port = int(os.environ.get("PORT", 10000))  # Render dùng PORT env var
-    app.run(host='0.0.0.0', port=port)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host='0.0.0.0', port=port).start()
+    except OSError as e:
+        print(f"HTTP server không khởi động được trên port {port}: {e}")
+        await runner.cleanup()
+        return
+    _http_runner = runner
+    print(f"HTTP server: http://0.0.0.0:{port} (/, /metrics, /status)")
 
-# Chạy Flask trong thread riêng
-flask_thread = Thread(target=run_flask)
-flask_thread.start()
 
+_import_seconds = time.perf_counter() - _boot_started
 
-bot.run(TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    # Guarded so extraction worker processes (spawn) can import this module
+    # without starting a second bot.
+    print(f"Startup: đã load module sau {_import_seconds:.2f}s")
+    bot.run(TOKEN)
\ No newline at end of file
@@ -0,0 +1,104 @@
+import struct
+
+import bot
+
+
+def _ogg_page(packets, granule, seq, flag=0, continued=False):
+    """One Ogg page; continued=True leaves the last packet open for the next page."""
+    segments, body = b"", b""
+    for i, packet in enumerate(packets):
+        n = len(packet)
+        while n >= 255:
+            segments += b"\xff"
+            n -= 255
+        if not (continued and i == len(packets) - 1):
+            segments += bytes([n])
+        body += packet
+    header = struct.pack("<4sBBqIIIB", b"OggS", 0, flag, granule, 1, seq, 0, len(segments))
+    return header + segments + body
+
+
+def _headers():
+    return _ogg_page([b"OpusHead" + b"\0" * 11], 0, 0, flag=2) + _ogg_page([b"OpusTags" + b"\0" * 8], 0, 1)
+
+
+def _write_ogg(path, n):
+    """n 20ms packets, one per page, after the OpusHead/OpusTags pages."""
+    data = _headers()
+    for i in range(n):
+        data += _ogg_page([b"pkt%04d" % i + b"x" * 100], (i + 1) * 960, i + 2)
+    path.write_bytes(data)
+
+
+def test_mapped_opus_plays_packets_in_order(tmp_path):
+    path = tmp_path / "track.opus"
+    _write_ogg(path, 100)
+
+    source = bot._MappedOpusAudio(str(path))
+    assert source.is_opus()
+    assert source.duration == 2.0
+    packets = []
+    while packet := source.read():
+        packets.append(packet[:7])
+    assert packets == [b"pkt%04d" % i for i in range(100)]  # header packets skipped
+    source.cleanup()
+    assert source.read() == b""  # reading after cleanup ends the track
+
+
+def test_mapped_opus_truncated_file_ends_track(tmp_path):
+    path = tmp_path / "track.opus"
+    _write_ogg(path, 10)
+    path.write_bytes(path.read_bytes()[:-50])
+
+    source = bot._MappedOpusAudio(str(path))
+    packets = []
+    while packet := source.read():
+        packets.append(packet)
+    assert [packet[:7] for packet in packets[:9]] == [b"pkt%04d" % i for i in range(9)]
+    assert len(packets) <= 10  # at most the cut-off packet, then the end of the track
+    source.cleanup()
+
+
+def test_mapped_opus_seek(tmp_path):
+    path = tmp_path / "track.opus"
+    _write_ogg(path, 100)
+
+    # The page holding 1.0s is the one whose granule (end of its last packet) reaches 48000
+    source = bot._MappedOpusAudio(str(path), 1.0)
+    assert source.read().startswith(b"pkt0049")
+    assert source.read().startswith(b"pkt0050")
+    source.cleanup()
+
+    source = bot._MappedOpusAudio(str(path), 99)
+    assert source.read() == b""
+    source.cleanup()
+
+
+def test_mapped_opus_seek_skips_continued_packet(tmp_path):
+    path = tmp_path / "track.opus"
+    long_packet = b"L" * 300  # split across two pages
+    data = _headers()
+    data += _ogg_page([b"first", long_packet[:255]], 960, 2, continued=True)
+    data += _ogg_page([long_packet[255:], b"after"], 2 * 960, 3, flag=1)
+    data += _ogg_page([b"last"], 3 * 960, 4)
+    path.write_bytes(data)
+
+    source = bot._MappedOpusAudio(str(path), 0.03)
+    assert source.read() == b"after"  # not the tail of the split packet
+    assert source.read() == b"last"
+    source.cleanup()
+
+    source = bot._MappedOpusAudio(str(path))
+    assert [source.read() for _ in range(4)] == [b"first", long_packet, b"after", b"last"]
+    source.cleanup()
+
+
+def test_parse_timestamp():
+    assert bot._parse_timestamp("90") == 90
+    assert bot._parse_timestamp(" 1:30 ") == 90
+    assert bot._parse_timestamp("1:02:03") == 3723
+    assert bot._parse_timestamp("1.5") == 1.5
+    for bad in ("x", "-1", "1:-2", "1:2:3:4", "nan", "inf", ""):
+        assert bot._parse_timestamp(bad) is None
+    assert bot._format_timestamp(3723) == "1:02:03"
+    assert bot._format_timestamp(90.7) == "1:30"
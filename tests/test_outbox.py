@@ -0,0 +1,188 @@
+import asyncio
+
+import discord
+import pytest
+
+import bot
+
+
+class _Message:
+    def __init__(self, channel, message_id, content):
+        self.channel = channel
+        self.id = message_id
+        self.content = content
+
+    async def edit(self, content=None, view=None):
+        if self.id in self.channel.deleted:
+            raise discord.NotFound(_Response(404), "Unknown Message")
+        self.channel.log.append(("edit", self.id, content))
+        self.content = content
+
+    async def delete(self):
+        self.channel.deleted.add(self.id)
+        self.channel.log.append(("delete", self.id))
+
+
+class _Response:
+    def __init__(self, status):
+        self.status = status
+        self.reason = "test"
+
+
+class _Channel:
+    def __init__(self):
+        self.id = 1
+        self.log = []
+        self.deleted = set()
+        self.last_message_id = None
+        self._ids = 0
+
+    async def send(self, content=None, view=None):
+        self._ids += 1
+        self.last_message_id = self._ids
+        self.log.append(("send", self._ids, content))
+        return _Message(self, self._ids, content)
+
+
+@pytest.fixture
+def run(monkeypatch):
+    monkeypatch.setattr(bot, "MESSAGE_DEBOUNCE_SECONDS", 0.01)
+
+    def run(coro):
+        async def main():
+            monkeypatch.setattr(bot.bot, "loop", asyncio.get_running_loop())
+            return await coro()
+        return asyncio.run(main())
+    return run
+
+
+async def _drain(outbox):
+    while outbox.task is not None and not outbox.task.done():
+        await outbox.task
+    await asyncio.sleep(0)
+
+
+def test_updates_within_the_debounce_collapse(run):
+    channel = _Channel()
+
+    async def scenario():
+        outbox = bot._ChannelOutbox(channel, 1)
+        for n in range(5):
+            outbox.update("now_playing", f"text {n}")
+        await _drain(outbox)
+        outbox.update("now_playing", "text 5")
+        outbox.update("now_playing", "text 5")
+        await _drain(outbox)
+        outbox.update("now_playing", "text 5")  # unchanged: no edit
+        await _drain(outbox)
+
+    run(scenario)
+    assert channel.log == [("send", 1, "text 4"), ("edit", 1, "text 5")]
+
+
+def test_notices_are_batched_and_split_at_2000_chars(run):
+    channel = _Channel()
+
+    async def scenario():
+        outbox = bot._ChannelOutbox(channel, 1)
+        outbox.notice("a")
+        outbox.notice("b")
+        await _drain(outbox)
+        outbox.notice("x" * 1500)
+        outbox.notice("y" * 1500)
+        await _drain(outbox)
+
+    run(scenario)
+    assert channel.log[0] == ("send", 1, "a\nb")
+    assert [len(content) for _, _, content in channel.log[1:]] == [1500, 1500]
+
+
+def test_repost_moves_the_message_to_the_bottom(run):
+    channel = _Channel()
+
+    async def scenario():
+        outbox = bot._ChannelOutbox(channel, 1)
+        outbox.update("now_playing", "first", repost=True)
+        await _drain(outbox)
+        outbox.update("now_playing", "second", repost=True)  # still the last message: edit
+        await _drain(outbox)
+        await channel.send("someone else")
+        outbox.update("now_playing", "third", repost=True)
+        await _drain(outbox)
+        await asyncio.sleep(0)  # the delete runs in its own task
+
+    run(scenario)
+    assert channel.log == [
+        ("send", 1, "first"),
+        ("edit", 1, "second"),
+        ("send", 2, "someone else"),
+        ("delete", 1),
+        ("send", 3, "third"),
+    ]
+
+
+def test_deleted_message_is_posted_again(run):
+    channel = _Channel()
+
+    async def scenario():
+        outbox = bot._ChannelOutbox(channel, 1)
+        outbox.update("now_playing", "first")
+        await _drain(outbox)
+        channel.deleted.add(1)
+        outbox.update("now_playing", "second")
+        await _drain(outbox)
+
+    run(scenario)
+    assert channel.log == [("send", 1, "first"), ("send", 2, "second")]
+
+
+def test_on_shown_runs_after_the_message_is_sent(run):
+    channel = _Channel()
+    shown = []
+
+    async def scenario():
+        outbox = bot._ChannelOutbox(channel, 1)
+        outbox.update("now_playing", "status", on_shown=lambda: shown.append(("status", len(channel.log))))
+        outbox.update("now_playing", "playing", on_shown=lambda: shown.append(("playing", len(channel.log))))
+        assert shown == []
+        await _drain(outbox)
+        outbox.update("now_playing", "dropped", on_shown=lambda: shown.append(("dropped", len(channel.log))))
+        outbox.clear("now_playing")
+
+    run(scenario)
+    assert shown == [("status", 1), ("playing", 1), ("dropped", 1)]
+    assert channel.log[0] == ("send", 1, "playing")
+
+
+def test_adopt_with_replace_deletes_the_old_message(run):
+    channel = _Channel()
+
+    async def scenario():
+        outbox = bot._ChannelOutbox(channel, 1)
+        outbox.update("now_playing", "old")
+        await _drain(outbox)
+        reply = await channel.send("▶️ starting")
+        outbox.adopt("now_playing", reply)  # slot taken: ignored
+        outbox.adopt("now_playing", reply, replace=True)
+        outbox.update("now_playing", "playing")
+        await _drain(outbox)
+
+    run(scenario)
+    assert channel.log == [
+        ("send", 1, "old"),
+        ("send", 2, "▶️ starting"),
+        ("delete", 1),
+        ("edit", 2, "playing"),
+    ]
+
+
+def test_outboxes_are_dropped_with_their_guild(monkeypatch):
+    monkeypatch.setattr(bot, "_outboxes", {})
+    first, second, other = _Channel(), _Channel(), _Channel()
+    second.id, other.id = 2, 3
+    outbox = bot._outbox(first, 10)
+    assert bot._outbox(first, 10) is outbox
+    bot._outbox(second, 10)
+    bot._outbox(other, 20)
+    bot._release_player(10, forget=True)  # no player: outboxes still go
+    assert list(bot._outboxes) == [3]
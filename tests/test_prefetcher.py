@@ -0,0 +1,111 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def prefetcher(monkeypatch):
+    monkeypatch.setattr(bot, "_resolution_cache", bot._ResolutionCache(10))
+    prefetcher = bot._MetadataPrefetcher(concurrency=1, per_guild=1)
+    prefetcher._wakeup = asyncio.Event()  # no workers: jobs are popped by the test
+    return prefetcher
+
+
+def _item(n):
+    return bot._make_queue_item(f"https://youtu.be/{n:011d}", 1)
+
+
+def _take_all(prefetcher):
+    order = []
+    while (job := prefetcher._pop_runnable()) is not None:
+        order.append(job.key[-2:])
+        job.priority = -1  # what the worker does; keeps the guild slot logic out of this
+        prefetcher._jobs.pop(job.key)
+    return order
+
+
+def test_priority_order_and_raise(prefetcher):
+    items = [_item(n) for n in range(4)]
+    for item in items:
+        prefetcher.schedule(1, item, bot.PREFETCH_BACKGROUND)
+    prefetcher.schedule(2, items[2], bot.PREFETCH_VISIBLE)  # raised: the old heap entry goes stale
+    prefetcher.schedule(3, items[3], bot.PREFETCH_NEXT)
+    prefetcher.schedule(3, items[3], bot.PREFETCH_BACKGROUND)  # never lowered
+    prefetcher._running = {}
+    prefetcher.per_guild = 10
+    assert _take_all(prefetcher) == ["03", "02", "00", "01"]
+
+
+def test_same_track_from_two_guilds_is_one_job(prefetcher):
+    a, b = _item(1), _item(1)
+    prefetcher.schedule(1, a)
+    prefetcher.schedule(2, b)
+    prefetcher.schedule(2, b)
+    assert len(prefetcher._jobs) == 1
+    job = next(iter(prefetcher._jobs.values()))
+    assert [(g, it) for g, it in job.items] == [(1, a), (2, b)]
+
+
+def test_discard_and_cancel_guild(prefetcher):
+    a, b, c = _item(1), _item(1), _item(2)
+    prefetcher.schedule(1, a)
+    prefetcher.schedule(2, b)
+    prefetcher.schedule(1, c)
+    prefetcher.discard(a)  # guild 2 still waits for the same track
+    prefetcher.cancel_guild(1)  # drops c's job entirely
+    assert _take_all(prefetcher) == ["01"]
+    assert not prefetcher._jobs
+
+    prefetcher.schedule(1, a)
+    prefetcher.discard(a)
+    prefetcher.schedule(1, a)  # scheduled again: no longer cancelled
+    assert _take_all(prefetcher) == ["01"]
+
+
+def test_per_guild_limit_lets_other_guilds_through(prefetcher):
+    for n in range(3):
+        prefetcher.schedule(1, _item(n), bot.PREFETCH_NEXT)
+    prefetcher.schedule(2, _item(9), bot.PREFETCH_BACKGROUND)
+    prefetcher._running = {1: 1}  # guild 1 already uses its slot
+    job = prefetcher._pop_runnable()
+    assert job.guild_id == 2
+    assert len(prefetcher._heap) == 3  # guild 1's jobs were deferred, not dropped
+
+
+def test_workers_fill_in_metadata(monkeypatch):
+    monkeypatch.setattr(bot, "_resolution_cache", bot._ResolutionCache(10))
+    resolved = []
+
+    async def fake_resolve(query, trace=None, fresh=False):
+        resolved.append(query)
+        await asyncio.sleep(0)
+        return {
+            "title": "T " + query[-2:],
+            "web_url": query,
+            "duration": 100,
+            "stream_url": "https://x/videoplayback",
+            "extracted_at": 0.0,
+            "expires_at": None,
+        }
+
+    monkeypatch.setattr(bot, "_resolve_track", fake_resolve)
+
+    async def scenario():
+        monkeypatch.setattr(bot.bot, "loop", asyncio.get_running_loop())
+        prefetcher = bot._MetadataPrefetcher(concurrency=2, per_guild=1)
+        items = [_item(n) for n in range(3)] + [_item(0)]
+        for item in items:
+            prefetcher.schedule(1, item)
+        for _ in range(200):
+            if all(item.title for item in items):
+                break
+            await asyncio.sleep(0.001)
+        for worker in prefetcher._workers:
+            worker.cancel()
+        return items
+
+    items = asyncio.run(scenario())
+    assert sorted(query[-2:] for query in resolved) == ["00", "01", "02"]  # the duplicate shared a job
+    assert [item.title for item in items] == ["T 00", "T 01", "T 02", "T 00"]
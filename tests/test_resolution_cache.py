@@ -0,0 +1,66 @@
+import bot
+
+
+def _info(n):
+    return {
+        "title": f"Bài {n}",
+        "web_url": f"https://www.youtube.com/watch?v={n:011d}",
+        "stream_url": f"https://x/videoplayback?id={n}",
+        "extracted_at": 1000.0 + n,
+        "expires_at": 2000.0 + n,
+        "duration": 60 + n,
+        "acodec": "opus",
+    }
+
+
+def test_lru_eviction_and_copies():
+    cache = bot._ResolutionCache(3)
+    for n in range(3):
+        cache.put(f"q{n}", _info(n))
+    assert cache.get("q0")["title"] == "Bài 0"  # q0 is now the most recent
+    cache.put("q3", _info(3))
+    assert len(cache) == 3
+    assert cache.get("q1") is None  # least recently used
+    assert cache.get("q0") is not None
+
+    entry = cache.get("q0")
+    entry["title"] = "changed"
+    assert cache.get("q0")["title"] == "Bài 0"  # get() hands out copies
+
+
+def test_drop_stream_keeps_metadata():
+    cache = bot._ResolutionCache(3)
+    cache.put("q", _info(1))
+    cache.drop_stream("q", "https://x/videoplayback?id=2")  # not the cached URL: ignored
+    assert cache.get("q")["stream_url"] == "https://x/videoplayback?id=1"
+    cache.drop_stream("q", "https://x/videoplayback?id=1")
+    entry = cache.get("q")
+    assert entry["stream_url"] is None and entry["expires_at"] is None
+    assert entry["title"] == "Bài 1"
+
+
+def test_persisted_across_restarts(tmp_path):
+    db_path = str(tmp_path / "resolve.db")
+    cache = bot._ResolutionCache(3, db_path)
+    assert len(cache) == 0  # nothing is opened before open()
+    cache.open()
+    for n in range(5):
+        cache.put(f"q{n}", _info(n))
+    cache.get("q2")
+    cache.flush()
+    cache.put("q5", _info(5))  # never flushed
+
+    restarted = bot._ResolutionCache(3, db_path)
+    restarted.open()
+    assert len(restarted) == 3
+    assert restarted.get("q4") == _info(4)
+    assert restarted.get("q5") is None
+    assert restarted.get("q0") is None  # trimmed to max_entries on flush
+
+
+def test_unusable_db_disables_persistence(tmp_path):
+    cache = bot._ResolutionCache(3, str(tmp_path / "missing" / "resolve.db"))
+    cache.open()
+    cache.put("q", _info(1))
+    cache.flush()
+    assert cache.get("q")["title"] == "Bài 1"
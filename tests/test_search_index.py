@@ -0,0 +1,58 @@
+import bot
+
+
+def _index():
+    index = bot._SearchIndex(100, 50)
+    index.add("lofi hip hop", "aaaaaaaaaaa", "Lofi Hip Hop Radio", 3600, searched=True)
+    index.add_title("Nơi Này Có Anh", "https://www.youtube.com/watch?v=bbbbbbbbbbb", 260)
+    index.add("Lo-Fi   HIP hop!", "aaaaaaaaaaa", None, None, searched=True)  # same key as the first
+    return index
+
+
+def test_lookup_only_matches_searched_queries():
+    index = _index()
+    assert index.lookup("LOFI hip-hop")["video_id"] == "aaaaaaaaaaa"
+    assert index.lookup("nơi này có anh") is None  # a title, never searched
+    assert index.peek("something else") is None
+    assert (index.lookups, index.hits) == (2, 1)
+
+
+def test_title_never_overrides_a_search():
+    index = _index()
+    index.add_title("lofi hip hop", "https://www.youtube.com/watch?v=ccccccccccc")
+    assert index.lookup("lofi hip hop")["video_id"] == "aaaaaaaaaaa"
+
+
+def test_complete_prefix_then_words_without_diacritics():
+    index = _index()
+    for text in ("lofi hip hop", "Nơi Này Có Anh"):
+        index.remember(1, text)
+    assert [key for key, _ in index.complete("lo", 1)] == ["lofi hip hop"]
+    assert [key for key, _ in index.complete("hip lofi", 1)] == ["lofi hip hop"]
+    assert [entry["video_id"] for _, entry in index.complete("noi nay", 1)] == ["bbbbbbbbbbb"]
+    # Empty text: the guild's most recent first
+    assert [key for key, _ in index.complete("", 1)] == ["nơi này có anh", "lofi hip hop"]
+    assert index.complete("zzz", 1) == []
+
+
+def test_complete_is_per_guild():
+    index = _index()
+    index.remember(1, "lofi hip hop")
+    index.remember(2, "Nơi Này Có Anh")
+    assert [key for key, _ in index.complete("", 1)] == ["lofi hip hop"]
+    assert [key for key, _ in index.complete("n", 2)] == ["nơi này có anh"]
+    assert index.complete("lo", 2) == []
+    assert index.complete("", 3) == []
+    index.forget_guild(1)
+    assert index.complete("", 1) == []
+
+
+def test_complete_skips_evicted_entries_and_bounds_guild_lists():
+    index = bot._SearchIndex(2, 2)
+    for n, text in enumerate(("one", "two", "three")):
+        index.add(text, f"{n:011d}", text, None, searched=True)
+        index.remember(1, text)
+    # "one" was evicted from the shared index and from the guild's recent list
+    assert [key for key, _ in index.complete("", 1)] == ["three", "two"]
+    index.add("four", "00000000004", "four", None, searched=True)  # evicts "two" from the index only
+    assert [key for key, _ in index.complete("t", 1)] == ["three"]
@@ -0,0 +1,65 @@
+import asyncio
+import marshal
+
+import bot
+
+
+class _Guild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.voice_client = None
+
+    def get_channel(self, channel_id):
+        return None
+
+
+def test_player_snapshot_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(bot, "players", {})
+    db_path = str(tmp_path / "players.db")
+
+    async def save():
+        snapshots = bot._PlayerSnapshots(db_path)
+        snapshots.open()
+        player = bot._get_player(42)
+        player.repeat_mode = "all"
+        player.now_playing_channel = 4200
+        for i in range(600):
+            item = bot._make_queue_item(f"https://youtu.be/{i:011d}", 7, title=f"Bài {i}", web_url=f"https://youtu.be/{i:011d}")
+            item.duration = 180 + i
+            player.queue.append(item)
+        player.history.append(bot._make_queue_item("https://youtu.be/old", 8, title="Cũ"))
+        await snapshots.save()
+        return [bot._item_state(item) for item in player.queue], [bot._item_state(item) for item in player.history]
+
+    queue, history = asyncio.run(save())
+    bot.players.clear()
+
+    snapshots = bot._PlayerSnapshots(db_path)
+    snapshots.open()
+    monkeypatch.setattr(bot, "_snapshots", snapshots)
+    snapshots.unrestored = snapshots.load()
+    assert set(snapshots.unrestored) == {42}
+    assert asyncio.run(bot._restore_player(_Guild(42))) is False  # no channels to rejoin
+
+    player = bot.players[42]
+    assert player.repeat_mode == "all"
+    assert player.now_playing_channel == 4200
+    assert [bot._item_state(item) for item in player.queue] == queue
+    assert [bot._item_state(item) for item in player.history] == history
+    assert player.start_at is None
+
+
+def test_unreadable_snapshot_rows_are_skipped(tmp_path):
+    snapshots = bot._PlayerSnapshots(str(tmp_path / "players.db"))
+    snapshots.open()
+    good = marshal.dumps((bot._PlayerSnapshots.FORMAT, "off", None, None, None, 0, marshal.dumps([]), []))
+    rows = [
+        (1, good),
+        (2, b"garbage"),
+        (3, marshal.dumps((bot._PlayerSnapshots.FORMAT, "off"))),
+        (4, marshal.dumps((bot._PlayerSnapshots.FORMAT, "off", None, None, None, 0, b"bad", []))),
+        (5, marshal.dumps((bot._PlayerSnapshots.FORMAT + 1, "off", None, None, None, 0, marshal.dumps([]), []))),
+    ]
+    with snapshots._db:
+        snapshots._db.executemany("INSERT INTO players VALUES (?, ?, 0)", rows)
+    assert set(snapshots.load()) == {1}
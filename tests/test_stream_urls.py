@@ -0,0 +1,48 @@
+import time
+
+import bot
+
+
+def test_stream_url_expiry_from_query_and_path():
+    assert bot._stream_url_expiry("https://rr1.googlevideo.com/videoplayback?expire=1700000000&ei=x") == 1700000000
+    assert bot._stream_url_expiry("https://manifest.googlevideo.com/api/manifest/hls/expire/1700000000/ei/x") == 1700000000
+    assert bot._stream_url_expiry("https://example.com/audio.mp3") is None
+    assert bot._stream_url_expiry("https://x/videoplayback?expire=soon") is None
+    assert bot._stream_url_expiry("https://x/api/expire") is None  # no value after the segment
+    assert bot._stream_url_expiry(None) is None
+
+
+def test_stream_url_is_fresh_with_expiry(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_URL_EXPIRY_MARGIN", 60)
+    now = time.time()
+    url = "https://x/videoplayback"
+    assert bot._stream_url_is_fresh(url, now, now + 3600)
+    assert not bot._stream_url_is_fresh(url, now, now + 30)  # inside the safety margin
+    # The URL must outlive the whole track
+    assert bot._stream_url_is_fresh(url, now, now + 600, min_remaining=300)
+    assert not bot._stream_url_is_fresh(url, now, now + 600, min_remaining=560)
+    assert not bot._stream_url_is_fresh(None, now, now + 3600)
+    assert not bot._stream_url_is_fresh("", now, now + 3600)
+
+
+def test_stream_url_is_fresh_without_expiry(monkeypatch):
+    monkeypatch.setattr(bot, "STREAM_URL_FALLBACK_TTL", 600)
+    now = time.time()
+    url = "https://example.com/audio.mp3"
+    assert bot._stream_url_is_fresh(url, now - 100, None)
+    assert not bot._stream_url_is_fresh(url, now - 700, None)
+    assert not bot._stream_url_is_fresh(url, None, None)
+
+
+def test_queue_item_stream_is_fresh_uses_duration():
+    item = bot._make_queue_item("https://youtu.be/x", 1)
+    assert not bot._queue_item_stream_is_fresh(item)
+    bot._apply_resolved_stream(item, {
+        "stream_url": "https://x/videoplayback",
+        "extracted_at": time.time(),
+        "expires_at": time.time() + bot.STREAM_URL_EXPIRY_MARGIN + 200,
+        "duration": 100,
+    })
+    assert bot._queue_item_stream_is_fresh(item)
+    item.duration = 300
+    assert not bot._queue_item_stream_is_fresh(item)
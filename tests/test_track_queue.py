@@ -0,0 +1,111 @@
+import random
+
+import pytest
+
+from bot import TrackQueue
+
+
+def _check(queue: TrackQueue, expected: list) -> None:
+    assert len(queue) == len(expected)
+    assert list(queue) == expected
+    if expected:
+        assert queue[0] == expected[0]
+        assert queue[-1] == expected[-1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_track_queue_matches_list(seed, monkeypatch):
+    rng = random.Random(seed)
+    queue, expected = TrackQueue(), []
+    # Small chunks so edits split and merge chunks often
+    monkeypatch.setattr(TrackQueue, "CHUNK", 4)
+    for step in range(2000):
+        op = rng.choice(["append", "appendleft", "extend", "insert", "pop", "popleft", "del", "move", "delete_front", "slice"])
+        if op == "append":
+            queue.append(step)
+            expected.append(step)
+        elif op == "appendleft":
+            queue.appendleft(step)
+            expected.insert(0, step)
+        elif op == "extend":
+            items = list(range(step, step + rng.randrange(20)))
+            queue.extend(items)
+            expected.extend(items)
+        elif op == "insert":
+            index = rng.randrange(len(expected) + 1)
+            queue.insert(index, step)
+            expected.insert(index, step)
+        elif not expected:
+            continue
+        elif op == "pop":
+            index = rng.randrange(-len(expected), len(expected))
+            assert queue.pop(index) == expected.pop(index)
+        elif op == "popleft":
+            assert queue.popleft() == expected.pop(0)
+        elif op == "del":
+            index = rng.randrange(len(expected))
+            del queue[index]
+            del expected[index]
+        elif op == "move":
+            src, dst = rng.randrange(len(expected)), rng.randrange(len(expected))
+            queue.move(src, dst)
+            expected.insert(dst, expected.pop(src))
+        elif op == "delete_front":
+            count = rng.randrange(len(expected) // 4 + 2)
+            assert queue.delete_front(count) == expected[:count]
+            del expected[:count]
+        else:
+            start = rng.randrange(len(expected))
+            stop = start + rng.randrange(30)
+            assert queue.slice(start, stop) == expected[start:stop]
+        _check(queue, expected)
+        if expected:
+            index = rng.randrange(len(expected))
+            assert queue[index] == expected[index]
+
+
+def test_track_queue_shuffle_and_clear():
+    queue = TrackQueue(range(1000))
+    queue.shuffle()
+    assert sorted(queue) == list(range(1000))
+    queue.clear()
+    _check(queue, [])
+    with pytest.raises(IndexError):
+        queue.popleft()
+
+
+def test_changed_from_keeps_unchanged_prefix():
+    rng = random.Random(1)
+    queue = TrackQueue(range(50))
+    snapshots = []
+    for step in range(300):
+        snapshots.append((queue.version, list(queue)))
+        op = rng.choice(["append", "pop", "insert", "move", "popleft", "extend"])
+        if op == "append":
+            queue.append(step)
+        elif op == "pop" and queue:
+            queue.pop(rng.randrange(len(queue)))
+        elif op == "insert":
+            queue.insert(rng.randrange(len(queue) + 1), step)
+        elif op == "move" and len(queue) > 1:
+            queue.move(rng.randrange(len(queue)), rng.randrange(len(queue)))
+        elif op == "popleft" and queue:
+            queue.popleft()
+        elif op == "extend":
+            queue.extend([step, step])
+        for version, items in snapshots[-70:]:
+            first = queue.changed_from(version)
+            if first is None:
+                assert list(queue) == items
+            else:
+                assert list(queue)[:first] == items[:first]
+
+
+def test_changed_from_appends_keep_existing_items():
+    queue = TrackQueue(range(10))
+    version = queue.version
+    assert queue.changed_from(version) is None
+    queue.append(10)
+    assert queue.changed_from(version) == 10
+    queue.popleft()
+    assert queue.changed_from(version) == 0